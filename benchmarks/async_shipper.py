@@ -0,0 +1,114 @@
+"""
+Throughput of the AsyncShipper against the worker threads sending batches over a PooledHttpClient,
+for a local collector answering every batch after a fixed latency, at several concurrencies.
+
+    python benchmarks/async_shipper.py --latency 0.05 --events 2000 --concurrency 2 8 32
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from moesifapi.configuration import Configuration
+from moesifapi.moesif_api_client import MoesifAPIClient
+from moesifwsgi.async_http_client import AsyncHttpClient
+from moesifwsgi.event_sender import EventSender
+from moesifwsgi.pooled_http_client import PooledHttpClient
+from moesifwsgi.workers import BatchedWorkerPool, Batcher, Worker
+
+EVENT = {"request": {"uri": "/items", "verb": "GET", "headers": {"accept": "a" * 200}}, "response": {"status": 200}}
+
+
+class SlowCollector(ThreadingHTTPServer):
+    """Answers every batch with 201 after latency seconds, and counts the batches"""
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.batches = 0
+        self.lock = threading.Lock()
+        super().__init__(('127.0.0.1', 0), SlowCollectorHandler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+class SlowCollectorHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        length = self.headers.get('Content-Length')
+        if length:
+            self.rfile.read(int(length))
+        else:
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if not size:
+                    self.rfile.readline()
+                    break
+                self.rfile.read(size)
+                self.rfile.readline()
+        time.sleep(self.server.latency)
+        with self.server.lock:
+            self.server.batches += 1
+        self.send_response(201)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+
+class NoConfig(object):
+    def check_and_update(self, response_headers):
+        pass
+
+
+def run(collector, api_client, mode, concurrency, event_count, batch_size):
+    collector.batches = 0
+    if mode == 'async':
+        pool = BatchedWorkerPool(1, EventSender(api_client), NoConfig(), False, 100000, batch_size, 0.05,
+                                 lambda event: event, async_http_client=AsyncHttpClient(),
+                                 async_concurrency=concurrency)
+    else:
+        pool = BatchedWorkerPool(concurrency, EventSender(api_client, http_client=PooledHttpClient(concurrency)),
+                                 NoConfig(), False, 100000, batch_size, 0.05, lambda event: event)
+    started = time.monotonic()
+    cpu_started = time.process_time()
+    for _ in range(event_count):
+        pool.add_event(EVENT, 500)
+    batch_count = event_count // batch_size
+    while collector.batches < batch_count and time.monotonic() - started < 120:
+        time.sleep(0.01)
+    elapsed = time.monotonic() - started
+    threads = sum(isinstance(thread, (Batcher, Worker)) for thread in threading.enumerate())
+    stats = pool.get_stats()
+    pool.stop()
+    print(f"{mode:7} concurrency {concurrency:3}: {event_count / elapsed:8.0f} events/s, "
+          f"{threads:3} threads, {time.process_time() - cpu_started:5.2f}s CPU, "
+          f"{stats.get('connections_opened')} connections")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--latency', type=float, default=0.05, help="seconds the collector takes to answer a batch")
+    parser.add_argument('--events', type=int, default=2000)
+    parser.add_argument('--batch-size', type=int, default=10)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[2, 8, 32])
+    args = parser.parse_args(argv)
+
+    collector = SlowCollector(args.latency)
+    Configuration.BASE_URI = f'http://127.0.0.1:{collector.server_port}'
+    api_client = MoesifAPIClient('benchmark').api
+    for concurrency in args.concurrency:
+        for mode in ('threads', 'async'):
+            run(collector, api_client, mode, concurrency, args.events, args.batch_size)
+    collector.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Time of a sampling rule lookup with the compiled RegexRuleIndex against the linear scan of every
+rule by moesifapi's RegexConfigHelper, for a config with many route rules.
+
+    python benchmarks/regex_rules.py --rules 2000 --lookups 20000 --baseline-lookups 100
+
+The linear scan takes around 0.1 s per lookup with thousands of rules, so it's only timed on the
+first --baseline-lookups lookups, which are also checked to give the same rate with both helpers.
+"""
+import argparse
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from moesifapi.app_config.regex_config_helper import RegexConfigHelper as LinearRegexConfigHelper
+from moesifwsgi.regex_config_helper import RegexConfigHelper
+
+
+def make_rules(count):
+    rules = []
+    for index in range(count):
+        conditions = [{"path": "request.route", "value": f"^/api/service{index % 20}/resource{index}(/|$)"}]
+        if index % 3 == 0:
+            conditions.append({"path": "request.verb", "value": "^(POST|PUT)$"})
+        rules.append({"conditions": conditions, "sample_rate": index % 100})
+    return rules
+
+
+def make_mappings(count, rule_count):
+    mappings = []
+    for _ in range(count):
+        index = random.randrange(rule_count * 2)
+        mappings.append({
+            "request.verb": random.choice(('GET', 'POST', 'PUT')),
+            "request.route": f"/api/service{index % 20}/resource{index}/items",
+            "request.ip_address": "10.0.0.1",
+            "response.status": 200,
+        })
+    return mappings
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rules', type=int, default=2000)
+    parser.add_argument('--lookups', type=int, default=20000)
+    parser.add_argument('--baseline-lookups', type=int, default=100)
+    args = parser.parse_args(argv)
+
+    random.seed(1)
+    rules = make_rules(args.rules)
+    mappings = make_mappings(args.lookups, args.rules)
+    indexed = RegexConfigHelper()
+    linear = LinearRegexConfigHelper()
+
+    baseline_mappings = mappings[:args.baseline_lookups]
+
+    # Both give the same rate for every lookup
+    for mapping in baseline_mappings:
+        assert indexed.fetch_sample_rate_on_regex_match(rules, mapping) == \
+            linear.fetch_sample_rate_on_regex_match(rules, mapping), mapping
+
+    for name, helper, lookups, repeat in (('linear scan', linear, baseline_mappings, 1),
+                                          ('indexed', indexed, mappings, 3)):
+        elapsed = min(timeit.repeat(
+            lambda: [helper.fetch_sample_rate_on_regex_match(rules, mapping) for mapping in lookups],
+            number=1, repeat=repeat))
+        print(f"{name:12} {args.rules} rules, {len(lookups)} lookups: "
+              f"{elapsed / len(lookups) * 1e6:10.2f} us per lookup")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+import math
+import random
+
+
+class AdaptiveSampler(object):
+    """
+    Samples events by the occupancy of the event queue, so the queue backs off smoothly before it is
+    full instead of dropping every event arriving once it is. Below low_watermark every event is kept.
+    Between the watermarks the sampling rate falls linearly from 1 to min_rate, and stays at min_rate
+    above high_watermark. The rate is recomputed for each event, so it recovers as the backlog drains.
+
+    The weight of a kept event is divided by the sampling rate, so counts in Moesif stay unbiased.
+    Weights are integers, so the fractional part is rounded up with its own probability.
+    """
+    def __init__(self, low_watermark, high_watermark, min_rate):
+        self.low_watermark = low_watermark
+        self.high_watermark = max(high_watermark, low_watermark)
+        self.min_rate = min_rate
+        self.rate = 1.0
+
+    def sampling_rate(self, occupancy):
+        """The share of events to keep when the event queue is occupancy full, from 0 to 1"""
+        if occupancy <= self.low_watermark:
+            return 1.0
+        if occupancy >= self.high_watermark:
+            return self.min_rate
+        progress = (occupancy - self.low_watermark) / (self.high_watermark - self.low_watermark)
+        return 1.0 - progress * (1.0 - self.min_rate)
+
+    def sample(self, weight, occupancy):
+        """The weight to record the event with, or None if it's sampled out"""
+        self.rate = rate = self.sampling_rate(occupancy)
+        if rate >= 1.0:
+            return weight
+        if random.random() >= rate:
+            return None
+        scaled = weight / rate
+        whole = math.floor(scaled)
+        return whole + (1 if random.random() < scaled - whole else 0)
+
+    def get_stats(self):
+        return {
+            "adaptive_sampling_rate": self.rate,
+        }
@@ -0,0 +1,191 @@
+import asyncio
+import collections
+import email.parser
+import http.client
+import logging
+import socket
+import ssl
+import urllib.parse
+
+from moesifapi.http.http_method_enum import HttpMethodEnum
+from moesifapi.http.http_response import HttpResponse
+from .pooled_http_client import DnsCache
+
+try:
+    import certifi
+except ImportError:
+    certifi = None
+
+logger = logging.getLogger(__name__)
+
+# Errors of a kept alive connection the server closed while it was idle, the request is sent again on a new connection
+STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError)
+
+
+class AsyncHttpClient(object):
+    """
+    HTTP/1.1 client over asyncio streams, for the AsyncShipper to keep several requests in flight
+    from a single thread. Idle keep-alive connections are kept per origin and reused most recently
+    used first. Resolved addresses are kept in a DnsCache, and resolved with loop.getaddrinfo when
+    they aren't cached, so a slow DNS lookup doesn't block the requests in flight.
+    Requests are built by the synchronous http client of the EventSender and executed here.
+    """
+    def __init__(self, timeout=30, dns_cache_ttl=60):
+        self.timeout = timeout
+        self.dns_cache = DnsCache(dns_cache_ttl)
+        self.ssl_context = ssl.create_default_context(cafile=certifi.where() if certifi is not None else None)
+        self._idle = collections.defaultdict(collections.deque)
+        self.stats = {
+            "requests": 0,
+            "connections_opened": 0,
+            "connections_reused": 0,
+        }
+
+    async def execute(self, request):
+        parsed = urllib.parse.urlsplit(request.query_url)
+        scheme = parsed.scheme or 'https'
+        port = parsed.port or (443 if scheme == 'https' else 80)
+        origin = (scheme, parsed.hostname, port)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+        host = parsed.hostname if parsed.port is None else f"{parsed.hostname}:{parsed.port}"
+        method = HttpMethodEnum.to_string(request.http_method)
+
+        idle = self._idle[origin]
+        reused = bool(idle)
+        connection = idle.pop() if reused else await self._connect(origin)
+        try:
+            response = await self._exchange(connection, method, host, path, request.headers, request.parameters)
+        except STALE_CONNECTION_ERRORS:
+            connection[1].close()
+            if not reused:
+                raise
+            # The server closed the idle connection, send again on a new one
+            reused = False
+            connection = await self._connect(origin)
+            try:
+                response = await self._exchange(connection, method, host, path, request.headers, request.parameters)
+            except BaseException:
+                connection[1].close()
+                raise
+        except BaseException:
+            connection[1].close()
+            raise
+
+        status, headers, raw_body, keep_alive = response
+        self.stats["requests"] += 1
+        if reused:
+            self.stats["connections_reused"] += 1
+        if keep_alive:
+            idle.append(connection)
+        else:
+            connection[1].close()
+        charset = headers.get_content_charset() or 'utf-8'
+        return HttpResponse(status, headers, raw_body.decode(charset, errors='replace'))
+
+    async def _connect(self, origin):
+        scheme, host, port = origin
+        addresses = self.dns_cache.get(host, port)
+        if addresses is None:
+            addresses = self.dns_cache.store(host, port, await self._wait(
+                asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)))
+        error = None
+        for _, _, _, _, address in addresses:
+            try:
+                connection = await self._wait(asyncio.open_connection(
+                    address[0], address[1],
+                    ssl=self.ssl_context if scheme == 'https' else None,
+                    server_hostname=host if scheme == 'https' else None))
+                self.stats["connections_opened"] += 1
+                return connection
+            except OSError as e:
+                error = e
+        self.dns_cache.invalidate(host, port)
+        raise error or OSError(f"Could not resolve {host}")
+
+    async def _wait(self, awaitable):
+        # Raised as the builtin TimeoutError, an OSError, which asyncio.TimeoutError isn't before Python 3.11
+        try:
+            return await asyncio.wait_for(awaitable, self.timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"Timed out after {self.timeout} seconds")
+
+    async def _exchange(self, connection, method, host, path, headers, body):
+        reader, writer = connection
+        request_headers = {'Host': host}
+        request_headers.update(headers or {})
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        chunked = False
+        if body is None or isinstance(body, bytes):
+            request_headers['Content-Length'] = str(len(body or b''))
+        elif hasattr(body, '__len__'):
+            # Streamed bodies with a known length are sent with Content-Length instead of chunked
+            request_headers['Content-Length'] = str(len(body))
+        else:
+            request_headers['Transfer-Encoding'] = 'chunked'
+            chunked = True
+        head = f"{method} {path} HTTP/1.1\r\n" + "".join(f"{k}: {v}\r\n" for k, v in request_headers.items()) + "\r\n"
+        writer.write(head.encode('latin-1'))
+        if isinstance(body, bytes):
+            writer.write(body)
+        elif body is not None:
+            for chunk in body:
+                if chunked:
+                    writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk) if chunk else b"")
+                else:
+                    writer.write(chunk)
+                await self._wait(writer.drain())
+            if chunked:
+                writer.write(b"0\r\n\r\n")
+        await self._wait(writer.drain())
+        return await self._wait(self._read_response(reader))
+
+    @classmethod
+    async def _read_response(cls, reader):
+        try:
+            status_line = await reader.readline()
+            if not status_line:
+                raise http.client.RemoteDisconnected("Remote end closed connection without response")
+            version, status = status_line.decode('latin-1').split(None, 2)[:2]
+            status = int(status)
+            header_lines = []
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                header_lines.append(line)
+            headers = email.parser.BytesParser(_class=http.client.HTTPMessage).parsebytes(b"".join(header_lines))
+
+            keep_alive = version == 'HTTP/1.1' and headers.get('Connection', '').lower() != 'close'
+            if 'chunked' in headers.get('Transfer-Encoding', '').lower():
+                chunks = []
+                while True:
+                    size = int((await reader.readline()).split(b";")[0].strip(), 16)
+                    if not size:
+                        # Trailers end with an empty line
+                        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                            pass
+                        break
+                    chunks.append(await reader.readexactly(size))
+                    await reader.readexactly(2)
+                raw_body = b"".join(chunks)
+            elif headers.get('Content-Length') is not None:
+                raw_body = await reader.readexactly(int(headers.get('Content-Length')))
+            elif status in (204, 304) or 100 <= status < 200:
+                raw_body = b""
+            else:
+                raw_body = await reader.read()
+                keep_alive = False
+            return status, headers, raw_body, keep_alive
+        except asyncio.IncompleteReadError:
+            raise http.client.RemoteDisconnected("Remote end closed connection before the response was complete")
+
+    def close(self):
+        for idle in self._idle.values():
+            while idle:
+                idle.pop()[1].close()
+
+    def get_stats(self):
+        return dict(self.stats)
@@ -1,104 +1,151 @@
-import re
+import functools
 import logging
 import ipaddress
 
 logger = logging.getLogger(__name__)
 
-class ClientIp:
+# Headers checked for the client ip address, in order, when CLIENT_IP_HEADERS is not set
+DEFAULT_CLIENT_IP_HEADERS = [
+    # Standard headers used by Amazon EC2, Heroku, and others.
+    'X-Client-IP',
+    # Load-balancers (AWS ELB) or proxies.
+    'X-Forwarded-For',
+    # Cloudflare.
+    # @see https://support.cloudflare.com/hc/en-us/articles/200170986-How-does-Cloudflare-handle-HTTP-Request-headers-
+    # CF-Connecting-IP - applied to every request to the origin.
+    'CF-Connecting-IP',
+    # Akamai and Cloudflare: True-Client-IP.
+    'True-Client-IP',
+    # Default nginx proxy/fcgi; alternative to x-forwarded-for, used by some proxies.
+    'X-Real-IP',
+    # (Rackspace LB and Riverbed's Stingray)
+    # http://www.rackspace.com/knowledge_center/article/controlling-access-to-linux-cloud-sites-based-on-the-client-ip-address
+    # https://splash.riverbed.com/docs/DOC-1926
+    'X-Cluster-Client-IP',
+    'X-Forwarded',
+    'Forwarded-For',
+    'Forwarded',
+]
+
+# Headers checked for the client ip address when TRUSTED_PROXIES is set and CLIENT_IP_HEADERS is not.
+# Trusted proxies pass the other headers through as the client sent them
+TRUSTED_CLIENT_IP_HEADERS = ['X-Forwarded-For']
+
+# Headers holding a comma separated list of addresses, one per proxy hop
+FORWARDED_LIST_HEADERS = {'x-forwarded-for'}
+
+# Maximum number of address strings kept with their validation result
+IP_CACHE_SIZE = 4096
+
 
-    def __init__(self):
-        pass
+class ClientIp:
+    """
+    Resolves the client ip address of a request. The header order and trusted proxy networks
+    are compiled once, and the validation of address strings is cached since the same client
+    and proxy addresses are seen over and over.
+
+    Without trusted proxies, the left-most valid address in X-Forwarded-For is the client, as
+    any proxy may have appended to it. With trusted proxies, the headers are only honoured if the
+    request came from a trusted proxy, and only X-Forwarded-For is read unless header_names are given.
+    It's walked from the right, skipping the trusted proxies, and the walk stops at an entry which isn't
+    an address, as the hops left of it can't be trusted. So a client can't spoof its address by
+    sending the headers itself.
+    """
+
+    def __init__(self, header_names=None, trusted_proxies=None, cache_size=IP_CACHE_SIZE):
+        self.trusted_networks = [ipaddress.ip_network(cidr, strict=False) for cidr in (trusted_proxies or [])]
+        self.resolvers = []
+        if not header_names:
+            header_names = TRUSTED_CLIENT_IP_HEADERS if self.trusted_networks else DEFAULT_CLIENT_IP_HEADERS
+        for header_name in header_names:
+            cgi_var = 'HTTP_' + header_name.upper().replace('-', '_')
+            if header_name.lower() in FORWARDED_LIST_HEADERS:
+                self.resolvers.append((cgi_var, self._from_forwarded_list))
+            else:
+                self.resolvers.append((cgi_var, self._from_single_value))
+        self._classify = functools.lru_cache(maxsize=cache_size)(self._classify_uncached)
 
     @classmethod
     def is_ip(cls, value):
         # https://docs.python.org/3/library/ipaddress.html#ipaddress.ip_address
         try:
-            ip = ipaddress.ip_address(value)
+            ipaddress.ip_address(value)
             return True
         except ValueError:
             return False
 
-    def getClientIpFromXForwardedFor(self, value):
+    def _classify_uncached(self, value):
+        """Returns the address without a port, and whether it belongs to a trusted proxy, or None if not an ip"""
+        if value.startswith('['):
+            # Bracketed IPv6 address with a port
+            value = value[1:].split(']', 1)[0]
+        elif value.count(':') == 1:
+            # Azure Web App's also adds a port for some reason, so we'll only use the first part (the IP)
+            value = value.split(':', 1)[0]
         try:
-
-            if not value or value is None:
+            ip = ipaddress.ip_address(value)
+        except ValueError:
+            return None
+        return value, any(ip in network for network in self.trusted_networks)
+
+    def _from_single_value(self, value):
+        classified = self._classify(value.strip())
+        if classified is not None:
+            return classified[0]
+        return None
+
+    def _from_forwarded_list(self, value):
+        # x-forwarded-for may return multiple IP addresses in the format:
+        # "client IP, proxy 1 IP, proxy 2 IP"
+        # Therefore, the right-most IP address is the IP address of the most recent proxy
+        # and the left-most IP address is the IP address of the originating client.
+        # source: http://docs.aws.amazon.com/elasticloadbalancing/latest/classic/x-forwarded-headers.html
+        # Sometimes IP addresses in this header can be 'unknown' (http://stackoverflow.com/a/11285650).
+        # A Squid configuration directive can also set the value to "unknown" (http://www.squid-cache.org/Doc/config/forwarded_for/)
+        entries = value.split(',')
+        if not self.trusted_networks:
+            # Taking the left-most IP address that is not unknown
+            for entry in entries:
+                classified = self._classify(entry.strip())
+                if classified is not None:
+                    return classified[0]
+            return None
+        # Walk from the right, the first address which is not a trusted proxy is the client
+        for entry in reversed(entries):
+            classified = self._classify(entry.strip())
+            if classified is None:
+                # The hops left of an entry which isn't an address can't be trusted
                 return None
-
-            if not isinstance(value, str):
-                logger.info(f"Expected a string, got: {str(type(value))}")
-            else:
-                # x-forwarded-for may return multiple IP addresses in the format:
-                # "client IP, proxy 1 IP, proxy 2 IP"
-                # Therefore, the right-most IP address is the IP address of the most recent proxy
-                # and the left-most IP address is the IP address of the originating client.
-                # source: http://docs.aws.amazon.com/elasticloadbalancing/latest/classic/x-forwarded-headers.html
-                # Azure Web App's also adds a port for some reason, so we'll only use the first part (the IP)
-                forwardedIps = []
-
-                for e in value.split(','):
-                    ip = e.strip()
-                    if ':' in ip:
-                        splitted = ip.split(':')
-                        if (len(splitted) == 2):
-                            forwardedIps.append(splitted[0])
-                    forwardedIps.append(ip)
-
-                # Sometimes IP addresses in this header can be 'unknown' (http://stackoverflow.com/a/11285650).
-                # Therefore taking the left-most IP address that is not unknown
-                # A Squid configuration directive can also set the value to "unknown" (http://www.squid-cache.org/Doc/config/forwarded_for/)
-                return next(item for item in forwardedIps if self.is_ip(item))
-        except StopIteration:
-            return value.encode('utf-8')
+            address, trusted = classified
+            if not trusted:
+                return address
+        return None
+
+    def is_forwarded(self, environ):
+        """Whether the request has one of the headers the client address is read from"""
+        return any(environ.get(cgi_var) for cgi_var, _ in self.resolvers)
+
+    def is_local_or_trusted(self, address):
+        """Whether the address is a loopback address or belongs to a trusted proxy"""
+        classified = self._classify(address) if address else None
+        if classified is None:
+            return False
+        return classified[1] or ipaddress.ip_address(classified[0]).is_loopback
 
     def get_client_address(self, environ):
+        remote_addr = environ.get('REMOTE_ADDR')
+        if self.trusted_networks:
+            # Forwarding headers can only be trusted when set by a trusted proxy
+            classified = self._classify(remote_addr) if remote_addr else None
+            if classified is None or not classified[1]:
+                return remote_addr
         try:
-            # Standard headers used by Amazon EC2, Heroku, and others.
-            if 'HTTP_X_CLIENT_IP' in environ:
-                if self.is_ip(environ['HTTP_X_CLIENT_IP']):
-                    return environ['HTTP_X_CLIENT_IP']
-
-            # Load-balancers (AWS ELB) or proxies.
-            if 'HTTP_X_FORWARDED_FOR' in environ:
-                xForwardedFor = self.getClientIpFromXForwardedFor(environ['HTTP_X_FORWARDED_FOR'])
-                if self.is_ip(xForwardedFor):
-                    return xForwardedFor
-
-            # Cloudflare.
-            # @see https://support.cloudflare.com/hc/en-us/articles/200170986-How-does-Cloudflare-handle-HTTP-Request-headers-
-            # CF-Connecting-IP - applied to every request to the origin.
-            if 'HTTP_CF_CONNECTING_IP' in environ:
-                if self.is_ip(environ['HTTP_CF_CONNECTING_IP']):
-                    return environ['HTTP_CF_CONNECTING_IP']
-
-            # Akamai and Cloudflare: True-Client-IP.
-            if 'HTTP_TRUE_CLIENT_IP' in environ:
-                if self.is_ip(environ['HTTP_TRUE_CLIENT_IP']):
-                    return environ['HTTP_TRUE_CLIENT_IP']
-
-            # Default nginx proxy/fcgi; alternative to x-forwarded-for, used by some proxies.
-            if 'HTTP_X_REAL_IP' in environ:
-                if self.is_ip(environ['HTTP_X_REAL_IP']):
-                    return environ['HTTP_X_REAL_IP']
-
-            # (Rackspace LB and Riverbed's Stingray)
-            # http://www.rackspace.com/knowledge_center/article/controlling-access-to-linux-cloud-sites-based-on-the-client-ip-address
-            # https://splash.riverbed.com/docs/DOC-1926
-            if 'HTTP_X_CLUSTER_CLIENT_IP' in environ:
-                if self.is_ip(environ['HTTP_X_CLUSTER_CLIENT_IP']):
-                    return environ['HTTP_X_CLUSTER_CLIENT_IP']
-
-            if 'HTTP_X_FORWARDED' in environ:
-                if self.is_ip(environ['HTTP_X_FORWARDED']):
-                    return environ['HTTP_X_FORWARDED']
-
-            if 'HTTP_FORWARDED_FOR' in environ:
-                if self.is_ip(environ['HTTP_FORWARDED_FOR']):
-                    return environ['HTTP_FORWARDED_FOR']
-
-            if 'HTTP_FORWARDED' in environ:
-                if self.is_ip(environ['HTTP_FORWARDED']):
-                    return environ['HTTP_FORWARDED']
-
-            return environ['REMOTE_ADDR']
-        except KeyError:
-            return environ['REMOTE_ADDR']
+            for cgi_var, resolver in self.resolvers:
+                value = environ.get(cgi_var)
+                if value:
+                    address = resolver(value)
+                    if address is not None:
+                        return address
+        except Exception as e:
+            logger.info(f"Error while resolving the client ip address: {str(e)}")
+        return remote_addr
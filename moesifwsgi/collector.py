@@ -0,0 +1,219 @@
+import argparse
+import logging
+import os
+import signal
+import socket
+import threading
+
+from moesifapi.configuration import Configuration
+from moesifapi.moesif_api_client import MoesifAPIClient
+from .event_sender import EventSender
+from .pooled_http_client import PooledHttpClient
+from .workers import BatchedWorkerPool
+
+logger = logging.getLogger(__name__)
+
+# Largest datagram sent to the collector, larger events are sent in process
+DATAGRAM_MAX_SIZE = 65536
+# Receive buffer of the collector socket, absorbing bursts from the processes of the host
+COLLECTOR_RECEIVE_BUFFER = 4194304
+# Permissions of the collector socket, sending to it needs write permission
+DEFAULT_SOCKET_MODE = 0o660
+
+
+class CollectorSender(EventSender):
+    """
+    EventSender forwarding the serialized events to the collector of the host over a Unix datagram
+    socket, which batches the events of every process and sends them to Moesif. Several events are
+    packed in a datagram, separated by newlines, which compact JSON never contains. Events which
+    can't be forwarded, because the collector isn't running, is falling behind or the event is too
+    large for a datagram, are sent in process instead. The socket is shared by the worker threads,
+    so it's created, used and closed under the lock.
+    """
+    def __init__(self, socket_path, api_client, **kwargs):
+        super().__init__(api_client, **kwargs)
+        self.socket_path = socket_path
+        self._socket = None
+        self._available = True
+        self._forwarded = 0
+        self._sent_in_process = 0
+
+    def send(self, batch_events, stop_event=None):
+        unsent = self.forward(batch_events)
+        with self._lock:
+            self._forwarded += len(batch_events) - len(unsent)
+            self._sent_in_process += len(unsent)
+        if not unsent:
+            # The collector checks the config ETags of its responses
+            return {}
+        return super().send(unsent, stop_event)
+
+    def forward(self, batch_events):
+        """Forward the events to the collector, returns the events which could not be forwarded"""
+        unsent = [event for event in batch_events if len(event) > DATAGRAM_MAX_SIZE]
+        events = [event for event in batch_events if len(event) <= DATAGRAM_MAX_SIZE]
+        start = 0
+        with self._lock:
+            try:
+                if self._socket is None:
+                    self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                    self._socket.setblocking(False)
+                    self._socket.connect(self.socket_path)
+                while start < len(events):
+                    end = start + 1
+                    size = len(events[start])
+                    while end < len(events) and size + 1 + len(events[end]) <= DATAGRAM_MAX_SIZE:
+                        size += 1 + len(events[end])
+                        end += 1
+                    self._socket.send(b"\n".join(events[start:end]))
+                    start = end
+                if not self._available:
+                    logger.info(f"Forwarding events to the collector at {self.socket_path} again")
+                    self._available = True
+            except OSError as e:
+                self._close_socket()
+                if self._available:
+                    logger.info(f"Sending events in process, the collector at {self.socket_path} is unavailable. {str(e)}")
+                    self._available = False
+                unsent.extend(events[start:])
+        return unsent
+
+    def _close_socket(self):
+        """Close the socket, called with the lock held"""
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def close(self):
+        with self._lock:
+            self._close_socket()
+        super().close()
+
+    def get_stats(self):
+        stats = super().get_stats()
+        with self._lock:
+            stats["forwarded_events"] = self._forwarded
+            stats["events_sent_in_process"] = self._sent_in_process
+        return stats
+
+
+class EventCollector(object):
+    """
+    Receives the events forwarded by the middleware of the processes of a host on a Unix datagram
+    socket, and sends them to Moesif in batches with a single pool of workers and connections.
+    The socket is given socket_mode, so only the processes of its owner and group can send events.
+    """
+    def __init__(self, socket_path, api_client, worker_count, max_queue_size, batch_size, timeout, debug,
+                 max_worker_count=None, socket_mode=DEFAULT_SOCKET_MODE):
+        self.socket_path = socket_path
+        self.socket_mode = socket_mode
+        self.debug = debug
+        self.event_sender = EventSender(api_client, http_client=PooledHttpClient(max(worker_count, max_worker_count or 0)))
+        self.worker_pool = BatchedWorkerPool(
+            worker_count=worker_count,
+            event_sender=self.event_sender,
+            config=None,
+            debug=debug,
+            max_queue_size=max_queue_size,
+            batch_size=batch_size,
+            timeout=timeout,
+            # Events are received serialized
+            build_event=None,
+            max_worker_count=max_worker_count,
+        )
+        self.dropped_events = 0
+        self.invalid_events = 0
+        self._stop_event = threading.Event()
+
+    def bind(self):
+        if os.path.exists(self.socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            try:
+                probe.connect(self.socket_path)
+                raise RuntimeError(f"A collector is already running at {self.socket_path}")
+            except OSError:
+                # Left by a collector which didn't stop cleanly
+                os.remove(self.socket_path)
+            finally:
+                probe.close()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, COLLECTOR_RECEIVE_BUFFER)
+        sock.bind(self.socket_path)
+        os.chmod(self.socket_path, self.socket_mode)
+        sock.settimeout(1)
+        return sock
+
+    def serve_forever(self):
+        sock = self.bind()
+        logger.info(f"Collecting events on {self.socket_path}")
+        try:
+            while not self._stop_event.is_set():
+                try:
+                    datagram = sock.recv(DATAGRAM_MAX_SIZE)
+                except socket.timeout:
+                    continue
+                for event in datagram.split(b"\n"):
+                    if not self.is_valid_event(event):
+                        self.invalid_events += 1
+                        continue
+                    if not self.worker_pool.add_event(event, len(event)):
+                        self.dropped_events += 1
+        finally:
+            sock.close()
+            os.remove(self.socket_path)
+            self.worker_pool.stop()
+            self.event_sender.close()
+            logger.info(f"Collector stopped, dropped {self.dropped_events} events. {self.get_stats()}")
+
+    @classmethod
+    def is_valid_event(cls, event):
+        """Whether a piece of a datagram looks like a serialized event, a JSON object, without parsing it"""
+        return event[:1] == b"{" and event[-1:] == b"}"
+
+    def stop(self):
+        self._stop_event.set()
+
+    def get_stats(self):
+        stats = self.worker_pool.get_stats()
+        stats.update(self.worker_pool.metrics.get_stats())
+        stats["dropped_events"] = self.dropped_events
+        stats["invalid_events"] = self.invalid_events
+        return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Receive the events of the Moesif middleware of the processes of this host, "
+                    "configured with COLLECTOR_SOCKET, and send them to Moesif in batches.")
+    parser.add_argument('--socket', required=True, help="path of the Unix socket to receive events on")
+    parser.add_argument('--socket-mode', type=lambda mode: int(mode, 8), default=DEFAULT_SOCKET_MODE,
+                        help="octal permissions of the socket, defaults to 660 so only the processes of its "
+                             "user and group can send events")
+    parser.add_argument('--application-id', default=os.environ.get('MOESIF_APPLICATION_ID'),
+                        help="Moesif Application Id, defaults to the MOESIF_APPLICATION_ID environment variable")
+    parser.add_argument('--base-uri', default='https://api.moesif.net')
+    parser.add_argument('--workers', type=int, default=2, help="number of threads sending batches")
+    parser.add_argument('--max-workers', type=int,
+                        help="scale the threads sending batches between --workers and this number as needed")
+    parser.add_argument('--queue-size', type=int, default=1000000)
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--batch-timeout', type=float, default=2)
+    parser.add_argument('--debug', action='store_true')
+    args = parser.parse_args(argv)
+    if not args.application_id:
+        parser.error("the Moesif Application Id is required")
+
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO,
+        format='%(asctime)s\t%(levelname)s\tPID: %(process)d\tThread: %(thread)d\t%(funcName)s\t%(message)s',
+    )
+    api_client = MoesifAPIClient(args.application_id).api
+    Configuration.BASE_URI = args.base_uri
+    Configuration.version = "moesifwsgi-python/1.10.5"
+
+    collector = EventCollector(args.socket, api_client, args.workers, args.queue_size, args.batch_size,
+                               args.batch_timeout, args.debug, args.max_workers, args.socket_mode)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: collector.stop())
+    collector.serve_forever()
+
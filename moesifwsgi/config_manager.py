@@ -0,0 +1,16 @@
+import concurrent.futures
+
+from moesifapi.config_manager import ConfigUpdateManager
+from readerwriterlock import rwlock
+
+
+class ForkSafeConfigUpdateManager(ConfigUpdateManager):
+    """
+    ConfigUpdateManager which keeps working in a process forked from the one which created it.
+    The update thread of the parent doesn't exist in a forked child, and its lock may have been
+    held by a thread of the parent during the fork, so after_fork_in_child gives the manager an
+    update thread and lock of its own. The configuration fetched by the parent is kept.
+    """
+    def after_fork_in_child(self):
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._lock = rwlock.RWLockFairD()
@@ -1,9 +1,9 @@
 import logging
+import time
 
 from moesifapi.models import *
 from moesifapi.parse_body import ParseBody
 from .logger_helper import LoggerHelper
-import logging
 
 logger = logging.getLogger(__name__)
 
@@ -14,7 +14,15 @@ class EventMapper:
         self.logger_helper = LoggerHelper()
 
     @classmethod
-    def to_event(cls, data, event_req, event_rsp, blocked_by):
+    def format_time(cls, time_ns):
+        """Format a wall clock time in nanoseconds as an ISO 8601 UTC timestamp with milliseconds"""
+        if time_ns is None:
+            return None
+        seconds, remainder = divmod(time_ns, 1000000000)
+        return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(seconds)) + ".%03d" % (remainder // 1000000)
+
+    @classmethod
+    def to_event(cls, data, event_req, event_rsp):
         # Prepare Event Model
         return EventModel(request=event_req,
                           response=event_rsp,
@@ -23,22 +31,46 @@ class EventMapper:
                           session_token=data.session_token,
                           metadata=data.metadata,
                           direction="Incoming",
-                          blocked_by=blocked_by)
+                          blocked_by=data.blocked_by)
 
     @classmethod
-    def to_request(cls, data, log_body, api_version):
+    def response_status(cls, data):
+        if data.status and data.status != -1:
+            return int(data.status[:3])
+        return None
+
+    def parse_request_body(self, data, req_headers):
+        # Parsed at most once, whether for the callbacks, the governance rules or the event
+        if data.parsed_request_body is None:
+            data.parsed_request_body = self._parse_request_body(data, req_headers)
+        return data.parsed_request_body
+
+    def _parse_request_body(self, data, req_headers):
+        if not data.request_body:
+            return None, None
+        if data.is_request_body_truncated():
+            # Partial bodies can not be parsed, so record why the body was left out instead
+            return {"msg": f"request.body.length exceeded REQUEST_MAX_BODY_SIZE of {len(data.request_body)} bytes"}, 'json'
+        content_encoding = req_headers.get('Content-Encoding') if req_headers else None
+        if isinstance(data.request_body, str):
+            return self.parse_body.parse_string_body(data.request_body, content_encoding, None)
+        return self.parse_body.parse_bytes_body(data.request_body, content_encoding, None)
+
+    def to_request(self, data, log_body, api_version):
+        req_headers = None
+        if data.request_headers or data.transaction_id:
+            req_headers = dict(data.request_headers.as_dict())
+            # Add transaction id to the request header
+            if data.transaction_id:
+                req_headers["X-Moesif-Transaction-Id"] = data.transaction_id
+
         req_body = None
         req_transfer_encoding = None
         if log_body:
-            req_body = data.request_body
-            req_transfer_encoding = data.transfer_encoding
-
-        req_headers = None
-        if data.request_headers:
-            req_headers = dict(data.request_headers)
+            req_body, req_transfer_encoding = self.parse_request_body(data, req_headers)
 
         # Prepare Event Request Model
-        return EventRequestModel(time=data.request_time,
+        return EventRequestModel(time=self.format_time(data.request_time_ns),
                                  uri=data.url,
                                  verb=data.method,
                                  api_version=api_version,
@@ -48,43 +80,28 @@ class EventMapper:
                                  transfer_encoding=req_transfer_encoding)
 
     def to_response(self, data, log_body, debug):
-        response_content = None
-
-        try:
-            response_content = "".join(data.response_chunks)
-        except:
-            try:
-                response_content = b"".join(data.response_chunks)
-            except:
-                if debug:
-                    logger.info(f'try to join response chunks failed - for pid - {self.logger_helper.get_worker_pid()}')
-
         rsp_headers = None
         if data.response_headers:
             rsp_headers = dict(data.response_headers)
 
         rsp_body = None
         rsp_transfer_encoding = None
-        if log_body and response_content:
-            if debug:
-                logger.info(f"about to process response for pid - {self.logger_helper.get_worker_pid()}"
-                            + f" response_content - {str(response_content)}")
-            if isinstance(response_content, str):
-                rsp_body, rsp_transfer_encoding = self.parse_body.parse_string_body(response_content, None,
-                                                                                         self.parse_body.transform_headers(
-                                                                                             rsp_headers))
+        if log_body and data.response_body:
+            if data.is_response_body_truncated():
+                # Partial bodies can not be parsed, so record why the body was left out instead
+                rsp_body = {"msg": f"response.body.length exceeded RESPONSE_MAX_BODY_SIZE of {len(data.response_body)} bytes"}
+                rsp_transfer_encoding = 'json'
             else:
-                rsp_body, rsp_transfer_encoding = self.parse_body.parse_bytes_body(response_content, None,
-                                                                                        self.parse_body.transform_headers(
-                                                                                            rsp_headers))
-
-        response_status = None
-        if data.status:
-            response_status = int(data.status[:3])
+                if debug:
+                    logger.info(f"about to process response for pid - {self.logger_helper.get_worker_pid()}"
+                                + f" response_content - {str(data.response_body)}")
+                rsp_body, rsp_transfer_encoding = self.parse_body.parse_bytes_body(bytes(data.response_body), None,
+                                                                                    self.parse_body.transform_headers(
+                                                                                        rsp_headers or {}))
 
         # Prepare Event Response Model
-        return EventResponseModel(time=data.response_time,
-                                  status=response_status,
+        return EventResponseModel(time=self.format_time(data.response_time_ns),
+                                  status=self.response_status(data),
                                   headers=rsp_headers,
                                   body=rsp_body,
                                   transfer_encoding=rsp_transfer_encoding)
@@ -0,0 +1,328 @@
+import gzip
+import http.client
+import json
+import logging
+import threading
+import time
+import zlib
+
+import requests
+from requests.adapters import HTTPAdapter
+from moesifapi.api_helper import APIHelper
+from moesifapi.models.base_model import BaseModel
+from moesifapi.configuration import Configuration
+from moesifapi.exceptions.api_exception import APIException
+from moesifapi.http.http_context import HttpContext
+from moesifapi.http.http_method_enum import HttpMethodEnum
+from moesifapi.http.requests_client import RequestsClient
+from .retry import (CircuitBreaker, CircuitOpenError, RETRY_AFTER_STATUSES, RETRYABLE_STATUSES, backoff_delay,
+                    parse_retry_after)
+
+logger = logging.getLogger(__name__)
+
+# zlib window bits which produce a gzip stream
+GZIP_WBITS = 31
+
+
+class BatchStream(object):
+    """
+    Re-iterable request body which yields the JSON array of a batch in chunks of about chunk_size,
+    so the batch is never copied into one contiguous payload. Small events are coalesced into a
+    chunk and large events are yielded as they are. The length is known up front and sent as
+    Content-Length. The stream is iterated again if the request is retried.
+    """
+    def __init__(self, batch_events, chunk_size):
+        self.batch_events = batch_events
+        self.chunk_size = chunk_size
+        self.length = 2 + sum(len(event) for event in batch_events) + max(len(batch_events) - 1, 0)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        chunk = bytearray(b"[")
+        for index, event in enumerate(self.batch_events):
+            if index:
+                chunk += b","
+            if len(event) >= self.chunk_size:
+                yield bytes(chunk)
+                chunk = bytearray()
+                yield event
+                continue
+            chunk += event
+            if len(chunk) >= self.chunk_size:
+                yield bytes(chunk)
+                chunk = bytearray()
+        chunk += b"]"
+        yield bytes(chunk)
+
+
+class CompressedBatchStream(object):
+    """
+    Re-iterable request body which gzip compresses a BatchStream on the fly. The compressed length
+    is not known up front, so it has no length and is sent with chunked transfer encoding.
+    on_compressed is called with the uncompressed and compressed sizes and the CPU time once the
+    stream has been compressed.
+    """
+    def __init__(self, stream, compression_level, on_compressed=None):
+        self.stream = stream
+        self.compression_level = compression_level
+        self.on_compressed = on_compressed
+
+    def __iter__(self):
+        compressor = zlib.compressobj(self.compression_level, zlib.DEFLATED, GZIP_WBITS)
+        compressed_size = 0
+        cpu_time = 0.0
+        for chunk in self.stream:
+            start = time.thread_time()
+            compressed = compressor.compress(chunk)
+            cpu_time += time.thread_time() - start
+            if compressed:
+                compressed_size += len(compressed)
+                yield compressed
+        start = time.thread_time()
+        compressed = compressor.flush()
+        cpu_time += time.thread_time() - start
+        compressed_size += len(compressed)
+        if self.on_compressed is not None:
+            # Only counted once if the stream is sent again by a retry
+            self.on_compressed(self.stream.length, compressed_size, cpu_time)
+            self.on_compressed = None
+        yield compressed
+
+
+class SingleAttemptRequestsClient(RequestsClient):
+    """
+    RequestsClient without the retries of its connection pool, nor the immediate resend on a
+    ConnectionError of RequestsClient.execute_as_string, as the EventSender retries batches itself.
+    Connecting and each read time out after timeout seconds, so a collector which stops responding
+    fails the attempt instead of blocking the worker.
+    """
+    def __init__(self, timeout=30):
+        self.timeout = timeout
+        super().__init__()
+
+    def __create_connection_pool__(self):
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(
+            max_retries=0,
+            pool_connections=Configuration.pool_connections,
+            pool_maxsize=Configuration.pool_maxsize
+        )
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+
+    def execute_as_string(self, request):
+        auth = None
+        if request.username or request.password:
+            auth = (request.username, request.password)
+        try:
+            response = self.session.request(HttpMethodEnum.to_string(request.http_method),
+                                            request.query_url,
+                                            headers=request.headers,
+                                            params=request.query_parameters,
+                                            data=request.parameters,
+                                            files=request.files,
+                                            auth=auth,
+                                            timeout=(self.timeout, self.timeout))
+        except requests.exceptions.ConnectionError:
+            # Drop the pooled connections, the attempt is retried with backoff by the EventSender
+            self.__refresh_connection_pool__()
+            raise
+        return self.convert_response(response, False)
+
+
+class EventSender(object):
+    """
+    Sends batches of events to Moesif from the worker threads. The batch payload is serialized and
+    compressed here instead of inside the api client, so compression can be configured and measured.
+    Payloads smaller than compression_min_size are sent uncompressed, as compression gains little on them.
+
+    Events are serialized one at a time to compact JSON bytes, and the batch payload is assembled
+    by joining those bytes, so the whole batch is never serialized in one call. With stream_uploads,
+    the payload is streamed from a BatchStream instead, so the memory a worker needs on top of the
+    serialized events is bounded by stream_chunk_size rather than the size of the batch.
+    Batches are sent with http_client if given, such as a PooledHttpClient, otherwise with a requests
+    session of their own, whose attempts time out after timeout seconds.
+
+    Failed attempts which may succeed later, such as network errors, throttling and 5xx responses, are
+    retried up to max_retries times with jittered exponential backoff, honouring Retry-After on 429 and
+    503 responses, as long as the batch has not been retrying for more than max_retry_time seconds.
+    A circuit breaker shared by the workers stops attempts while the collector keeps failing.
+    """
+    def __init__(self, api_client, compression=True, compression_level=9, compression_min_size=1024,
+                 stream_uploads=False, stream_chunk_size=65536, http_client=None, max_retries=3,
+                 max_retry_time=60, circuit_breaker_threshold=5, circuit_breaker_reset_timeout=30, timeout=30):
+        self.api_client = api_client
+        self.http_client = http_client or SingleAttemptRequestsClient(timeout)
+        self.max_retries = max_retries
+        self.max_retry_time = max_retry_time
+        self.circuit_breaker = CircuitBreaker(circuit_breaker_threshold, circuit_breaker_reset_timeout)
+        self._retries = 0
+        self._batches_failed = 0
+        self._batches_rejected = 0
+        self.compression = compression
+        self.compression_level = compression_level
+        self.compression_min_size = compression_min_size
+        self.stream_uploads = stream_uploads
+        self.stream_chunk_size = stream_chunk_size
+        self._lock = threading.Lock()
+        self._batches_sent = 0
+        self._batches_compressed = 0
+        self._bytes_uncompressed = 0
+        self._bytes_compressed = 0
+        self._compression_cpu_time = 0.0
+
+    @classmethod
+    def serialize_event(cls, event):
+        """Serialize an event model to compact JSON bytes"""
+        if isinstance(event, BaseModel):
+            event = event.to_dictionary()
+        return json.dumps(event, separators=(',', ':')).encode('utf-8')
+
+    def build_payload(self, batch_events):
+        """
+        Join the serialized events into a JSON array, and compress it if enabled and large enough.
+        Returns the payload and its headers
+        """
+        headers = {
+            'content-type': 'application/json; charset=utf-8',
+            'X-Moesif-Application-Id': Configuration.application_id,
+            'User-Agent': Configuration.version,
+        }
+        if self.stream_uploads:
+            payload = BatchStream(batch_events, self.stream_chunk_size)
+            if self.compression and payload.length >= self.compression_min_size:
+                payload = CompressedBatchStream(payload, self.compression_level, self._record_compression)
+                headers['Content-Encoding'] = 'gzip'
+            return payload, headers
+
+        payload = b"[" + b",".join(batch_events) + b"]"
+        if self.compression and len(payload) >= self.compression_min_size:
+            # Only the CPU time of this worker thread is counted
+            start = time.thread_time()
+            compressed = gzip.compress(payload, compresslevel=self.compression_level)
+            self._record_compression(len(payload), len(compressed), time.thread_time() - start)
+            payload = compressed
+            headers['Content-Encoding'] = 'gzip'
+        return payload, headers
+
+    def _record_compression(self, uncompressed_size, compressed_size, cpu_time):
+        with self._lock:
+            self._batches_compressed += 1
+            self._bytes_uncompressed += uncompressed_size
+            self._bytes_compressed += compressed_size
+            self._compression_cpu_time += cpu_time
+
+    def send(self, batch_events, stop_event=None):
+        """
+        POST the batch to /v1/events/batch, retrying failed attempts, returns the response headers.
+        Retries are abandoned once stop_event is set.
+        """
+        payload, headers = self.build_payload(batch_events)
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            self.check_circuit()
+            try:
+                request = self.prepare_request(payload, headers)
+                return self.complete_request(request, self.http_client.execute_as_string(request))
+            except Exception as e:
+                delay = self.retry_delay(e, attempt, started)
+                if delay is None:
+                    raise
+                attempt += 1
+                if stop_event is not None:
+                    if stop_event.wait(delay):
+                        self.count_failed()
+                        raise
+                else:
+                    time.sleep(delay)
+
+    def check_circuit(self):
+        """Raise CircuitOpenError if the circuit breaker doesn't let an attempt through"""
+        if not self.circuit_breaker.allow():
+            with self._lock:
+                self._batches_rejected += 1
+            raise CircuitOpenError("Moesif API unavailable, the circuit breaker is open")
+
+    def retry_delay(self, error, attempt, started):
+        """
+        Record a failed attempt, and return the delay in seconds before the next attempt,
+        or None if the batch is given up on
+        """
+        retryable, retry_after = self.is_retryable(error)
+        if not retryable:
+            # The collector responded, it's the batch which was rejected
+            if isinstance(error, APIException):
+                self.circuit_breaker.record_success()
+            self.count_failed()
+            return None
+        self.circuit_breaker.record_failure()
+        delay = backoff_delay(attempt)
+        if retry_after is not None:
+            delay += retry_after
+        if attempt + 1 > self.max_retries or time.monotonic() - started + delay > self.max_retry_time:
+            self.count_failed()
+            return None
+        logger.info(f"Retrying batch in {delay:.2f} seconds after error: {str(error)}")
+        with self._lock:
+            self._retries += 1
+        return delay
+
+    @classmethod
+    def is_retryable(cls, error):
+        """Whether a failed attempt may succeed later, and the Retry-After delay in seconds if the collector gave one"""
+        if isinstance(error, APIException):
+            retry_after = None
+            if error.response_code in RETRY_AFTER_STATUSES:
+                retry_after = parse_retry_after(error.context.response.headers.get('Retry-After'))
+            return error.response_code in RETRYABLE_STATUSES, retry_after
+        # Network errors and timeouts, requests exceptions are OSErrors too
+        return isinstance(error, (OSError, http.client.HTTPException)), None
+
+    def count_failed(self):
+        with self._lock:
+            self._batches_failed += 1
+
+    def prepare_request(self, payload, headers):
+        """The request posting the payload to /v1/events/batch"""
+        query_url = APIHelper.clean_url(Configuration.BASE_URI + '/v1/events/batch')
+        request = self.http_client.post(query_url, headers=headers, parameters=payload)
+        if self.api_client.http_call_back is not None:
+            self.api_client.http_call_back.on_before_request(request)
+        return request
+
+    def complete_request(self, request, response):
+        """Validate the response of the request, returns its headers"""
+        context = HttpContext(request, response)
+        if self.api_client.http_call_back is not None:
+            self.api_client.http_call_back.on_after_response(context)
+        self.api_client.validate_response(context)
+        self.circuit_breaker.record_success()
+        with self._lock:
+            self._batches_sent += 1
+        return response.headers
+
+    def close(self):
+        if hasattr(self.http_client, 'close'):
+            self.http_client.close()
+
+    def get_stats(self):
+        stats = self.http_client.get_stats() if hasattr(self.http_client, 'get_stats') else {}
+        with self._lock:
+            stats.update({
+                "batches_sent": self._batches_sent,
+                "batches_failed": self._batches_failed,
+                "batches_rejected": self._batches_rejected,
+                "retries": self._retries,
+                "circuit_breaker_state": self.circuit_breaker.state,
+                "circuit_breaker_opened": self.circuit_breaker.opened_count,
+                "batches_compressed": self._batches_compressed,
+                "bytes_uncompressed": self._bytes_uncompressed,
+                "bytes_compressed": self._bytes_compressed,
+                "compression_ratio": (self._bytes_uncompressed / self._bytes_compressed
+                                      if self._bytes_compressed else None),
+                "compression_cpu_seconds": self._compression_cpu_time,
+            })
+        return stats
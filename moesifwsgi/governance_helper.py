@@ -0,0 +1,238 @@
+import json
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on the responses rendered with merge tag values, one per rule and user or company
+MAX_RENDERED_RESPONSES = 4096
+
+
+def compile_condition(condition):
+    """Compile a condition into where its value is read from, the key and the pattern"""
+    path = condition['path']
+    pattern = re.compile(condition['value'])
+    if path.startswith('request.body.'):
+        return 'body', path[len('request.body.'):], pattern
+    if path.startswith('request.headers.'):
+        # Headers are matched case insensitively
+        return 'headers', path[len('request.headers.'):].lower(), pattern
+    return 'fields', path, pattern
+
+
+def replace_merge_tags(value, merge_tag_values, rule_variables):
+    """Replace the {{name}} merge tags of the rule variables in the headers and body of a rule response"""
+    if not rule_variables or not value:
+        return value
+    if isinstance(value, str):
+        for rule_variable in rule_variables:
+            name = rule_variable['name']
+            value = value.replace('{{' + name + '}}', merge_tag_values.get(name, 'UNKNOWN'))
+        return value
+    if isinstance(value, dict):
+        return {k: replace_merge_tags(v, merge_tag_values, rule_variables) for k, v in value.items()}
+    if isinstance(value, list):
+        return [replace_merge_tags(v, merge_tag_values, rule_variables) for v in value]
+    return value
+
+
+class GovernanceRule(object):
+    """
+    A governance rule with its regex conditions compiled. The headers, status line and body of the
+    response are rendered once, or once per set of merge tag values for rules with variables.
+    """
+    def __init__(self, rule, wsgi_statuses):
+        self.id = rule['_id']
+        self.type = rule.get('type')
+        self.applied_to = rule.get('applied_to')
+        self.applied_to_unidentified = rule.get('applied_to_unidentified', False)
+        self.block = bool(rule.get('block'))
+        self.variables = rule.get('variables') or None
+
+        # None applies to every request, an empty tuple never matches
+        self.condition_sets = None
+        if rule.get('regex_config'):
+            self.condition_sets = tuple(
+                tuple(compile_condition(condition) for condition in one_regex_config['conditions'])
+                for one_regex_config in rule['regex_config']
+                if one_regex_config['conditions']
+            )
+
+        response = rule.get('response') or {}
+        self.response_headers = response.get('headers') or {}
+        self.response_body = response.get('body')
+        self.status = response.get('status')
+        self.status_line = None
+        if self.block:
+            self.status_line = wsgi_statuses.get(int(self.status), str(self.status))
+
+        self._default_response = self._render(None)
+        self._rendered = {}
+
+    def uses(self, source):
+        return bool(self.condition_sets) and any(
+            condition[0] == source for condition_set in self.condition_sets for condition in condition_set)
+
+    def matches(self, request_fields, request_body, request_headers):
+        if self.condition_sets is None:
+            return True
+        for condition_set in self.condition_sets:
+            for source, key, pattern in condition_set:
+                if source == 'body':
+                    value = request_body.get(key) if isinstance(request_body, dict) else None
+                elif source == 'headers':
+                    value = request_headers.get(key) if request_headers else None
+                else:
+                    value = request_fields.get(key)
+                if not value or not pattern.search(str(value)):
+                    break
+            else:
+                return True
+        return False
+
+    def _render(self, merge_tag_values):
+        merge_tag_values = merge_tag_values or {}
+        headers = replace_merge_tags(self.response_headers, merge_tag_values, self.variables)
+        body = None
+        if self.block:
+            body = json.dumps(replace_merge_tags(self.response_body, merge_tag_values, self.variables)).encode('utf-8')
+        return headers, body
+
+    def response(self, merge_tag_values):
+        """Headers dict and body bytes of the rule response"""
+        if not self.variables or not merge_tag_values:
+            return self._default_response
+        # The merge tag values are held by the config the rule set was compiled from, so their id is stable
+        key = id(merge_tag_values)
+        rendered = self._rendered.get(key)
+        if rendered is None:
+            rendered = self._render(merge_tag_values)
+            if len(self._rendered) >= MAX_RENDERED_RESPONSES:
+                self._rendered = {}
+            self._rendered[key] = rendered
+        return rendered
+
+
+class GovernedResponse(object):
+    """The headers to add to the response, and the blocking response if a rule blocks the request"""
+    def __init__(self, headers, blocked_by=None, status_line=None, body=None):
+        self.headers = headers
+        self.blocked_by = blocked_by
+        self.status_line = status_line
+        self.body = body
+
+
+class GovernanceRuleSet(object):
+    """
+    Governance rules compiled for a version of the rules and config. Rules are split into regex,
+    user and company tables as the config manager does, the user and company cohorts are looked up
+    in the config by id, and the rules applying to users or companies outside their cohort are
+    kept in their own list, so a request no rule applies to only costs a few dict lookups.
+    Rules which can't be compiled, such as a blocking rule without a valid status, are logged and left out.
+    """
+    def __init__(self, rules, config_body, wsgi_statuses):
+        self.rules = rules
+        self.config_body = config_body
+        self.regex_rules = []
+        self.user_rules = {}
+        self.company_rules = {}
+        self.unidentified_user_rules = []
+        self.unidentified_company_rules = []
+        self.rejected_rules = []
+        for rule in (rules or []):
+            try:
+                compiled = GovernanceRule(rule, wsgi_statuses)
+            except Exception as e:
+                # An invalid rule is skipped, the other rules still apply
+                rule_id = rule.get('_id') if isinstance(rule, dict) else None
+                logger.warning(f"Skipping governance rule {rule_id} which could not be compiled: {str(e)}")
+                self.rejected_rules.append(rule_id)
+                continue
+            if compiled.type == 'regex':
+                self.regex_rules.append(compiled)
+            elif compiled.type == 'user':
+                self.user_rules[compiled.id] = compiled
+                if compiled.applied_to_unidentified:
+                    self.unidentified_user_rules.append(compiled)
+            elif compiled.type == 'company':
+                self.company_rules[compiled.id] = compiled
+                if compiled.applied_to_unidentified:
+                    self.unidentified_company_rules.append(compiled)
+        self.not_matching_user_rules = [r for r in self.user_rules.values() if r.applied_to == 'not_matching']
+        self.not_matching_company_rules = [r for r in self.company_rules.values() if r.applied_to == 'not_matching']
+        self.user_cohorts = (config_body or {}).get('user_rules') or {}
+        self.company_cohorts = (config_body or {}).get('company_rules') or {}
+
+        all_rules = self.regex_rules + list(self.user_rules.values()) + list(self.company_rules.values())
+        # The request body is only parsed and the headers only lowercased when a condition needs them
+        self.needs_request_body = any(rule.uses('body') for rule in all_rules)
+        self.needs_request_headers = any(rule.uses('headers') for rule in all_rules)
+
+    @classmethod
+    def _cohort_rules(cls, rules_by_id, not_matching_rules, cohort_values, applicable, *request):
+        in_cohort = set()
+        if cohort_values:
+            for entry in cohort_values:
+                rule_id = entry['rules']
+                in_cohort.add(rule_id)
+                rule = rules_by_id.get(rule_id)
+                if rule is None or not rule.matches(*request) or rule.applied_to == 'not_matching':
+                    break
+                applicable.append((rule, entry.get('values')))
+        for rule in not_matching_rules:
+            if rule.id not in in_cohort and rule.matches(*request):
+                applicable.append((rule, None))
+
+    def govern(self, request_fields, request_body, request_headers, get_user_id, get_company_id):
+        """
+        Find the rules applying to the request, in the same order as the config manager applies them.
+        Returns None if no rule applies, otherwise the GovernedResponse of the rules.
+        """
+        request = (request_fields, request_body, request_headers)
+        applicable = [(rule, None) for rule in self.regex_rules if rule.matches(*request)]
+
+        if self.company_rules:
+            company_id = get_company_id()
+            if company_id is None:
+                applicable.extend((rule, None) for rule in self.unidentified_company_rules if rule.matches(*request))
+            else:
+                self._cohort_rules(self.company_rules, self.not_matching_company_rules,
+                                   self.company_cohorts.get(company_id), applicable, *request)
+
+        if self.user_rules:
+            user_id = get_user_id()
+            if user_id is None:
+                applicable.extend((rule, None) for rule in self.unidentified_user_rules if rule.matches(*request))
+            else:
+                self._cohort_rules(self.user_rules, self.not_matching_user_rules,
+                                   self.user_cohorts.get(user_id), applicable, *request)
+
+        if not applicable:
+            return None
+
+        headers = {}
+        governed_response = GovernedResponse(headers)
+        for rule, merge_tag_values in applicable:
+            rule_headers, body = rule.response(merge_tag_values)
+            headers.update(rule_headers)
+            if rule.block:
+                governed_response.blocked_by = rule.id
+                governed_response.status_line = rule.status_line
+                governed_response.body = body
+        governed_response.headers = list(headers.items())
+        return governed_response
+
+
+class GovernanceHelper:
+
+    def __init__(self, wsgi_statuses):
+        self.wsgi_statuses = wsgi_statuses
+        self._rule_set = None
+
+    def get_rule_set(self, rules, config_body):
+        """The rule set compiled for the current rules and config, compiled again when either is replaced"""
+        rule_set = self._rule_set
+        if rule_set is None or rule_set.rules is not rules or rule_set.config_body is not config_body:
+            rule_set = GovernanceRuleSet(rules, config_body, self.wsgi_statuses)
+            self._rule_set = rule_set
+        return rule_set
@@ -5,36 +5,33 @@ try:
 except ImportError:
     from io import StringIO
 from moesifapi.parse_body import ParseBody
+from .request_body_tee import RequestBodyTee
+from .request_headers import RequestHeaders
 from io import BytesIO
+import collections
+import hashlib
 import json
 import base64
 import logging
+import threading
 
 logger = logging.getLogger(__name__)
 
+# Maximum number of Authorization header values kept with their decoded user id
+TOKEN_CACHE_SIZE = 1024
+
 class LoggerHelper:
 
+    # Decoded user ids by digest of the Authorization header value, least recently used first
+    _token_user_ids = collections.OrderedDict()
+    _token_cache_lock = threading.Lock()
+
     def __init__(self):
         self.parse_body = ParseBody()
-        self._parse_headers_special = {
-            'HTTP_CGI_AUTHORIZATION': 'Authorization',
-            'CONTENT_LENGTH': 'Content-Length',
-            'CONTENT_TYPE': 'Content-Type',
-        }
 
-    def parse_request_headers(self, environ):
-        try:
-            for cgi_var, value in environ.iteritems():
-                if cgi_var in self._parse_headers_special:
-                    yield self._parse_headers_special[cgi_var], value
-                elif cgi_var.startswith('HTTP_'):
-                    yield cgi_var[5:].title().replace('_', '-'), value
-        except AttributeError:
-            for cgi_var, value in environ.items():
-                if cgi_var in self._parse_headers_special:
-                    yield self._parse_headers_special[cgi_var], value
-                elif cgi_var.startswith('HTTP_'):
-                    yield cgi_var[5:].title().replace('_', '-'), value
+    @classmethod
+    def parse_request_headers(cls, environ):
+        return iter(RequestHeaders(environ))
 
     @classmethod
     def request_url(cls, environ):
@@ -46,12 +43,10 @@ class LoggerHelper:
             '?' + environ['QUERY_STRING'] if environ.get('QUERY_STRING') else '',
         )
 
-    def request_body(self, environ):
-        content_encoding = environ.get('HTTP_CONTENT_ENCODING')
+    @classmethod
+    def request_body(cls, environ):
         content_length = environ.get('CONTENT_LENGTH')
         body = None
-        encoded_body = None
-        transfer_encoding = None
         if content_length:
             if content_length == '-1':
                 # case where the content length is basically undetermined
@@ -63,15 +58,29 @@ class LoggerHelper:
 
             if isinstance(body, str):
                 environ['wsgi.input'] = StringIO(body) # reset request body for the nested app Python2
-                encoded_body, transfer_encoding = self.parse_body.parse_string_body(body, content_encoding, None)
-                environ['moesif.request_body'] = encoded_body
             else:
                 environ['wsgi.input'] = BytesIO(body) # reset request body for the nested app Python3
-                encoded_body, transfer_encoding = self.parse_body.parse_bytes_body(body, content_encoding, None)
-                environ['moesif.request_body'] = encoded_body
+            # The body is only parsed into environ['moesif.request_body'] when a callback may read it
+            environ['moesif.request_body_raw'] = body
         else:
             content_length = 0
-        return content_length, encoded_body, transfer_encoding
+        return content_length, body
+
+    @classmethod
+    def tee_request_body(cls, environ, max_body_size):
+        # Record the request body as the nested app reads it, rather than reading it upfront
+        request_body_tee = RequestBodyTee(environ['wsgi.input'], max_body_size)
+        environ['wsgi.input'] = request_body_tee
+        return request_body_tee
+
+    @classmethod
+    def captured_request_body(cls, environ, request_body_tee):
+        body = None
+        if request_body_tee.size:
+            body = request_body_tee.getvalue()
+            environ['moesif.request_body_raw'] = body
+        request_body_tee.discard()
+        return request_body_tee.size, body
 
     @classmethod
     def transform_token(cls, token):
@@ -87,14 +96,15 @@ class LoggerHelper:
     def split_token(cls, token):
         return token.split('.')
 
-    def parse_authorization_header(self, token, field, debug):
+    @classmethod
+    def parse_authorization_header(cls, token, field, debug):
         try:
             # Fix the padding issue before decoding
             token += '=' * (-len(token) % 4)
             # Decode the payload
             base64_decode = base64.b64decode(token)
             # Transform token to string to be compatible with Python 2 and 3
-            base64_decode = self.transform_token(base64_decode)
+            base64_decode = cls.transform_token(base64_decode)
             # Convert the payload to json
             json_decode = json.loads(base64_decode)
             # Convert keys to lowercase
@@ -108,77 +118,112 @@ class LoggerHelper:
                 logger.info(f"Error while parsing authorization header to fetch user id: {str(e)}")
         return None
 
-    def get_user_id(self, environ, settings, app, debug, response_headers=dict()):
+    @classmethod
+    def parse_user_id_from_token(cls, token, field, debug):
+        # Cached so hot API keys and long-lived JWTs are only decoded once. The cache is keyed on a digest
+        # of the header value, so the credentials themselves aren't kept in memory
+        key = (hashlib.blake2b(token.encode('utf-8'), digest_size=16).digest(), field)
+        with cls._token_cache_lock:
+            if key in cls._token_user_ids:
+                cls._token_user_ids.move_to_end(key)
+                return cls._token_user_ids[key]
+        username = cls.decode_user_id_from_token(token, field, debug)
+        with cls._token_cache_lock:
+            cls._token_user_ids[key] = username
+            if len(cls._token_user_ids) > TOKEN_CACHE_SIZE:
+                cls._token_user_ids.popitem(last=False)
+        return username
+
+    @classmethod
+    def decode_user_id_from_token(cls, token, field, debug):
+        username = None
+        # Check if token is of type Bearer
+        if 'Bearer' in token:
+            # Fetch the bearer token
+            token = cls.fetch_token(token, 'Bearer')
+            # Split the bearer token by dot(.)
+            split_token = cls.split_token(token)
+            # Check if payload is not None
+            if len(split_token) >= 3 and split_token[1]:
+                # Parse and set user Id
+                username = cls.parse_authorization_header(split_token[1], field, debug)
+        # Check if token is of type Basic
+        elif 'Basic' in token:
+            # Fetch the basic token
+            token = cls.fetch_token(token, 'Basic')
+            # Decode the token
+            decoded_token = base64.b64decode(token)
+            # Transform token to string to be compatible with Python 2 and 3
+            decoded_token = cls.transform_token(decoded_token)
+            # Fetch the username and set the user Id
+            username = decoded_token.split(':', 1)[0].strip()
+        # Check if token is of user-defined custom type
+        else:
+            # Split the token by dot(.)
+            split_token = cls.split_token(token)
+            # Check if payload is not None
+            if len(split_token) > 1 and split_token[1]:
+                # Parse and set user Id
+                username = cls.parse_authorization_header(split_token[1], field, debug)
+            else:
+                # Parse and set user Id
+                username = cls.parse_authorization_header(token, field, debug)
+        return username
+
+    @classmethod
+    def identify_user(cls, environ, settings, app, response_headers):
+        username = None
+        identify_user = settings.get("IDENTIFY_USER")
+        if identify_user is not None:
+            try:
+                username = identify_user(app, environ, response_headers)
+            except Exception as e:
+                logger.warning(f"Exception in identify_user function, please check your identify_user method: {str(e)}")
+        return username
+
+    @classmethod
+    def get_user_id_from_headers(cls, environ, settings, debug, request_headers=None):
         username = None
         try:
-            identify_user = settings.get("IDENTIFY_USER")
-            if identify_user is not None:
-                try:
-                    username = identify_user(app, environ, response_headers)
-                except Exception as e:
-                    logger.warning(f"Exception in identify_user function, please check your identify_user method: {str(e)}")
-            if not username:
-                # Parse request headers
-                request_headers = dict([(k.lower(), v) for k, v in self.parse_request_headers(environ)])
-                # Fetch the auth header name from the config
-                auth_header_names = settings.get('AUTHORIZATION_HEADER_NAME', 'authorization').lower()
-                # Split authorization header name by comma
-                auth_header_names = [x.strip() for x in auth_header_names.split(',')]
-                # Fetch the header name available in the request header
-                token = None
-                for auth_name in auth_header_names:
-                    # Check if the auth header name in request headers
-                    if auth_name in request_headers:
-                        # Fetch the token from the request headers
-                        token = request_headers[auth_name]
-                        # Split the token by comma
-                        token = [x.strip() for x in token.split(',')]
-                        # Fetch the first available header
-                        if len(token) >= 1:
-                            token = token[0]
-                        else:
-                            token = None
-                        break
-                # Fetch the field from the config
-                field = settings.get('AUTHORIZATION_USER_ID_FIELD', 'sub').lower()
-                # Check if token is not None
-                if token:
-                    # Check if token is of type Bearer
-                    if 'Bearer' in token:
-                        # Fetch the bearer token
-                        token = self.fetch_token(token, 'Bearer')
-                        # Split the bearer token by dot(.)
-                        split_token = self.split_token(token)
-                        # Check if payload is not None
-                        if len(split_token) >= 3 and split_token[1]:
-                            # Parse and set user Id
-                            username = self.parse_authorization_header(split_token[1], field, debug)
-                    # Check if token is of type Basic
-                    elif 'Basic' in token:
-                        # Fetch the basic token
-                        token = self.fetch_token(token, 'Basic')
-                        # Decode the token
-                        decoded_token = base64.b64decode(token)
-                        # Transform token to string to be compatible with Python 2 and 3
-                        decoded_token = self.transform_token(decoded_token)
-                        # Fetch the username and set the user Id
-                        username = decoded_token.split(':', 1)[0].strip()
-                    # Check if token is of user-defined custom type
+            # Lowercase view of the request headers
+            if request_headers is None:
+                request_headers = RequestHeaders(environ)
+            request_headers = request_headers.lower()
+            # Fetch the auth header name from the config
+            auth_header_names = settings.get('AUTHORIZATION_HEADER_NAME', 'authorization').lower()
+            # Split authorization header name by comma
+            auth_header_names = [x.strip() for x in auth_header_names.split(',')]
+            # Fetch the header name available in the request header
+            token = None
+            for auth_name in auth_header_names:
+                # Check if the auth header name in request headers
+                if auth_name in request_headers:
+                    # Fetch the token from the request headers
+                    token = request_headers[auth_name]
+                    # Split the token by comma
+                    token = [x.strip() for x in token.split(',')]
+                    # Fetch the first available header
+                    if len(token) >= 1:
+                        token = token[0]
                     else:
-                        # Split the token by dot(.)
-                        split_token = self.split_token(token)
-                        # Check if payload is not None
-                        if len(split_token) > 1 and split_token[1]:
-                            # Parse and set user Id
-                            username = self.parse_authorization_header(split_token[1], field, debug)
-                        else:
-                            # Parse and set user Id
-                            username = self.parse_authorization_header(token, field, debug)
+                        token = None
+                    break
+            # Fetch the field from the config
+            field = settings.get('AUTHORIZATION_USER_ID_FIELD', 'sub').lower()
+            # Check if token is not None
+            if token:
+                username = cls.parse_user_id_from_token(token, field, debug)
         except Exception as e:
             if debug:
                 logger.info(f"can not execute identify_user function, please check moesif settings: {str(e)}")
         return username
 
+    def get_user_id(self, environ, settings, app, debug, response_headers=dict()):
+        username = self.identify_user(environ, settings, app, response_headers)
+        if not username:
+            username = self.get_user_id_from_headers(environ, settings, debug)
+        return username
+
     @classmethod
     def get_company_id(cls, environ, settings, app, debug, response_headers=dict()):
         company_id = None
@@ -0,0 +1,225 @@
+import threading
+import time
+
+from moesifapi.app_config.app_config import AppConfig
+
+# Upper bounds of the histogram buckets
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BATCH_EVENTS_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000)
+BATCH_BYTES_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 10485760)
+# Number of thread shards above which the shards of threads which exited are merged
+SHARD_MERGE_THRESHOLD = 64
+
+
+class Counter(object):
+    """Count of events, optionally split by the value of a single label"""
+    kind = 'counter'
+
+    def __init__(self, registry, name, help, label=None):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.label = label
+
+    def inc(self, value=1, label_value=None):
+        values = self.registry.shard()
+        key = (self.name, label_value)
+        values[key] = values.get(key, 0) + value
+
+    def value(self, label_value=None):
+        return self.registry.collect().get((self.name, label_value), 0)
+
+
+class Histogram(object):
+    """Distribution of observed values in buckets with the given upper bounds"""
+    kind = 'histogram'
+
+    def __init__(self, registry, name, help, buckets):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+
+    def observe(self, value):
+        values = self.registry.shard()
+        key = (self.name, None)
+        counts = values.get(key)
+        if counts is None:
+            # Count per bucket, then the count and the sum of all observations
+            counts = values[key] = [0] * (len(self.buckets) + 2)
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[index] += 1
+                break
+        counts[-2] += 1
+        counts[-1] += value
+
+
+class Gauge(object):
+    """Current value read when the metrics are collected"""
+    kind = 'gauge'
+
+    def __init__(self, name, help, read):
+        self.name = name
+        self.help = help
+        self.read = read
+
+
+class MetricsRegistry(object):
+    """
+    Counters and histograms of the event pipeline, cheap enough to update from the request threads.
+    Each thread updates its own shard of the values without a lock, and the shards are only summed
+    when the metrics are read. The shards of threads which exited are merged once there are more than
+    SHARD_MERGE_THRESHOLD, so servers starting a thread per request don't accumulate them.
+    Gauges are read when the metrics are read.
+    """
+    def __init__(self):
+        self._metrics = {}
+        self.reset()
+
+    def reset(self):
+        """Forget the values, such as the values inherited from the parent process in a forked child"""
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # The thread and values of each shard
+        self._shards = []
+        # Values of the threads which exited
+        self._merged = {}
+        self._merge_at = SHARD_MERGE_THRESHOLD
+
+    def counter(self, name, help, label=None):
+        return self._register(name, lambda: Counter(self, name, help, label))
+
+    def histogram(self, name, help, buckets):
+        return self._register(name, lambda: Histogram(self, name, help, buckets))
+
+    def gauge(self, name, help, read):
+        # Replaced when registered again, such as by the worker pool started again in a forked child
+        self._metrics[name] = Gauge(name, help, read)
+
+    def _register(self, name, create):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = create()
+        return metric
+
+    def shard(self):
+        """The values of the current thread"""
+        try:
+            return self._local.values
+        except AttributeError:
+            pass
+        values = self._local.values = {}
+        with self._lock:
+            self._shards.append((threading.current_thread(), values))
+            if len(self._shards) > self._merge_at:
+                self._merge_exited()
+                self._merge_at = max(SHARD_MERGE_THRESHOLD, 2 * len(self._shards))
+        return values
+
+    def _merge_exited(self):
+        shards = []
+        for thread, values in self._shards:
+            if thread.is_alive():
+                shards.append((thread, values))
+            else:
+                self._add(self._merged, values)
+        self._shards = shards
+
+    @classmethod
+    def _add(cls, totals, values):
+        for key, value in values.items():
+            if isinstance(value, list):
+                total = totals.get(key)
+                totals[key] = list(value) if total is None else [a + b for a, b in zip(total, value)]
+            else:
+                totals[key] = totals.get(key, 0) + value
+
+    def collect(self):
+        """The values of the counters and histograms summed over the threads"""
+        with self._lock:
+            self._merge_exited()
+            totals = {}
+            self._add(totals, self._merged)
+            for _, values in self._shards:
+                # Copied at once, as the thread of the shard may be adding values
+                self._add(totals, values.copy())
+        return totals
+
+    def get_stats(self):
+        """The counters and histograms by name, split by label value where they have a label"""
+        totals = self.collect()
+        stats = {}
+        for metric in list(self._metrics.values()):
+            if metric.kind == 'counter':
+                if metric.label is None:
+                    stats[metric.name] = totals.get((metric.name, None), 0)
+                else:
+                    stats[metric.name] = {label_value: value for (name, label_value), value in totals.items()
+                                          if name == metric.name}
+            elif metric.kind == 'histogram':
+                counts = totals.get((metric.name, None)) or [0] * (len(metric.buckets) + 2)
+                stats[metric.name] = {
+                    "count": counts[-2],
+                    "sum": counts[-1],
+                    "buckets": dict(zip(metric.buckets, counts[:-2])),
+                }
+        return stats
+
+    def render_prometheus(self, prefix='moesif'):
+        """The metrics in the Prometheus text exposition format"""
+        totals = self.collect()
+        lines = []
+        for metric in list(self._metrics.values()):
+            name = f"{prefix}_{metric.name}"
+            if metric.kind == 'counter':
+                name += '_total'
+            lines.append(f"# HELP {name} {metric.help}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            if metric.kind == 'counter':
+                if metric.label is None:
+                    lines.append(f"{name} {totals.get((metric.name, None), 0)}")
+                    continue
+                for (metric_name, label_value), value in sorted(totals.items(), key=lambda item: str(item[0][1])):
+                    if metric_name == metric.name:
+                        lines.append(f'{name}{{{metric.label}="{_escape(label_value)}"}} {value}')
+            elif metric.kind == 'histogram':
+                counts = totals.get((metric.name, None)) or [0] * (len(metric.buckets) + 2)
+                cumulative = 0
+                for bound, count in zip(metric.buckets, counts[:-2]):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{le="+Inf"}} {counts[-2]}')
+                lines.append(f"{name}_sum {counts[-1]}")
+                lines.append(f"{name}_count {counts[-2]}")
+            else:
+                try:
+                    value = metric.read()
+                except Exception:
+                    value = None
+                lines.append(f"{name} {'NaN' if value is None else float(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape(label_value):
+    return str(label_value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class MeteredAppConfig(AppConfig):
+    """AppConfig timing the fetches of the config, by the config manager and the shared config alike"""
+    def __init__(self, metrics):
+        super().__init__()
+        self.fetch_seconds = metrics.histogram(
+            'config_fetch_seconds', "Time taken to fetch the config from Moesif", SECONDS_BUCKETS)
+        self.fetch_errors = metrics.counter('config_fetch_errors', "Config fetches which failed")
+
+    def get_config(self, api_client, debug):
+        start = time.monotonic()
+        config = None
+        try:
+            config = super().get_config(api_client, debug)
+            return config
+        finally:
+            self.fetch_seconds.observe(time.monotonic() - start)
+            if config is None:
+                self.fetch_errors.inc()
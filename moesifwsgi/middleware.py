@@ -1,11 +1,15 @@
 # -*- coding: utf-8 -*-
+import hmac
 import itertools
 import math
+import os
 import random
-from datetime import datetime
 import sys
+import threading
+import time
+import weakref
 
-from moesifapi.config_manager import ConfigUpdateManager
+from .config_manager import ForkSafeConfigUpdateManager
 from .workers import BatchedWorkerPool, ConfigJobScheduler
 
 try:
@@ -17,20 +21,35 @@ import atexit
 import logging
 
 from moesifapi.moesif_api_client import *
-from moesifapi.app_config.app_config import AppConfig
 from moesifpythonrequest.start_capture.start_capture import StartCapture
 from moesifapi.api_helper import *
 from .client_ip import ClientIp
+from .adaptive_sampler import AdaptiveSampler
+from .async_http_client import AsyncHttpClient
+from .collector import CollectorSender
 from .event_mapper import EventMapper
+from .event_sender import EventSender
+from .pooled_http_client import PooledHttpClient
+from .shared_config import SharedConfigUpdateManager
+from .spill_queue import SpillQueue
+from .governance_helper import GovernanceHelper
 from .http_response_catcher import HttpResponseCatcher
+from .metrics import MeteredAppConfig, MetricsRegistry
 from .logger_helper import LoggerHelper
 from .moesif_data_holder import DataHolder
+from .regex_config_helper import RegexConfigHelper
+from .request_headers import RequestHeaders
+from .request_identity import RequestIdentity
+from .streaming_response import StreamingResponse
 from moesifapi.parse_body import ParseBody
 from moesifapi.update_companies import Company
 from moesifapi.update_users import User
 
 logger = logging.getLogger(__name__)
 
+# Callbacks given the environ once the request body is read, which may read it from environ['moesif.request_body']
+REQUEST_BODY_CALLBACKS = ('IDENTIFY_USER', 'IDENTIFY_COMPANY', 'GET_METADATA', 'GET_SESSION_TOKEN')
+
 
 PY3 = sys.version_info > (3,)
 if PY3:
@@ -41,6 +60,19 @@ def ensure_bytestring(s):
     return s.encode('utf-8') if isinstance(s, unicode) else s
 
 
+# Middlewares of this process, reset in a forked child by a single fork hook which doesn't keep them alive
+_middlewares = weakref.WeakSet()
+
+
+def _after_fork_in_child():
+    for middleware in list(_middlewares):
+        middleware._after_fork_in_child()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
 class MoesifMiddleware(object):
     """WSGI Middleware for recording of request-response"""
 
@@ -55,11 +87,51 @@ class MoesifMiddleware(object):
         self.initialize_counter()
         self.initialize_client()
         self.initialize_config()
-        self.initialize_worker_pool()
+
+        # The worker pool and config scheduler run threads, which don't survive a fork. They are started
+        # on the first request of each process, so apps preloaded by a pre-fork server start quickly and
+        # their workers each get their own threads.
+        self.worker_pool = None
+        self.event_sender = None
+        self.adaptive_sampler = None
+        self.config_job_scheduler = None
+        self._started_pid = None
+        self._start_lock = threading.Lock()
+        _middlewares.add(self)
 
         # graceful shutdown handlers
         atexit.register(self._shutdown)
 
+    def ensure_started(self):
+        """Start the background threads if they were not started in this process yet"""
+        if self._started_pid != os.getpid():
+            with self._start_lock:
+                if self._started_pid != os.getpid():
+                    self.start()
+                    self._started_pid = os.getpid()
+
+    def start(self):
+        if self.DEBUG:
+            logger.debug(f"Starting Moesif background threads for pid - {self.logger_helper.get_worker_pid()}")
+        self.schedule_config_job()
+        self.initialize_worker_pool()
+
+    def _after_fork_in_child(self):
+        """
+        Forget the threads, queues and locks inherited from the parent process. Its threads don't exist in
+        the child and its locks may have been held during the fork, so they are created again on the next request.
+        The configuration fetched by the parent is kept, with a new update thread and lock.
+        """
+        self._start_lock = threading.Lock()
+        self._started_pid = None
+        self.config.after_fork_in_child()
+        self.worker_pool = None
+        self.event_sender = None
+        self.adaptive_sampler = None
+        self.config_job_scheduler = None
+        self.is_config_job_scheduled = False
+        self.metrics.reset()
+
     def initialize_logger(self):
         """Initialize logger mirroring the debug and stdout behavior of previous print statements for compatibility"""
         logging.basicConfig(
@@ -70,6 +142,9 @@ class MoesifMiddleware(object):
 
     def _shutdown(self):
         """Graceful shutdown: stop scheduler first, then worker pool."""
+        if self._started_pid != os.getpid():
+            # Nothing was started by this process
+            return
         try:
             if getattr(self, 'config_job_scheduler', None):
                 self.config_job_scheduler.exit_config_job()
@@ -79,6 +154,8 @@ class MoesifMiddleware(object):
         try:
             if getattr(self, 'worker_pool', None):
                 self.worker_pool.stop()
+            if getattr(self, 'event_sender', None):
+                self.event_sender.close()
         except Exception as ex:
             if self.DEBUG:
                 logger.info(f'Error shutting down worker pool: {str(ex)}')
@@ -92,7 +169,14 @@ class MoesifMiddleware(object):
             self.request_counter = itertools.count().next  # Threadsafe counter for Python 2
         except AttributeError:
             self.request_counter = itertools.count().__next__  # Threadsafe counter for Python 3
-        self.dropped_events = 0
+        # Counters of the event pipeline, updated without locks from the request threads
+        self.metrics = MetricsRegistry()
+        self.enqueued_counter = self.metrics.counter('enqueued_events', "Events added to the event queue")
+        self.dropped_counter = self.metrics.counter('dropped_events', "Events dropped as the event queue was full")
+        self.sampled_out_counter = self.metrics.counter('sampled_out_events', "Events not recorded due to sampling",
+                                                        label='reason')
+        self.metrics_path = self.settings.get("METRICS_PATH")
+        self.metrics_token = self.settings.get("METRICS_TOKEN")
         self.parse_body = ParseBody()
         self.event_mapper = EventMapper()
         self.logger_helper = LoggerHelper()
@@ -126,37 +210,165 @@ class MoesifMiddleware(object):
             StartCapture().start_capture_outgoing(self.settings)
 
         self.LOG_BODY = self.settings.get("LOG_BODY", True)
-        self.client_ip = ClientIp()
-        self.app_config = AppConfig()
-        self.config = ConfigUpdateManager(self.api_client, self.app_config, self.DEBUG)
-        self.schedule_config_job()
+        self.RESPONSE_MAX_BODY_SIZE = self.settings.get("RESPONSE_MAX_BODY_SIZE", 100000)
+        self.LAZY_REQUEST_BODY_CAPTURE = self.settings.get("LAZY_REQUEST_BODY_CAPTURE", False)
+        self.REQUEST_MAX_BODY_SIZE = self.settings.get("REQUEST_MAX_BODY_SIZE", 100000)
+        self.request_body_callbacks = any(self.settings.get(name) for name in REQUEST_BODY_CALLBACKS)
+        self.client_ip = ClientIp(self.settings.get("CLIENT_IP_HEADERS"), self.settings.get("TRUSTED_PROXIES"))
+        self.regex_config_helper = RegexConfigHelper()
+        self.governance_helper = GovernanceHelper(self.wsgi_statuses)
+        self.app_config = MeteredAppConfig(self.metrics)
+        # Fetches the configuration in the background
+        if self.settings.get("SHARED_CONFIG_PATH"):
+            # Fetched by one process of the host and shared with the others
+            self.config = SharedConfigUpdateManager(self.api_client, self.app_config, self.DEBUG,
+                                                    self.settings.get("SHARED_CONFIG_PATH"))
+        else:
+            self.config = ForkSafeConfigUpdateManager(self.api_client, self.app_config, self.DEBUG)
 
     def initialize_worker_pool(self):
         # Create queues and threads which will batch and send events in the background
+        collector_socket = self.settings.get("COLLECTOR_SOCKET")
+        # With a collector, a single worker is enough to forward the events
+        worker_count = self.settings.get("EVENT_WORKER_COUNT", 1 if collector_socket else 2)
+        # Scaled between the two as needed when set above EVENT_WORKER_COUNT
+        max_worker_count = self.settings.get("EVENT_WORKER_MAX_COUNT", worker_count)
+        http_client = None
+        if self.settings.get("POOLED_CONNECTIONS", False):
+            # One kept alive connection per worker thread, opened ahead of the first batch
+            http_client = PooledHttpClient(max(worker_count, max_worker_count), self.settings.get("CONNECTION_TIMEOUT", 30),
+                                           self.settings.get("DNS_CACHE_TTL", 60))
+            http_client.warm_up(Configuration.BASE_URI)
+        spill_queue = None
+        if self.settings.get("SPILL_DIRECTORY"):
+            # Events which don't fit in the event queue are written to disk instead of being dropped
+            spill_queue = SpillQueue(self.settings.get("SPILL_DIRECTORY"),
+                                     self.settings.get("SPILL_MAX_BYTES", 268435456),
+                                     self.settings.get("SPILL_SEGMENT_SIZE", 16777216),
+                                     self.settings.get("SPILL_MAX_SEND_ATTEMPTS", 5))
+        sender_options = dict(
+            compression=self.settings.get("BATCH_COMPRESSION", True),
+            compression_level=self.settings.get("BATCH_COMPRESSION_LEVEL", 9),
+            compression_min_size=self.settings.get("BATCH_COMPRESSION_MIN_SIZE", 1024),
+            stream_uploads=self.settings.get("STREAM_BATCH_UPLOADS", False),
+            stream_chunk_size=self.settings.get("STREAM_CHUNK_SIZE", 65536),
+            http_client=http_client,
+            max_retries=self.settings.get("RETRY_MAX_ATTEMPTS", 3),
+            max_retry_time=self.settings.get("RETRY_MAX_ELAPSED", 60),
+            circuit_breaker_threshold=self.settings.get("CIRCUIT_BREAKER_THRESHOLD", 5),
+            circuit_breaker_reset_timeout=self.settings.get("CIRCUIT_BREAKER_RESET_TIMEOUT", 30),
+            timeout=self.settings.get("CONNECTION_TIMEOUT", 30),
+        )
+        if collector_socket:
+            # Events are sent by the collector of the host, and in process when it's unavailable
+            self.event_sender = CollectorSender(collector_socket, self.api_client, **sender_options)
+        else:
+            self.event_sender = EventSender(self.api_client, **sender_options)
+        async_http_client = None
+        if self.settings.get("ASYNC_SHIPPER", False) and not collector_socket:
+            # A single event loop thread keeps several batches in flight instead of the worker threads
+            async_http_client = AsyncHttpClient(self.settings.get("CONNECTION_TIMEOUT", 30),
+                                                self.settings.get("DNS_CACHE_TTL", 60))
+        if self.settings.get("ADAPTIVE_SAMPLING", False):
+            # Events are sampled as the event queue fills instead of being dropped once it's full
+            self.adaptive_sampler = AdaptiveSampler(self.settings.get("ADAPTIVE_SAMPLING_LOW_WATERMARK", 0.5),
+                                                    self.settings.get("ADAPTIVE_SAMPLING_HIGH_WATERMARK", 0.9),
+                                                    self.settings.get("ADAPTIVE_SAMPLING_MIN_RATE", 0.01))
+            self.metrics.gauge('adaptive_sampling_rate', "Share of the events kept by adaptive sampling",
+                               lambda: self.adaptive_sampler.rate)
         self.worker_pool = BatchedWorkerPool(
-            worker_count=self.settings.get("EVENT_WORKER_COUNT", 2),
-            api_client=self.api_client,
+            worker_count=worker_count,
+            event_sender=self.event_sender,
             config=self.config,
             debug=self.DEBUG,
             max_queue_size=self.settings.get("EVENT_QUEUE_SIZE", 1000000),
             batch_size=self.settings.get("BATCH_SIZE", 100),
             timeout=self.settings.get("EVENT_BATCH_TIMEOUT", 2),
+            build_event=self.process_data,
+            max_batch_bytes=self.settings.get("MAX_BATCH_BYTES", 10485760),
+            spill_queue=spill_queue,
+            async_http_client=async_http_client,
+            async_concurrency=self.settings.get("ASYNC_SHIPPER_CONCURRENCY", 8),
+            metrics=self.metrics,
+            max_worker_count=max_worker_count,
+            scale_down_delay=self.settings.get("EVENT_WORKER_SCALE_DOWN_DELAY", 30),
         )
 
+    def get_stats(self):
+        """Counters of the event pipeline, such as dropped events and the compression of the batches sent"""
+        stats = self.worker_pool.get_stats() if self.worker_pool is not None else {}
+        if hasattr(self.config, 'get_stats'):
+            stats.update(self.config.get_stats())
+        if self.adaptive_sampler is not None:
+            stats.update(self.adaptive_sampler.get_stats())
+        stats.update(self.metrics.get_stats())
+        return stats
+
+    @property
+    def dropped_events(self):
+        """Number of events dropped because the event queue was full"""
+        return self.dropped_counter.value()
+
+    def metrics_allowed(self, environ):
+        """
+        Whether a request may read the metrics. With METRICS_TOKEN, it must send the token as a bearer token.
+        Otherwise the client must be the host itself or a trusted proxy.
+        """
+        if self.metrics_token:
+            expected = f"Bearer {self.metrics_token}".encode('utf-8')
+            return hmac.compare_digest(environ.get('HTTP_AUTHORIZATION', '').encode('utf-8'), expected)
+        if self.client_ip.trusted_networks:
+            # The forwarding headers are only honoured when set by a trusted proxy
+            address = self.client_ip.get_client_address(environ)
+        elif self.client_ip.is_forwarded(environ):
+            # Forwarded by a proxy, possibly on the same host, for a client which can't be told apart
+            return False
+        else:
+            address = environ.get('REMOTE_ADDR')
+        return self.client_ip.is_local_or_trusted(address)
+
+    def serve_metrics(self, environ, start_response):
+        """Respond with the metrics of the event pipeline in the Prometheus text format"""
+        if not self.metrics_allowed(environ):
+            start_response('403 Forbidden', [('Content-Length', '0')])
+            return [b'']
+        if environ.get('REQUEST_METHOD') not in ('GET', 'HEAD'):
+            start_response('405 Method Not Allowed', [('Allow', 'GET, HEAD'), ('Content-Length', '0')])
+            return [b'']
+        body = self.metrics.render_prometheus().encode('utf-8')
+        start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'),
+                                  ('Content-Length', str(len(body)))])
+        return [body if environ.get('REQUEST_METHOD') == 'GET' else b'']
+
     def __call__(self, environ, start_response):
-        request_time = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3]
-        logger.debug(f"event request time: {request_time}")
+        self.ensure_started()
+
+        if self.metrics_path is not None and environ.get('PATH_INFO') == self.metrics_path:
+            # Served by the middleware instead of the app, and not recorded as an event
+            return self.serve_metrics(environ, start_response)
+
+        # Decide SKIP and sampling before anything is captured, dropped requests pass through untouched
+        request_headers = RequestHeaders(environ)
+        identity = RequestIdentity(self.logger_helper, environ, request_headers, self.settings, self.app, self.DEBUG)
+        record_event, event_sampling_percentage = self.sample_request(environ, identity)
+        if not record_event and not self.config.have_governance_rules():
+            return self.app(environ, start_response)
+
+        # Only raw clock values are captured here, the background workers format the timestamps
+        request_time_ns = time.time_ns()
+        request_start_ns = time.monotonic_ns()
 
-        event_info = self.prepare_event_info(environ, start_response, request_time)
+        event_info = self.prepare_event_info(environ, start_response, request_time_ns, request_start_ns, request_headers)
+        self.set_parsed_request_body(environ, event_info, request_headers)
         response_headers_mapping = {}
 
-        governed_response = {}
+        request_body_tee = None
+        if self.LAZY_REQUEST_BODY_CAPTURE:
+            request_body_tee = self.logger_helper.tee_request_body(environ, self.REQUEST_MAX_BODY_SIZE)
+
+        governed_response = None
         if self.config.have_governance_rules():
-            # we must fire these hooks early.
-            request_user_id = self.logger_helper.get_user_id(environ, self.settings, self.app, self.DEBUG)
-            request_company_id = self.logger_helper.get_company_id(environ, self.settings, self.app, self.DEBUG)
-            request_headers = dict(self.logger_helper.parse_request_headers(environ))
-            governed_response = self.config.govern_request(event_info, request_user_id, request_company_id, event_info.request_body, request_headers)
+            governed_response = self.govern_request(event_info, identity, request_headers)
 
         # monkey patch the default start_response to capture data and add headers
         def _start_response(status, response_headers, *args):
@@ -169,9 +381,8 @@ class MoesifMiddleware(object):
                 final_headers = []
 
             # always insert in the headers from governance rules regardless of blocking or not.
-            if 'headers' in governed_response:
-                governance_headers_as_tuple_list = [(k, v) for k, v in governed_response['headers'].items()]
-                final_headers = list(set(final_headers + governance_headers_as_tuple_list))
+            if governed_response is not None and governed_response.headers:
+                final_headers = final_headers + [pair for pair in governed_response.headers if pair not in final_headers]
 
             try:
                 for pair in final_headers:
@@ -181,111 +392,222 @@ class MoesifMiddleware(object):
             return start_response(status, final_headers, *args)
 
         blocked_by = None
-        original_response = None
-        response_chunks = None
 
-        if 'blocked_by' in governed_response:
+        if governed_response is not None and governed_response.blocked_by is not None:
           # start response immediately, skip next step
-          headers_as_tuple_list = [(k, v) for k, v in governed_response['headers'].items()]
-          _start_response(self.wsgi_statuses[governed_response['status']], headers_as_tuple_list)
-          response_chunks = event_info.finish_response(governed_response['body'])
-          blocked_by = governed_response['blocked_by']
+          _start_response(governed_response.status_line, [])
+          response = [governed_response.body]
+          blocked_by = governed_response.blocked_by
         else:
           # trigger next step in the process
-          original_response = self.app(environ, _start_response);
-          response_chunks = event_info.finish_response(original_response)
+          response = self.app(environ, _start_response)
 
-        # Add response chunks and response headers to the environ
-        environ["moesif.response_body_chunks"] = response_chunks
-        environ["moesif.response_headers"] = response_headers_mapping
+        def _on_finish():
+            if not record_event:
+                # Only captured for the governance rules
+                return
 
-        try:
-            logger.debug(f"event response time: {event_info.response_time}")
-        except Exception as e:
-            logger.exception(f"Error while fetching response time: {str(e)}")
+            if request_body_tee is not None:
+                event_info.set_request_body(*self.logger_helper.captured_request_body(environ, request_body_tee))
+                self.set_parsed_request_body(environ, event_info, request_headers)
 
-        self.add_user_and_metadata(event_info, environ, response_headers_mapping)
+            # Add captured response body and response headers to the environ
+            environ["moesif.response_body_chunks"] = [bytes(event_info.response_body)]
+            environ["moesif.response_headers"] = response_headers_mapping
 
+            if self.DEBUG:
+                logger.debug(f"event duration: {event_info.duration_ns / 1000000.0} ms")
+
+            self.add_user_and_metadata(event_info, environ, response_headers_mapping, identity)
+            self.process_and_add_event_if_required(event_info, environ, response_headers_mapping, blocked_by, event_sampling_percentage)
+
+        # Stream the response through to the server, the event is built once the response is finished
+        return StreamingResponse(response, event_info, _on_finish)
+
+    def set_parsed_request_body(self, environ, event_info, request_headers):
+        """
+        Set the parsed request body in environ['moesif.request_body'] for the callbacks. It's only parsed on the
+        request thread when a callback may read it, and the event reuses it.
+        """
+        if self.request_body_callbacks and event_info.request_body:
+            environ['moesif.request_body'], _ = self.event_mapper.parse_request_body(event_info,
+                                                                                   request_headers.as_dict())
+
+    def govern_request(self, event_info, identity, request_headers):
+        """
+        Apply the governance rules compiled for the current config. The request body, headers and identity
+        are only resolved when the rules need them. Returns None if no rule applies to the request.
+        """
         try:
-            return self.wrap_response(response_chunks, original_response)
-        finally:
-            self.process_and_add_event_if_required(event_info, environ, response_headers_mapping, blocked_by)
-
-    def wrap_response(self, response_chunks, original_response):
-        class WrappedResponse:
-            def __init__(self, chunks, original):
-                self.chunks = chunks
-                self.original = original
-
-            def __iter__(self):
-                return iter(self.chunks)
-
-            def close(self):
-                if hasattr(self.original, 'close'):
-                    self.original.close()
-
-            def __getattr__(self, name):
-                # Delegate attribute access to the original response
-                return getattr(self.original, name)
+            rule_set = self.governance_helper.get_rule_set(self.config.govern_manager.rules, self.config.config_parsed_body)
+            request_body = None
+            if rule_set.needs_request_body:
+                request_body, _ = self.event_mapper.parse_request_body(event_info, request_headers.as_dict())
+            request_fields = {
+                'request.verb': event_info.method,
+                'request.ip': event_info.ip_address,
+                'request.route': event_info.url,
+            }
+            return rule_set.govern(request_fields, request_body,
+                                   request_headers.lower() if rule_set.needs_request_headers else None,
+                                   identity.get_user_id, identity.get_company_id)
+        except Exception as e:
+            logger.warning(f"Error while applying the governance rules: {str(e)}")
+            return None
 
-        return WrappedResponse(response_chunks, original_response)
+    def prepare_event_info(self, environ, start_response, request_time_ns, request_start_ns, request_headers):
+        if self.LAZY_REQUEST_BODY_CAPTURE:
+            # The request body is recorded while the app reads it and added to the event once the response has finished
+            request_body = (0, None)
+        else:
+            request_body = self.logger_helper.request_body(environ)
 
-    def prepare_event_info(self, environ, start_response, request_time):
         event_info = DataHolder(
             self.settings.get("DISABLED_TRANSACTION_ID", False),
             self.request_counter(),
             environ["REQUEST_METHOD"],
             self.logger_helper.request_url(environ),
             self.client_ip.get_client_address(environ),
-            [(k, v) for k, v in self.logger_helper.parse_request_headers(environ)],
-            *self.logger_helper.request_body(environ),
-            request_time,
+            request_headers,
+            *request_body,
+            request_time_ns,
+            request_start_ns,
+            self.RESPONSE_MAX_BODY_SIZE,
         )
         return event_info
 
-    def add_user_and_metadata(self, event_info, environ, response_headers_mapping):
-        event_info.set_user_id(self.logger_helper.get_user_id(environ, self.settings, self.app, self.DEBUG, response_headers_mapping))
-        event_info.set_company_id(self.logger_helper.get_company_id(environ, self.settings, self.app, self.DEBUG, response_headers_mapping))
+    def add_user_and_metadata(self, event_info, environ, response_headers_mapping, identity):
+        event_info.set_user_id(identity.get_user_id(response_headers_mapping))
+        event_info.set_company_id(identity.get_company_id(response_headers_mapping))
         event_info.set_metadata(self.logger_helper.get_metadata(environ, self.settings, self.app, self.DEBUG))
         event_info.set_session_token(self.logger_helper.get_session_token(environ, self.settings, self.app, self.DEBUG))
 
-    def process_and_add_event_if_required(self, event_info, environ, response_headers_mapping, blocked_by):
-        if event_info is None:
-            logger.debug("Skipped Event as the moesif event model is None")
-            return
+    def sample_request(self, environ, identity):
+        """
+        Decide whether the event is recorded using only the request, before the app runs.
+        Returns whether to record the event, and the sampling percentage if it could be resolved without the response.
+        """
         if self.logger_helper.should_skip(environ, self.settings, self.app, self.DEBUG):
             logger.debug("Skipped Event using should_skip configuration option")
-            return
+            return False, None
+
+        event_sampling_percentage = self.get_request_sampling_percentage(environ, identity)
+        if event_sampling_percentage is not None and self.is_sampled_out(event_sampling_percentage):
+            self.sampled_out_counter.inc(label_value='config')
+            return False, event_sampling_percentage
+        return True, event_sampling_percentage
+
+    def get_request_sampling_percentage(self, environ, identity):
+        """
+        Resolve the sampling percentage from the request alone, following the same precedence as the config.
+        Returns None if it depends on the response, such as a rule on response.status or a user only identified from the response.
+        """
+        return self.get_sampling_percentage(
+            lambda: self.regex_config_helper.prepare_fields_config_mapping(
+                environ.get("REQUEST_METHOD"),
+                self.logger_helper.request_url(environ),
+                self.client_ip.get_client_address(environ)
+            ),
+            identity.get_user_id,
+            identity.get_company_id,
+            request_only=True
+        )
 
-        # Prepare event to be sent to Moesif and check the config for applicable sampling rules
-        event_data = self.process_data(event_info, blocked_by)
-        event_sampling_percentage = self.config.get_sampling_percentage(
-            event_data,
-            self.logger_helper.get_user_id(environ, self.settings, self.app, self.DEBUG, response_headers_mapping),
-            self.logger_helper.get_company_id(environ, self.settings, self.app, self.DEBUG, response_headers_mapping)
+    def get_event_sampling_percentage(self, event_info):
+        """Resolve the sampling percentage once the response has finished"""
+        return self.get_sampling_percentage(
+            lambda: self.regex_config_helper.prepare_fields_config_mapping(
+                event_info.method,
+                event_info.url,
+                event_info.ip_address,
+                self.event_mapper.response_status(event_info)
+            ),
+            lambda: event_info.user_id,
+            lambda: event_info.company_id
         )
 
+    def get_sampling_percentage(self, get_config_mapping, get_user_id, get_company_id, request_only=False):
+        """
+        Resolve the sampling percentage: the first matching regex rule, then the user, company and default sample rate.
+        The config mapping and ids are only resolved when the config has rules which need them. The regex rules are
+        evaluated with the index compiled for the current config.
+        With request_only, returns None if the percentage can't be resolved until the response has finished.
+        """
+        config_body = self.config.config_parsed_body
+        if config_body is None:
+            return 100
+        try:
+            regex_config = config_body.get('regex_config', None)
+            if regex_config:
+                decided, regex_sample_rate = self.regex_config_helper.get_index(regex_config).lookup(
+                    get_config_mapping(), request_only)
+                if not decided and request_only:
+                    # Resolved again once the response has finished
+                    return None
+                if regex_sample_rate is not None:
+                    return regex_sample_rate
+
+            user_sample_rate = config_body.get('user_sample_rate', None)
+            if user_sample_rate:
+                user_id = get_user_id()
+                if not user_id and request_only:
+                    return None
+                if user_id and user_id in user_sample_rate:
+                    return user_sample_rate[user_id]
+
+            company_sample_rate = config_body.get('company_sample_rate', None)
+            if company_sample_rate:
+                company_id = get_company_id()
+                if not company_id and request_only:
+                    return None
+                if company_id and company_id in company_sample_rate:
+                    return company_sample_rate[company_id]
+
+            return config_body.get('sample_rate', 100)
+        except Exception as e:
+            logger.warning(f"Error while resolving the sampling percentage: {str(e)}")
+            return None if request_only else 100
+
+    @classmethod
+    def is_sampled_out(cls, event_sampling_percentage):
         # if the event has a sample rate of less than 100, then we need to check if this event should be skipped and not sent to Moesif
         if event_sampling_percentage != 100:
             random_percentage = random.random() * 100
             if random_percentage >= event_sampling_percentage:
                 logger.debug(f"Skipped Event due to sampling percentage: {event_sampling_percentage} "
                              f"and random percentage: {random_percentage}")
+                return True
+        return False
+
+    def process_and_add_event_if_required(self, event_info, environ, response_headers_mapping, blocked_by, event_sampling_percentage=None):
+        if event_info is None:
+            logger.debug("Skipped Event as the moesif event model is None")
+            return
+
+        if event_sampling_percentage is None:
+            # Rules depending on the response are checked once the response has finished
+            event_sampling_percentage = self.get_event_sampling_percentage(event_info)
+            if self.is_sampled_out(event_sampling_percentage):
+                self.sampled_out_counter.inc(label_value='config')
                 return
 
         # Add proportionate weight to the event for sampling percentage lower than 100
-        event_data.weight = 1 if event_sampling_percentage == 0 else math.floor(100 / event_sampling_percentage)
+        event_info.weight = 1 if event_sampling_percentage == 0 else math.floor(100 / event_sampling_percentage)
+        if self.adaptive_sampler is not None:
+            event_info.weight = self.adaptive_sampler.sample(event_info.weight, self.worker_pool.occupancy())
+            if event_info.weight is None:
+                self.sampled_out_counter.inc(label_value='adaptive')
+                logger.debug("Skipped Event due to adaptive sampling of the event queue")
+                return
+        event_info.blocked_by = blocked_by
         try:
-            # Add Event to the queue if able and count the dropped event if at capacity
-            if self.worker_pool.add_event(event_data):
+            # Add the raw capture record to the queue if able and count the dropped event if at capacity
+            if self.worker_pool.add_event(event_info, event_info.estimate_size()):
+                self.enqueued_counter.inc()
                 logger.debug("Add Event to the queue")
-                if self.DEBUG:
-                    logger.debug(f"Event added to the queue: {APIHelper.json_serialize(event_data)}")
             else:
-                self.dropped_events += 1
-                logger.info(f"Dropped Event due to queue capacity drop_count: {str(self.dropped_events)}")
-                if self.DEBUG:
-                    logger.debug(f"Event dropped: {APIHelper.json_serialize(event_data)}")
+                self.dropped_counter.inc()
+                logger.info("Dropped Event due to queue capacity")
         # add_event does not throw exceptions so this is unexepected
         except Exception as ex:
             logger.exception(f"Error while adding event to the queue: {str(ex)}")
@@ -295,7 +617,8 @@ class MoesifMiddleware(object):
             self.schedule_config_job()
 
 
-    def process_data(self, data, blocked_by):
+    def process_data(self, data):
+        """Build the event model from a raw capture record. This is called by the background workers."""
         # Prepare Event Request Model
         event_req = self.event_mapper.to_request(data, self.LOG_BODY, self.api_version)
 
@@ -303,10 +626,12 @@ class MoesifMiddleware(object):
         event_rsp = self.event_mapper.to_response(data, self.LOG_BODY, self.DEBUG)
 
         # Prepare Event Model
-        event_model = self.event_mapper.to_event(data, event_req, event_rsp, blocked_by)
+        event_model = self.event_mapper.to_event(data, event_req, event_rsp)
 
         # Mask Event Model
-        return self.logger_helper.mask_event(event_model, self.settings, self.DEBUG)
+        event_model = self.logger_helper.mask_event(event_model, self.settings, self.DEBUG)
+        event_model.weight = data.weight
+        return event_model
 
     def update_user(self, user_profile):
         User().update_user(user_profile, self.api_client, self.DEBUG)
@@ -1,11 +1,16 @@
-from datetime import datetime
 import time
 import uuid
 from .logger_helper import LoggerHelper
 
+# Rough size of the serialized event without its headers and bodies
+EVENT_OVERHEAD_BYTES = 512
+
 class DataHolder(object):
-    """Capture the data for a request-response."""
-    def __init__(self, disable_capture_transaction_id, id, method, url, ip, request_headers, content_length, request_body, transfer_encoding, request_time):
+    """
+    Capture the raw data for a request-response. This is the record which is queued
+    for the background workers, which parse the bodies and build the event model.
+    """
+    def __init__(self, disable_capture_transaction_id, id, method, url, ip, request_headers, content_length, request_body, request_time_ns, request_start_ns, response_max_body_size=None):
         self.request_id = id
         self.method = method
         self.verb = method
@@ -19,26 +24,34 @@ class DataHolder(object):
         self.request_headers = request_headers
         self.content_length = content_length
         self.request_body = request_body
-        self.transfer_encoding = transfer_encoding
+        # The parsed request body and its transfer encoding, once parsed
+        self.parsed_request_body = None
         self.status = -1
         self.response_headers = None
-        self.response_chunks = None
-        self.response_body_data = None
-        self.request_time = request_time
-        self.start_at = time.time()
+        self.response_body = bytearray()
+        self.response_body_size = 0
+        self.response_max_body_size = response_max_body_size
+        # Raw clock values, the timestamps are only formatted by the background workers.
+        # request_time_ns is the wall clock time, request_start_ns and response_end_ns are monotonic
+        self.request_time_ns = request_time_ns
+        self.request_start_ns = request_start_ns
+        self.response_end_ns = None
         self.transaction_id = None
-        self.logger_helper = LoggerHelper()
+        self.blocked_by = None
+        self.weight = None
 
         if not disable_capture_transaction_id:
-            req_trans_id = [value for key, value in request_headers if key == "X-Moesif-Transaction-Id"]
-            if req_trans_id:
-                self.transaction_id = req_trans_id[0]
-                if not self.transaction_id:
-                    self.transaction_id = str(uuid.uuid4())
-            else:
+            self.transaction_id = request_headers.get("X-Moesif-Transaction-Id")
+            if not self.transaction_id:
                 self.transaction_id = str(uuid.uuid4())
-            # Add transaction id to the request header
-            self.request_headers.append(("X-Moesif-Transaction-Id", self.transaction_id))
+
+    def set_request_body(self, content_length, request_body):
+        self.content_length = content_length
+        self.request_body = request_body
+        self.parsed_request_body = None
+
+    def is_request_body_truncated(self):
+        return self.request_body is not None and self.content_length > len(self.request_body)
 
     def set_user_id(self, user_id):
         self.user_id = user_id
@@ -59,23 +72,54 @@ class DataHolder(object):
             response_headers.append(("X-Moesif-Transaction-Id", self.transaction_id))
         # Add worker process Id
         if debug:
-            response_headers.append(("X-Moesif-Wsgi-Pid", self.logger_helper.get_worker_pid()))
+            response_headers.append(("X-Moesif-Wsgi-Pid", LoggerHelper.get_worker_pid()))
         self.response_headers = response_headers
 
-    def capture_body_data(self, body_data):
-        if self.response_body_data is None:
-            self.response_body_data = body_data
+    def capture_response_chunk(self, chunk):
+        if not chunk:
+            return
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        self.response_body_size += len(chunk)
+        # Only copy up to the configured limit, the rest is streamed through without being retained
+        if self.response_max_body_size is None:
+            self.response_body += chunk
         else:
-            self.response_body_data = self.response_body_data + body_data
-
-    def finish_response(self, response_chunks):
-        self.response_time = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3]
-        self.response_chunks = response_chunks
-        new_response_chunks = []
-        stored_response_chunks = []
-        for line in response_chunks:
-            new_response_chunks.append(line)
-            stored_response_chunks.append(line)
-        self.response_chunks = stored_response_chunks
-        return new_response_chunks
+            remaining = self.response_max_body_size - len(self.response_body)
+            if remaining > 0:
+                self.response_body += chunk[:remaining]
+
+    def is_response_body_truncated(self):
+        return self.response_body_size > len(self.response_body)
+
+    def finish_response(self):
+        self.response_end_ns = time.monotonic_ns()
+
+    def estimate_size(self):
+        """
+        Estimate the size of the serialized event in bytes without building it, so batches can be
+        kept within a byte budget. Bodies are counted as base64, the larger of their encodings.
+        """
+        size = EVENT_OVERHEAD_BYTES + len(self.url)
+        for name, value in self.request_headers:
+            size += len(name) + len(value) + 6
+        for name, value in (self.response_headers or []):
+            size += len(name) + len(value) + 6
+        if self.request_body:
+            size += len(self.request_body) * 4 // 3
+        size += len(self.response_body) * 4 // 3
+        return size
+
+    @property
+    def duration_ns(self):
+        if self.response_end_ns is None:
+            return None
+        return self.response_end_ns - self.request_start_ns
+
+    @property
+    def response_time_ns(self):
+        # Derived from the monotonic duration, so the response time is never before the request time
+        if self.response_end_ns is None:
+            return None
+        return self.request_time_ns + self.duration_ns
 
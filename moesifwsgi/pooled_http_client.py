@@ -0,0 +1,277 @@
+import collections
+import http.client
+import logging
+import socket
+import ssl
+import threading
+import time
+import urllib.parse
+
+from moesifapi.http.http_client import HttpClient
+from moesifapi.http.http_method_enum import HttpMethodEnum
+from moesifapi.http.http_response import HttpResponse
+
+try:
+    import certifi
+except ImportError:
+    certifi = None
+
+logger = logging.getLogger(__name__)
+
+# Errors of a kept alive connection the server closed while it was idle, the request is sent again on a new connection
+STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError)
+
+
+class DnsCache(object):
+    """Caches the resolved addresses of a host for ttl seconds"""
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, host, port):
+        addresses = self.get(host, port)
+        if addresses is None:
+            addresses = self.store(host, port, socket.getaddrinfo(host, port, type=socket.SOCK_STREAM))
+        return addresses
+
+    def get(self, host, port):
+        """The cached addresses of the host, or None if they aren't cached or have expired"""
+        with self._lock:
+            entry = self._entries.get((host, port))
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+        return None
+
+    def store(self, host, port, addresses):
+        with self._lock:
+            self._entries[(host, port)] = (time.monotonic() + self.ttl, addresses)
+        return addresses
+
+    def invalidate(self, host, port):
+        with self._lock:
+            self._entries.pop((host, port), None)
+
+
+class TimedConnection(http.client.HTTPConnection):
+    """
+    HTTP or HTTPS connection to a pooled origin. Connects to the addresses cached by the pool,
+    resumes the last TLS session of the origin, and records the time spent connecting and in the TLS handshake.
+    """
+    def __init__(self, pool, timeout):
+        super().__init__(pool.host, pool.port, timeout=timeout)
+        self.pool = pool
+
+    def connect(self):
+        start = time.perf_counter()
+        sock = None
+        error = None
+        for family, sock_type, proto, _, address in self.pool.dns_cache.resolve(self.host, self.port):
+            try:
+                sock = socket.socket(family, sock_type, proto)
+                sock.settimeout(self.timeout)
+                sock.connect(address)
+                break
+            except OSError as e:
+                error = e
+                if sock is not None:
+                    sock.close()
+                sock = None
+        if sock is None:
+            self.pool.dns_cache.invalidate(self.host, self.port)
+            raise error or OSError(f"Could not resolve {self.host}")
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connect_time = time.perf_counter() - start
+
+        tls_time = None
+        tls_resumed = False
+        if self.pool.ssl_context is not None:
+            start = time.perf_counter()
+            sock = self.pool.ssl_context.wrap_socket(sock, server_hostname=self.host, session=self.pool.tls_session)
+            tls_time = time.perf_counter() - start
+            tls_resumed = sock.session_reused
+        self.sock = sock
+        self.pool.record_connect(connect_time, tls_time, tls_resumed)
+
+
+class ConnectionPool(object):
+    """Idle keep-alive connections to one origin, reused most recently used first"""
+    def __init__(self, scheme, host, port, size, timeout, dns_cache, ssl_context):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.size = size
+        self.timeout = timeout
+        self.dns_cache = dns_cache
+        self.ssl_context = ssl_context
+        self.tls_session = None
+        self._idle = collections.deque()
+        self._lock = threading.Lock()
+        self.stats = {
+            "connections_opened": 0,
+            "tls_sessions_resumed": 0,
+            "connect_seconds": 0.0,
+            "tls_handshake_seconds": 0.0,
+        }
+
+    def record_connect(self, connect_time, tls_time, tls_resumed):
+        with self._lock:
+            self.stats["connections_opened"] += 1
+            self.stats["connect_seconds"] += connect_time
+            if tls_time is not None:
+                self.stats["tls_handshake_seconds"] += tls_time
+            if tls_resumed:
+                self.stats["tls_sessions_resumed"] += 1
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats)
+
+    def acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return TimedConnection(self, self.timeout)
+
+    def release(self, connection):
+        if connection.sock is not None and self.ssl_context is not None:
+            # Keep the session, including tickets sent after the handshake, for the next connection to resume
+            self.tls_session = connection.sock.session
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def warm_up(self):
+        """Open the connections of the pool ahead of the first batch"""
+        connections = []
+        try:
+            for _ in range(self.size):
+                connection = TimedConnection(self, self.timeout)
+                connection.connect()
+                connections.append(connection)
+        finally:
+            for connection in connections:
+                self.release(connection)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, collections.deque()
+        for connection in idle:
+            connection.close()
+
+
+class PooledHttpClient(HttpClient):
+    """
+    HttpClient which keeps explicit pools of keep-alive connections, one pool per origin with up to
+    pool_size idle connections, typically one per worker thread. Resolved addresses are cached for
+    dns_cache_ttl seconds and TLS sessions are resumed. The time spent connecting and in TLS
+    handshakes is counted, alongside how many requests reused a connection.
+    """
+    def __init__(self, pool_size, timeout=30, dns_cache_ttl=60):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.dns_cache = DnsCache(dns_cache_ttl)
+        self.ssl_context = ssl.create_default_context(cafile=certifi.where() if certifi is not None else None)
+        self._pools = {}
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._reused = 0
+
+    def get_pool(self, url):
+        parsed = urllib.parse.urlsplit(url)
+        scheme = parsed.scheme or 'https'
+        port = parsed.port or (443 if scheme == 'https' else 80)
+        key = (scheme, parsed.hostname, port)
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = ConnectionPool(scheme, parsed.hostname, port, self.pool_size, self.timeout, self.dns_cache,
+                                      self.ssl_context if scheme == 'https' else None)
+                self._pools[key] = pool
+        return pool
+
+    def warm_up(self, url):
+        """Connect to the origin of the url in a background thread, so startup is not delayed"""
+        def connect():
+            try:
+                self.get_pool(url).warm_up()
+            except Exception as e:
+                logger.info(f"Error while opening connections to {url}: {str(e)}")
+        threading.Thread(target=connect, daemon=True).start()
+
+    def execute_as_string(self, request):
+        parsed = urllib.parse.urlsplit(request.query_url)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+        headers = dict(request.headers or {})
+        body = request.parameters
+        if body is not None and not isinstance(body, (bytes, str)) and hasattr(body, '__len__'):
+            # Streamed bodies with a known length are sent with Content-Length instead of chunked
+            headers['Content-Length'] = str(len(body))
+
+        pool = self.get_pool(request.query_url)
+        connection = pool.acquire()
+        reused = connection.sock is not None
+        try:
+            response = self._send(connection, HttpMethodEnum.to_string(request.http_method), path, body, headers)
+        except STALE_CONNECTION_ERRORS:
+            connection.close()
+            if not reused:
+                raise
+            # The server closed the idle connection, send again on a new one
+            connection = TimedConnection(pool, self.timeout)
+            reused = False
+            try:
+                response = self._send(connection, HttpMethodEnum.to_string(request.http_method), path, body, headers)
+            except BaseException:
+                connection.close()
+                raise
+        except BaseException:
+            connection.close()
+            raise
+
+        with self._lock:
+            self._requests += 1
+            if reused:
+                self._reused += 1
+        try:
+            raw_body = response.read()
+        except BaseException:
+            connection.close()
+            raise
+        if response.will_close:
+            connection.close()
+        else:
+            pool.release(connection)
+        charset = response.headers.get_content_charset() or 'utf-8'
+        return HttpResponse(response.status, response.headers, raw_body.decode(charset, errors='replace'))
+
+    @classmethod
+    def _send(cls, connection, method, path, body, headers):
+        connection.request(method, path, body=body, headers=headers)
+        return connection.getresponse()
+
+    def close(self):
+        with self._lock:
+            pools = list(self._pools.values())
+        for pool in pools:
+            pool.close()
+
+    def get_stats(self):
+        stats = {
+            "connections_opened": 0,
+            "tls_sessions_resumed": 0,
+            "connect_seconds": 0.0,
+            "tls_handshake_seconds": 0.0,
+        }
+        with self._lock:
+            pools = list(self._pools.values())
+            stats["requests"] = self._requests
+            stats["connections_reused"] = self._reused
+        for pool in pools:
+            for name, value in pool.get_stats().items():
+                stats[name] += value
+        return stats
@@ -1,29 +1,198 @@
 import re
 
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    # Before Python 3.11
+    import sre_parse
+
+# Extracts the route from the request uri
+ROUTE_PATTERN = re.compile(r"http[s]*://[^/]+(/[^?]+)")
+
+# Verbs and statuses are small closed sets, so the verb and status conditions of each rule are
+# evaluated against all of them when the index is compiled
+KNOWN_VERBS = ('GET', 'HEAD', 'POST', 'PUT', 'DELETE', 'CONNECT', 'OPTIONS', 'TRACE', 'PATCH')
+KNOWN_STATUSES = range(100, 600)
+
+# Upper bound on the memoized candidate lists, routes are keyed by their first segment only
+MAX_CANDIDATE_KEYS = 1024
+
+
+def literal_prefix(pattern):
+    """
+    Literal text any route matching an anchored pattern must start with, or None if the pattern is not
+    anchored, ignores case, or has alternatives at the top level such as ^/users|/orders
+    """
+    try:
+        parsed = sre_parse.parse(pattern)
+    except Exception:
+        return None
+    if parsed.state.flags & sre_parse.SRE_FLAG_IGNORECASE:
+        return None
+    items = list(parsed)
+    if not items or items[0] != (sre_parse.AT, sre_parse.AT_BEGINNING):
+        return None
+    if any(op == sre_parse.BRANCH for op, _ in items):
+        return None
+    prefix = []
+    # Only the literals following the anchor, up to the first repeat, class or group
+    for op, value in items[1:]:
+        if op != sre_parse.LITERAL:
+            break
+        prefix.append(chr(value))
+    return ''.join(prefix)
+
+
+def route_segment(route):
+    """First segment of the route, e.g. /api for /api/v1/users"""
+    end = route.find('/', 1)
+    return route if end == -1 else route[:end]
+
+
+class RegexRuleIndex(object):
+    """
+    Sampling rules compiled once per config version. The patterns are precompiled, the verb and
+    status conditions are resolved into sets, and anchored route patterns are reduced to a literal
+    prefix. The candidate rules for a verb, status and first route segment are computed once and
+    memoized, so a lookup only evaluates the few rules which can match, in their original order.
+    """
+    def __init__(self, regex_configs):
+        self.rules = []
+        for regex_rule in regex_configs:
+            # Map the condition path and value, the last condition for a path wins
+            condition_table = {}
+            for condition in regex_rule["conditions"]:
+                condition_table[condition["path"]] = condition["value"]
+            if not condition_table:
+                # A rule without conditions never matches
+                continue
+            self.rules.append(self._compile_rule(regex_rule["sample_rate"], condition_table))
+        self._candidates = {}
+
+    @classmethod
+    def _compile_rule(cls, sample_rate, condition_table):
+        rule = {
+            "sample_rate": sample_rate,
+            "verbs": None,
+            "statuses": None,
+            "route_prefix": None,
+            "route_segment": None,
+            "conditions": [],
+        }
+        for path, value in condition_table.items():
+            pattern = re.compile(str(value))
+            if path == "request.verb":
+                rule["verbs"] = frozenset(verb for verb in KNOWN_VERBS if cls._search(pattern, verb))
+            elif path == "response.status":
+                rule["statuses"] = frozenset(status for status in KNOWN_STATUSES if cls._search(pattern, str(status)))
+            elif path == "request.route":
+                prefix = literal_prefix(pattern.pattern)
+                if prefix:
+                    rule["route_prefix"] = prefix
+                    if prefix.find('/', 1) != -1:
+                        rule["route_segment"] = route_segment(prefix)
+            rule["conditions"].append((path, pattern))
+        return rule
+
+    @staticmethod
+    def _search(pattern, value):
+        # As in RegexConfigHelper.regex_match, a zero-length match doesn't count as a match
+        extracted = pattern.search(value)
+        return extracted is not None and extracted.group(0) != ''
+
+    @classmethod
+    def _may_match(cls, rule, verb, status, segment):
+        if rule["verbs"] is not None and verb in KNOWN_VERBS and verb not in rule["verbs"]:
+            return False
+        if rule["statuses"] is not None and status in KNOWN_STATUSES and status not in rule["statuses"]:
+            return False
+        if rule["route_prefix"] is not None and segment is not None:
+            if rule["route_segment"] is not None:
+                return rule["route_segment"] == segment
+            # The prefix lies within the first segment
+            return segment.startswith(rule["route_prefix"])
+        return True
+
+    def candidates(self, verb, status, route):
+        segment = route_segment(route) if route else None
+        key = (verb, status, segment)
+        candidates = self._candidates.get(key)
+        if candidates is None:
+            candidates = [rule for rule in self.rules if self._may_match(rule, verb, status, segment)]
+            if len(self._candidates) >= MAX_CANDIDATE_KEYS:
+                self._candidates = {}
+            self._candidates[key] = candidates
+        return candidates
+
+    def lookup(self, config_mapping, request_only=False):
+        """
+        Find the sample rate of the first matching rule
+        Args:
+            config_mapping: Config associated with the request
+            request_only: Whether fields missing from the config mapping may still be known once the response has
+                finished, otherwise a rule on a missing field doesn't match
+        Return:
+            decided: False if request_only and the first rule which can match depends on a missing field
+            sample_rate: Sample rate, or None if no rule matched
+        """
+        route = config_mapping.get("request.route")
+        candidates = self.candidates(config_mapping.get("request.verb"), config_mapping.get("response.status"), route)
+        for rule in candidates:
+            if rule["route_prefix"] is not None and not (route and route.startswith(rule["route_prefix"])):
+                continue
+            regex_matched = True
+            missing_field = False
+            for path, pattern in rule["conditions"]:
+                if path not in config_mapping:
+                    if not request_only:
+                        regex_matched = False
+                        break
+                    missing_field = True
+                    continue
+                if not self._search(pattern, str(config_mapping[path])):
+                    regex_matched = False
+                    break
+            if regex_matched:
+                if missing_field:
+                    return False, None
+                return True, rule["sample_rate"]
+        return True, None
+
 
 class RegexConfigHelper:
 
     def __init__(self):
-        pass
+        # The compiled index and the regex configs it was built from, replaced when the config changes
+        self._index = (None, None)
+
+    def get_index(self, regex_configs):
+        source, index = self._index
+        if source is not regex_configs:
+            index = RegexRuleIndex(regex_configs)
+            self._index = (regex_configs, index)
+        return index
 
     @classmethod
-    def prepare_config_mapping(cls, event):
+    def prepare_fields_config_mapping(cls, verb, uri, ip_address, status=None):
         """
-        Function to prepare config mapping
+        Function to prepare config mapping from the event fields
         Args:
-            event: Event to be logged
+            verb: Request method
+            uri: Request url
+            ip_address: Client ip address
+            status: Response status, or None before the response is known
         Return:
             regex_config: Regex config mapping
         """
         regex_config = {}
 
         # Config mapping for request.verb
-        if event.request.verb:
-            regex_config["request.verb"] = event.request.verb
+        if verb:
+            regex_config["request.verb"] = verb
 
         # Config mapping for request.uri
-        if event.request.uri:
-            extracted = re.match(r"http[s]*://[^/]+(/[^?]+)", event.request.uri)
+        if uri:
+            extracted = ROUTE_PATTERN.match(uri)
             if extracted is not None:
                 route_mapping = extracted.group(1)
             else:
@@ -31,15 +200,27 @@ class RegexConfigHelper:
             regex_config["request.route"] = route_mapping
 
         # Config mapping for request.ip_address
-        if event.request.ip_address:
-            regex_config["request.ip_address"] = event.request.ip_address
+        if ip_address:
+            regex_config["request.ip_address"] = ip_address
 
         # Config mapping for response.status
-        if event.response.status:
-            regex_config["response.status"] = event.response.status
+        if status:
+            regex_config["response.status"] = status
 
         return regex_config
 
+    @classmethod
+    def prepare_config_mapping(cls, event):
+        """
+        Function to prepare config mapping
+        Args:
+            event: Event to be logged
+        Return:
+            regex_config: Regex config mapping
+        """
+        return cls.prepare_fields_config_mapping(event.request.verb, event.request.uri, event.request.ip_address,
+                                                 event.response.status)
+
     @classmethod
     def regex_match(cls, event_value, condition_value):
         """
@@ -50,7 +231,7 @@ class RegexConfigHelper:
         Return:
              regex_matched: Regex matched value to determine if the regex match was successful
         """
-        extracted = re.search(condition_value, event_value)
+        extracted = re.search(str(condition_value), str(event_value))
         if extracted is not None:
             return extracted.group(0)
 
@@ -63,36 +244,6 @@ class RegexConfigHelper:
         Return:
             sample_rate: Sample rate
         """
-        # Iterate through the list of regex configs
-        for regex_rule in regex_configs:
-            # Fetch the sample rate
-            sample_rate = regex_rule["sample_rate"]
-            # Fetch the conditions
-            conditions = regex_rule["conditions"]
-            # Bool flag to determine if the regex conditions are matched
-            regex_matched = None
-            # Create a table to hold the conditions mapping (path and value)
-            condition_table = {}
-            # Iterate through the regex rule conditions and map the path and value
-            for condition in conditions:
-                # Add condition path -> value to the condition table
-                condition_table[condition["path"]] = condition["value"]
-            # Iterate through conditions table and perform `and` operation between each conditions
-            for path, values in condition_table.items():
-                # Check if the path exists in the request config mapping
-                if config_mapping[path]:
-                    # Fetch the value of the path in request config mapping
-                    event_data = config_mapping[path]
-                    # Perform regex matching with event value
-                    regex_matched = self.regex_match(event_data, values)
-                else:
-                    # Path does not exists in request config mapping, so no need to match regex condition rule
-                    regex_matched = False
-                # If one of the rule does not match, skip the condition & avoid matching other rules for the same condition
-                if not regex_matched:
-                    break
-            # If regex conditions matched, return sample rate
-            if regex_matched:
-                return sample_rate
         # If regex conditions are not matched, return sample rate as None and will use default sample rate
-        return None
+        _, sample_rate = self.get_index(regex_configs).lookup(config_mapping)
+        return sample_rate
@@ -0,0 +1,65 @@
+import io
+
+
+class RequestBodyTee(object):
+    """
+    Replacement for wsgi.input which records the request body as the app reads it.
+    At most max_body_size bytes are recorded in memory, the whole body when it's None. Since
+    nothing is read ahead of the app, this also captures chunked request bodies sent without
+    a Content-Length.
+    """
+    def __init__(self, stream, max_body_size):
+        self.stream = stream
+        self.max_body_size = max_body_size
+        self.buffer = None
+        self.captured_size = 0
+        self.size = 0
+
+    def _record(self, data):
+        if not data:
+            return data
+        self.size += len(data)
+        if self.max_body_size is None:
+            remaining = len(data)
+        else:
+            remaining = self.max_body_size - self.captured_size
+        if remaining > 0:
+            if self.buffer is None:
+                self.buffer = io.BytesIO()
+            chunk = data[:remaining]
+            self.buffer.write(chunk)
+            self.captured_size += len(chunk)
+        return data
+
+    def read(self, *args):
+        return self._record(self.stream.read(*args))
+
+    def readline(self, *args):
+        return self._record(self.stream.readline(*args))
+
+    def readlines(self, *args):
+        lines = self.stream.readlines(*args)
+        for line in lines:
+            self._record(line)
+        return lines
+
+    def __iter__(self):
+        for line in self.stream:
+            yield self._record(line)
+
+    def is_truncated(self):
+        return self.size > self.captured_size
+
+    def getvalue(self):
+        if self.buffer is None:
+            return b''
+        return self.buffer.getvalue()
+
+    def discard(self):
+        if self.buffer is not None:
+            self.buffer.close()
+            self.buffer = None
+
+    def __getattr__(self, name):
+        # Delegate attribute access to the original input stream
+        return getattr(self.stream, name)
@@ -0,0 +1,72 @@
+# CGI variables which carry a request header but don't use the HTTP_ prefix
+SPECIAL_HEADER_NAMES = {
+    'HTTP_CGI_AUTHORIZATION': 'Authorization',
+    'CONTENT_LENGTH': 'Content-Length',
+    'CONTENT_TYPE': 'Content-Type',
+}
+
+# Upper bound on the memoized translations, so clients sending arbitrary header names can't grow it forever
+MAX_HEADER_NAMES = 4096
+
+# Process-wide memo of environ key -> header name, or None for keys which are not headers
+_header_names = {}
+
+
+def header_name(cgi_var):
+    """Translate an environ key into its HTTP header name, or None if it's not a header"""
+    try:
+        return _header_names[cgi_var]
+    except KeyError:
+        pass
+    if cgi_var in SPECIAL_HEADER_NAMES:
+        name = SPECIAL_HEADER_NAMES[cgi_var]
+    elif cgi_var.startswith('HTTP_'):
+        name = cgi_var[5:].title().replace('_', '-')
+    else:
+        name = None
+    if len(_header_names) < MAX_HEADER_NAMES:
+        _header_names[cgi_var] = name
+    return name
+
+
+class RequestHeaders(object):
+    """
+    Immutable snapshot of the request headers, built in a single pass over the environ the
+    first time it is used. The same snapshot is shared by identity, governance, the DataHolder
+    and the event mapper, with original-case and lowercase dict views built on demand.
+    """
+    def __init__(self, environ):
+        self._environ = environ
+        self._items = None
+        self._dict = None
+        self._lower = None
+
+    def items(self):
+        if self._items is None:
+            items = []
+            for cgi_var, value in self._environ.items():
+                name = header_name(cgi_var)
+                if name is not None:
+                    items.append((name, value))
+            self._items = tuple(items)
+            self._environ = None
+        return self._items
+
+    def as_dict(self):
+        if self._dict is None:
+            self._dict = dict(self.items())
+        return self._dict
+
+    def lower(self):
+        if self._lower is None:
+            self._lower = {k.lower(): v for k, v in self.items()}
+        return self._lower
+
+    def get(self, name, default=None):
+        return self.as_dict().get(name, default)
+
+    def __iter__(self):
+        return iter(self.items())
+
+    def __len__(self):
+        return len(self.items())
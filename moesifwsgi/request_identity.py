@@ -0,0 +1,45 @@
+class RequestIdentity(object):
+    """
+    Resolves the user and company ids for a single request once, so governance, sampling
+    and the event share the same result. IDENTIFY_USER and IDENTIFY_COMPANY take the response
+    headers as an argument, so they are called again once the response headers are known.
+    The user id parsed from the authorization header only depends on the request and is
+    resolved at most once.
+    """
+    def __init__(self, logger_helper, environ, request_headers, settings, app, debug):
+        self.logger_helper = logger_helper
+        self.environ = environ
+        self.request_headers = request_headers
+        self.settings = settings
+        self.app = app
+        self.debug = debug
+        self._user_ids = {}
+        self._company_ids = {}
+        self._headers_user_id = None
+        self._headers_user_id_resolved = False
+
+    def get_user_id(self, response_headers=None):
+        # Without IDENTIFY_USER the result does not depend on the response, so both phases share it
+        with_response = response_headers is not None and self.settings.get("IDENTIFY_USER") is not None
+        if with_response not in self._user_ids:
+            user_id = self.logger_helper.identify_user(self.environ, self.settings, self.app,
+                                                       response_headers if response_headers is not None else dict())
+            if not user_id:
+                user_id = self._get_headers_user_id()
+            self._user_ids[with_response] = user_id
+        return self._user_ids[with_response]
+
+    def get_company_id(self, response_headers=None):
+        with_response = response_headers is not None and self.settings.get("IDENTIFY_COMPANY") is not None
+        if with_response not in self._company_ids:
+            self._company_ids[with_response] = self.logger_helper.get_company_id(
+                self.environ, self.settings, self.app, self.debug,
+                response_headers if response_headers is not None else dict())
+        return self._company_ids[with_response]
+
+    def _get_headers_user_id(self):
+        if not self._headers_user_id_resolved:
+            self._headers_user_id = self.logger_helper.get_user_id_from_headers(self.environ, self.settings, self.debug,
+                                                                                 self.request_headers)
+            self._headers_user_id_resolved = True
+        return self._headers_user_id
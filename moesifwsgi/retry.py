@@ -0,0 +1,90 @@
+import email.utils
+import random
+import threading
+import time
+
+# Delay before the first retry and the maximum delay between retries, in seconds
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 30
+
+# Response statuses which are retried, the collector is throttling or temporarily unavailable
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+# Response statuses whose Retry-After header is honoured
+RETRY_AFTER_STATUSES = {429, 503}
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of sending a batch while the circuit breaker is open"""
+    pass
+
+
+def backoff_delay(attempt, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY):
+    """Exponential backoff with full jitter, so processes recovering together don't retry in lockstep"""
+    return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header, given in seconds or as an HTTP date, or None"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at is None:
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+class CircuitBreaker(object):
+    """
+    Stops sending to the collector after failure_threshold consecutive failed attempts, so the workers
+    don't keep paying connect timeouts while it's down. Once reset_timeout seconds have passed, a
+    single trial attempt is let through, which closes the circuit if it succeeds and opens it again if not.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_count = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                # Let a single trial attempt through
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def is_available(self):
+        """Whether a batch would be let through now, without changing the state"""
+        with self._lock:
+            if self.state == self.OPEN:
+                return time.monotonic() - self._opened_at >= self.reset_timeout
+            return self.state == self.CLOSED
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+                self.state = self.OPEN
+                self.opened_count += 1
+                self._opened_at = time.monotonic()
@@ -0,0 +1,188 @@
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime
+
+from moesifapi.http.http_response import HttpResponse
+
+from .config_manager import ForkSafeConfigUpdateManager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+SHARED_CONFIG_MAGIC = b'MCFG'
+SHARED_CONFIG_VERSION = 1
+# Magic, format version, sequence number (odd while being written), publish time in ns, data length and CRC32
+SHARED_CONFIG_HEADER = struct.Struct('<4sIQQII')
+# Age in seconds after which the shared config is fetched again, a little under the interval of the config job
+SHARED_CONFIG_MAX_AGE = 50
+# Minimum age in seconds before a new ETag seen in a batch response fetches the shared config again
+SHARED_CONFIG_MIN_AGE = 5
+
+
+class SharedConfigUpdateManager(ForkSafeConfigUpdateManager):
+    """
+    ConfigUpdateManager sharing the fetched config and governance rules with the other processes of the
+    host through a memory mapped file at path. When the shared config is older than max_age, or a batch
+    response has a new ETag, the first process to take the lock file fetches it from Moesif and publishes
+    it with its ETag. The other processes only parse the shared config again when its sequence number changes.
+    A new ETag is only fetched once the shared config is SHARED_CONFIG_MIN_AGE old, until then it's
+    forgotten, so the next batch response with it updates the config again.
+    """
+    def __init__(self, api_client, app_config, debug, path, max_age=SHARED_CONFIG_MAX_AGE):
+        # Set before the config manager fetches the config on start
+        self.path = path
+        self.max_age = max_age
+        self.lock_path = path + '.lock'
+        self._mapped = None
+        self._loaded_sequence = None
+        self._shared_etag = None
+        self._shared_lock = threading.Lock()
+        self._fetches = 0
+        self._loads = 0
+        super().__init__(api_client, app_config, debug)
+
+    def after_fork_in_child(self):
+        super().after_fork_in_child()
+        # The lock may have been held by a thread of the parent during the fork
+        self._shared_lock = threading.Lock()
+
+    def update_configuration(self):
+        if fcntl is None:
+            # File locks are required to elect the process fetching the config
+            return super().update_configuration()
+        with self._shared_lock:
+            try:
+                if not self._needs_fetch(self._read_header()):
+                    self._load()
+                    return
+                with open(self.lock_path, 'a+b') as lock_file:
+                    try:
+                        # Until a config was loaded, wait for the process fetching it instead
+                        flags = fcntl.LOCK_EX if self._loaded_sequence is None else fcntl.LOCK_EX | fcntl.LOCK_NB
+                        fcntl.flock(lock_file.fileno(), flags)
+                    except BlockingIOError:
+                        # Another process is fetching it, load the config shared so far
+                        self._load()
+                        return
+                    try:
+                        # Checked again, the config may have been published while the lock was taken
+                        if self._needs_fetch(self._read_header()):
+                            self._fetch_and_publish()
+                        else:
+                            self._load()
+                    finally:
+                        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            except Exception as e:
+                logger.exception(f"Error while updating the shared configuration at {self.path}: {str(e)}")
+            finally:
+                self._forget_unfetched_etag()
+
+    def _forget_unfetched_etag(self):
+        # check_and_update only queues an update for an ETag other than current_etag, which it saved
+        with self._lock.gen_wlock():
+            if self.current_etag != self._shared_etag:
+                self.current_etag = self._shared_etag
+
+    def _needs_fetch(self, header):
+        if header is None:
+            return True
+        magic, version, sequence, published_ns, _, _ = header
+        if magic != SHARED_CONFIG_MAGIC or version != SHARED_CONFIG_VERSION or sequence % 2:
+            # Not published yet, or the process publishing it crashed
+            return True
+        age = time.time() - published_ns / 1e9
+        if age >= self.max_age:
+            return True
+        # A batch response had an ETag the shared config doesn't have yet
+        return (self.current_etag is not None and self.current_etag != self._shared_etag and
+                age >= SHARED_CONFIG_MIN_AGE and sequence == self._loaded_sequence)
+
+    def _map(self, size):
+        if self._mapped is not None and len(self._mapped) >= size:
+            return self._mapped
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            if self._mapped is not None:
+                self._mapped.close()
+            self._mapped = mmap.mmap(fd, os.fstat(fd).st_size)
+        finally:
+            os.close(fd)
+        return self._mapped
+
+    def _read_header(self):
+        header = SHARED_CONFIG_HEADER.unpack_from(self._map(SHARED_CONFIG_HEADER.size), 0)
+        return header if header[0] == SHARED_CONFIG_MAGIC else None
+
+    def _load(self):
+        """Apply the shared config if it changed since it was last loaded"""
+        header = self._read_header()
+        if header is None or header[2] % 2 or header[2] == self._loaded_sequence:
+            return
+        _, _, sequence, _, length, crc = header
+        data = self._map(SHARED_CONFIG_HEADER.size + length)[SHARED_CONFIG_HEADER.size:SHARED_CONFIG_HEADER.size + length]
+        # Discard the data if it was being published while it was read
+        if zlib.crc32(data) != crc or SHARED_CONFIG_HEADER.unpack_from(self._mapped, 0)[2] != sequence:
+            return
+        shared = json.loads(data)
+        config = HttpResponse(200, {"X-Moesif-Config-ETag": shared['etag']}, shared['config'])
+        self._apply(shared['etag'], config, shared['rules'])
+        self._loaded_sequence = sequence
+        self._loads += 1
+        if self.debug:
+            logger.debug(f"Loaded shared config {sequence} with ETag {shared['etag']}")
+
+    def _fetch_and_publish(self):
+        config = self.app_config.get_config(self.api_client, self.debug)
+        new_etag, _, _ = self.app_config.parse_configuration(config, self.debug)
+        rules = self.govern_manager.load_rules(self.debug)
+        self._fetches += 1
+        if config is None:
+            # Retried on the next update, the other processes keep the config shared so far
+            return
+        if rules is None:
+            rules = self.govern_manager.rules
+        data = json.dumps({'etag': new_etag, 'config': config.raw_body, 'rules': rules}).encode('utf-8')
+
+        mapped = self._map(SHARED_CONFIG_HEADER.size + len(data))
+        previous = SHARED_CONFIG_HEADER.unpack_from(mapped, 0)
+        sequence = previous[2] + 1 if previous[0] == SHARED_CONFIG_MAGIC else 1
+        sequence += sequence % 2
+        # An odd sequence number marks the data as being written
+        SHARED_CONFIG_HEADER.pack_into(mapped, 0, SHARED_CONFIG_MAGIC, SHARED_CONFIG_VERSION, sequence - 1, 0, 0, 0)
+        mapped[SHARED_CONFIG_HEADER.size:SHARED_CONFIG_HEADER.size + len(data)] = data
+        SHARED_CONFIG_HEADER.pack_into(mapped, 0, SHARED_CONFIG_MAGIC, SHARED_CONFIG_VERSION, sequence,
+                                       time.time_ns(), len(data), zlib.crc32(data))
+        mapped.flush()
+
+        self._apply(new_etag, config, rules)
+        self._loaded_sequence = sequence
+        if self.debug:
+            logger.debug(f"Published shared config {sequence} with ETag {new_etag}")
+
+    def _apply(self, etag, config, rules):
+        config_body = json.loads(config.raw_body)
+        with self._lock.gen_wlock():
+            self.current_etag = etag
+            self.config = config
+            self.config_parsed_body = config_body
+            self.last_updated_time = datetime.utcnow()
+        self.govern_manager.cache_rules(rules)
+        self._shared_etag = etag
+
+    def get_stats(self):
+        return {
+            "config_fetches": self._fetches,
+            "config_loads": self._loads,
+        }
@@ -0,0 +1,341 @@
+import collections
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_SUFFIX = '.spill'
+SEGMENT_MAGIC = b'MSPL'
+SEGMENT_VERSION = 2
+# Magic, version and the offset of the first record not acknowledged yet
+SEGMENT_HEADER = struct.Struct('<4sIQ')
+# Length and CRC32 of the record, and the number of times its event failed to be sent.
+# A length of 0 marks the end of the written records
+RECORD_HEADER = struct.Struct('<IIH')
+ATTEMPTS = struct.Struct('<H')
+
+
+def record_crc(payload, attempts):
+    """CRC32 of the payload followed by its attempts"""
+    return zlib.crc32(ATTEMPTS.pack(attempts), zlib.crc32(payload))
+
+
+class SpilledEvent(object):
+    """
+    A serialized event read back from the spill queue. It stays on disk until it's acknowledged
+    with SpillQueue.ack, once it was sent, spilled again or given up on.
+    """
+    __slots__ = ('payload', 'attempts', 'segment', 'offset')
+
+    def __init__(self, payload, attempts, segment, offset):
+        self.payload = payload
+        self.attempts = attempts
+        self.segment = segment
+        self.offset = offset
+
+
+class SpillSegment(object):
+    """
+    Append-only segment file of the spill queue, memory mapped. Each record is framed with its
+    length and CRC32, so a record torn by a crash ends the segment instead of being read back.
+    Records read are only done once acknowledged, and the offset of the first record which isn't
+    is kept in the segment header, so records read but not sent yet are replayed after a crash,
+    and records done are not. An exclusive lock is held on the file while it is open, so a segment is
+    only ever read or written by one process.
+    """
+    def __init__(self, path, file, size):
+        self.path = path
+        self.file = file
+        self.size = size
+        self.mapped = mmap.mmap(file.fileno(), size)
+        self.read_offset = SEGMENT_HEADER.size
+        self.write_offset = SEGMENT_HEADER.size
+        self.count = 0
+        # Whether each record read is acknowledged, by offset in the order they were read
+        self._in_flight = collections.OrderedDict()
+
+    @classmethod
+    def create(cls, directory, size):
+        """Create a segment, under a temporary name until it's complete so a crash never leaves a partial header"""
+        name = f"{time.time_ns():020d}-{os.getpid()}"
+        temp_path = os.path.join(directory, name + '.tmp')
+        path = os.path.join(directory, name + SEGMENT_SUFFIX)
+        file = open(temp_path, 'w+b')
+        try:
+            cls._lock(file)
+            file.truncate(size)
+            file.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, SEGMENT_VERSION, SEGMENT_HEADER.size))
+            file.flush()
+            os.rename(temp_path, path)
+            return cls(path, file, size)
+        except Exception:
+            file.close()
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    @classmethod
+    def open(cls, path):
+        """
+        Open a segment left by a previous process and find its unread records.
+        Raises BlockingIOError if another process holds the segment
+        """
+        file = open(path, 'r+b')
+        try:
+            cls._lock(file)
+            size = os.fstat(file.fileno()).st_size
+            if size < SEGMENT_HEADER.size:
+                raise ValueError(f"Truncated spill segment {path}")
+            segment = cls(path, file, size)
+        except Exception:
+            file.close()
+            raise
+        magic, version, read_offset = SEGMENT_HEADER.unpack_from(segment.mapped, 0)
+        if magic != SEGMENT_MAGIC or version != SEGMENT_VERSION or read_offset > size:
+            segment.close()
+            raise ValueError(f"Invalid spill segment {path}")
+        segment.read_offset = read_offset
+        segment.write_offset = read_offset
+        segment._scan()
+        return segment
+
+    @classmethod
+    def _lock(cls, file):
+        if fcntl is not None:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    def _scan(self):
+        offset = self.write_offset
+        while offset + RECORD_HEADER.size <= self.size:
+            length, crc, attempts = RECORD_HEADER.unpack_from(self.mapped, offset)
+            start = offset + RECORD_HEADER.size
+            if not length or start + length > self.size or \
+                    record_crc(self.mapped[start:start + length], attempts) != crc:
+                break
+            offset = start + length
+            self.count += 1
+        self.write_offset = offset
+
+    def append(self, payload, attempts=0):
+        """Append a record, False if the segment is full"""
+        end = self.write_offset + RECORD_HEADER.size + len(payload)
+        if end > self.size:
+            return False
+        start = self.write_offset + RECORD_HEADER.size
+        # The payload is written before its header, so the record only becomes readable once complete
+        self.mapped[start:end] = payload
+        RECORD_HEADER.pack_into(self.mapped, self.write_offset, len(payload), record_crc(payload, attempts), attempts)
+        self.write_offset = end
+        self.count += 1
+        return True
+
+    def read(self, max_count, max_bytes):
+        """Read up to max_count records, and records up to max_bytes unless it's the first, as SpilledEvents"""
+        records = []
+        total = 0
+        offset = self.read_offset
+        while offset < self.write_offset and len(records) < max_count:
+            length, _, attempts = RECORD_HEADER.unpack_from(self.mapped, offset)
+            if records and total + length > max_bytes:
+                break
+            start = offset + RECORD_HEADER.size
+            records.append(SpilledEvent(self.mapped[start:start + length], attempts, self, offset))
+            self._in_flight[offset] = False
+            total += length
+            offset = start + length
+        self.read_offset = offset
+        self.count -= len(records)
+        return records
+
+    def ack(self, offset):
+        """Acknowledge the record read at offset, the offset in the header moves past the records acknowledged in order"""
+        if self.mapped.closed:
+            # Closed with the spill queue, the record is replayed by the next process
+            return
+        self._in_flight[offset] = True
+        while self._in_flight and next(iter(self._in_flight.values())):
+            self._in_flight.popitem(last=False)
+        committed = next(iter(self._in_flight), self.read_offset)
+        SEGMENT_HEADER.pack_into(self.mapped, 0, SEGMENT_MAGIC, SEGMENT_VERSION, committed)
+
+    def exhausted(self):
+        """Whether every record written was read"""
+        return self.read_offset >= self.write_offset
+
+    def consumed(self):
+        """Whether every record written was read and acknowledged"""
+        return self.exhausted() and not self._in_flight
+
+    def close(self, delete=False):
+        try:
+            if not delete:
+                self.mapped.flush()
+            self.mapped.close()
+        finally:
+            self.file.close()
+            if delete:
+                os.remove(self.path)
+
+
+class SpillQueue(object):
+    """
+    Disk tier of the event queue, holding serialized events which didn't fit in memory in segment
+    files under directory. Segments are rotated once they reach segment_size, and events are refused
+    once the segments would take more than max_bytes. Segments left by a process which stopped or
+    crashed before they were read are replayed by the next process opening the directory.
+
+    Events taken with get stay on disk until they are acknowledged with ack, so events lost by a
+    crash while they're sent are replayed, and may be sent twice. Each event keeps the number of
+    times it failed to be sent, and should be given up on once it reaches max_attempts.
+    """
+    def __init__(self, directory, max_bytes, segment_size, max_attempts=5):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_size = segment_size
+        self.max_attempts = max_attempts
+        self._segments = collections.deque()
+        self._writer = None
+        self._bytes = 0
+        self._count = 0
+        self._lock = threading.Lock()
+        self._spilled = 0
+        self._replayed = 0
+        self._rejected = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._replay()
+
+    def _replay(self):
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.tmp'):
+                # Left by a crash while creating a segment
+                self._remove_abandoned(path)
+                continue
+            if not name.endswith(SEGMENT_SUFFIX):
+                continue
+            try:
+                segment = SpillSegment.open(path)
+            except BlockingIOError:
+                # Held by a running process
+                continue
+            except Exception as e:
+                logger.warning(f"Removing unreadable spill segment {path}: {str(e)}")
+                self._remove_abandoned(path)
+                continue
+            if segment.consumed():
+                segment.close(delete=True)
+                continue
+            self._segments.append(segment)
+            self._bytes += segment.size
+            self._count += segment.count
+            self._replayed += segment.count
+        if self._replayed:
+            logger.info(f"Replaying {self._replayed} events spilled to {self.directory}")
+
+    @classmethod
+    def _remove_abandoned(cls, path):
+        try:
+            with open(path, 'r+b') as file:
+                SpillSegment._lock(file)
+                os.remove(path)
+        except OSError:
+            pass
+
+    def put(self, payload, attempts=0):
+        """Write a serialized event to disk with the number of times it failed to be sent, False if it doesn't fit within max_bytes"""
+        with self._lock:
+            if self._writer is None or not self._writer.append(payload, attempts):
+                if not self._rotate(len(payload)) or not self._writer.append(payload, attempts):
+                    self._rejected += 1
+                    return False
+            self._count += 1
+            self._spilled += 1
+            return True
+
+    def _rotate(self, payload_size):
+        if self._writer is not None:
+            self._writer.mapped.flush()
+            self._writer = None
+            self._collect()
+        size = max(self.segment_size, SEGMENT_HEADER.size + RECORD_HEADER.size + payload_size)
+        if self._bytes + size > self.max_bytes:
+            return False
+        try:
+            self._writer = SpillSegment.create(self.directory, size)
+        except OSError as e:
+            logger.warning(f"Error creating spill segment in {self.directory}: {str(e)}")
+            return False
+        self._segments.append(self._writer)
+        self._bytes += size
+        return True
+
+    def get(self, max_count, max_bytes):
+        """Take up to max_count events, oldest first, as (SpilledEvent, size) pairs"""
+        events = []
+        with self._lock:
+            for segment in self._segments:
+                if len(events) >= max_count:
+                    break
+                if segment.exhausted():
+                    # Read entirely, but events are still in flight
+                    continue
+                records = segment.read(max_count - len(events), max_bytes)
+                events.extend((record, len(record.payload)) for record in records)
+                max_bytes -= sum(len(record.payload) for record in records)
+                if not segment.exhausted():
+                    break
+            self._count -= len(events)
+        return events
+
+    def ack(self, events):
+        """Acknowledge SpilledEvents taken with get once they were sent, spilled again or given up on"""
+        with self._lock:
+            for event in events:
+                event.segment.ack(event.offset)
+            self._collect()
+
+    def _collect(self):
+        # Delete the segments which were read and acknowledged entirely, except the one being written
+        while self._segments and self._segments[0].consumed() and self._segments[0] is not self._writer:
+            segment = self._segments.popleft()
+            self._bytes -= segment.size
+            segment.close(delete=True)
+
+    def qsize(self):
+        return self._count
+
+    def empty(self):
+        return not self._count
+
+    def close(self):
+        """Flush the segments to disk, the events still spilled are replayed by the next process"""
+        with self._lock:
+            segments, self._segments = self._segments, collections.deque()
+            self._writer = None
+            for segment in segments:
+                try:
+                    segment.close(delete=segment.consumed())
+                except Exception as e:
+                    logger.warning(f"Error closing spill segment {segment.path}: {str(e)}")
+            self._bytes = 0
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "spilled_events": self._spilled,
+                "spill_replayed_events": self._replayed,
+                "spill_rejected_events": self._rejected,
+                "spill_queued_events": self._count,
+                "spill_bytes": self._bytes,
+            }
@@ -0,0 +1,44 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class StreamingResponse(object):
+    """
+    Wraps the response iterable returned by the app. Chunks are passed to the
+    server as soon as the app yields them, while a bounded copy is kept on the
+    DataHolder. Once the stream is exhausted or closed, the on_finish callback is
+    invoked exactly once so the event can be built.
+    """
+    def __init__(self, original, event_info, on_finish):
+        self.original = original
+        self.event_info = event_info
+        self.on_finish = on_finish
+        self._finished = False
+
+    def __iter__(self):
+        for chunk in self.original:
+            self.event_info.capture_response_chunk(chunk)
+            yield chunk
+        self._finish()
+
+    def close(self):
+        try:
+            if hasattr(self.original, 'close'):
+                self.original.close()
+        finally:
+            self._finish()
+
+    def _finish(self):
+        if self._finished:
+            return
+        self._finished = True
+        try:
+            self.event_info.finish_response()
+            self.on_finish()
+        except Exception as e:
+            logger.exception(f"Error while finishing the response: {str(e)}")
+
+    def __getattr__(self, name):
+        # Delegate attribute access to the original response
+        return getattr(self.original, name)
@@ -1,123 +1,704 @@
+import asyncio
+import collections
 import math
 import queue
 import threading
 import time
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.interval import IntervalTrigger
+from moesifapi.exceptions.api_exception import APIException
 from moesifwsgi.logger_helper import LoggerHelper
+from moesifwsgi.metrics import BATCH_BYTES_BUCKETS, BATCH_EVENTS_BUCKETS, SECONDS_BUCKETS, MetricsRegistry
+from moesifwsgi.retry import CircuitBreaker, CircuitOpenError
+from moesifwsgi.spill_queue import SpilledEvent
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Weight of the latest measurement in the smoothed arrival rate of the batcher
+ARRIVAL_RATE_SMOOTHING = 0.2
+# Multiple of the expected fill time a partial batch lingers for
+LINGER_HEADROOM = 2
+# Seconds between two checks of the worker autoscaler
+AUTOSCALE_INTERVAL = 1
+# Share of their time the workers should spend on batches, the number of workers needed is estimated from it
+AUTOSCALE_TARGET_UTILIZATION = 0.7
+# Weight of the latest check in the smoothed number of workers needed and send latency
+AUTOSCALE_SMOOTHING = 0.3
+# Seconds in which the workers added for queued batches should send them
+AUTOSCALE_BACKLOG_TIME = 5
+# Number of the latest scaling decisions reported by get_stats
+AUTOSCALE_HISTORY = 20
+# Events the event queue had no room for, waiting for the Spiller to write them to disk
+SPILL_BUFFER_SIZE = 10000
+
+class EventBuffer(object):
+    """
+    Bounded buffer between the request threads and the batcher. Request threads append events to
+    a deque under a single lock, and the batcher swaps out the whole deque at once instead of taking
+    the queue locks once per event. Each event is kept with its estimated size in bytes, and the
+    batcher is only woken once enough events or bytes for a batch are waiting.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._events = collections.deque()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        # Number of buffered events or bytes which wakes the batcher
+        self._wanted = None
+        self._wanted_bytes = None
+
+    def put(self, item, size=0):
+        # Do not block and return immediately, True if successful, False if the buffer is full
+        with self._lock:
+            if len(self._events) >= self.max_size:
+                return False
+            self._events.append((item, size))
+            self._bytes += size
+            if self._wanted is not None and (len(self._events) == self._wanted or
+                                             self._bytes - size < self._wanted_bytes <= self._bytes):
+                self._ready.notify()
+            return True
+
+    def drain(self, wanted, wanted_bytes, timeout):
+        """Wait up to timeout for wanted events or bytes to be buffered, then take all of the buffered events"""
+        with self._lock:
+            if len(self._events) < wanted and self._bytes < wanted_bytes and timeout > 0:
+                self._wanted = wanted
+                self._wanted_bytes = wanted_bytes
+                self._ready.wait(timeout)
+                self._wanted = None
+                self._wanted_bytes = None
+            events = self._events
+            self._events = collections.deque()
+            self._bytes = 0
+        return events
+
+    def interrupt(self):
+        with self._lock:
+            self._ready.notify_all()
+
+    def qsize(self):
+        return len(self._events)
+
+    def empty(self):
+        return not self._events
+
+
 class Batcher(threading.Thread):
     """
     A class used for batching events. This runs in a single background thread,
-    and consumes events from the input queue, executes batch size and maximum
+    and consumes events from the input buffer, executes batch size and maximum
     wait time constraints and puts batches of events into the batch queue for
     the worker threads to consume.
+
+    A batch is full once it holds batch_size events or max_batch_bytes of estimated event size,
+    and an event larger than max_batch_bytes is sent in a batch of its own.
+    Full batches are put in the batch queue as soon as they are available. A partial batch
+    lingers for the time the measured arrival rate needs to fill it, up to the timeout, so
+    light traffic is still batched while heavier traffic is not held back.
+
+    Events spilled to disk are read back to top up batches the input buffer doesn't fill,
+    as long as can_drain_spill allows it, so live traffic is batched first.
     """
-    def __init__(self, event_queue, batch_queue, batch_size, timeout, debug):
+    def __init__(self, event_queue, batch_queue, batch_size, timeout, debug, max_batch_bytes=None, spill_queue=None,
+                 can_drain_spill=None):
         super().__init__(daemon=True)
         logger.debug("Initializing Batcher")
-        self.event_queue = event_queue # input queue
+        self.event_queue = event_queue # input buffer
         self.batch_queue = batch_queue # output queue
         # batch_size is used to control how many events are in a batch maximum
         self.batch_size = batch_size
-        # timeout is used to control how long the batcher will wait for the next event
+        # max_batch_bytes is used to control the estimated size of a batch maximum
+        self.max_batch_bytes = max_batch_bytes or float('inf')
+        # timeout is used to control how long the batcher will wait for a batch to fill
         self.timeout = timeout
         self.debug = debug
+        self.spill_queue = spill_queue
+        self.can_drain_spill = can_drain_spill
+        # Smoothed number of events added per second
+        self.arrival_rate = 0.0
+        self._last_drain_time = time.monotonic()
         self._stop_event = threading.Event()
 
     def stop(self):
         self._stop_event.set()
+        self.event_queue.interrupt()
 
     def run(self):
-        # Continue to consume the input queue until stop event is set
+        # Events waiting to be batched, with their estimated sizes
+        pending = collections.deque()
+        self._pending_bytes = 0
+        batch_started = time.monotonic()
+        # Continue to consume the input buffer until stop event is set
         while not self._stop_event.is_set():
             try:
-                batch = self._create_batch(block=True)
-                if batch:
-                    logger.debug("Putting batch in queue")
-                    self.batch_queue.put(batch)
-            except Exception as e:
-                logger.exception(f"Exception occurred in Batcher thread. {str(e)}")
-                continue
+                linger = self._linger_time(len(pending)) - (time.monotonic() - batch_started)
+                draining_spill = self._draining_spill()
+                if draining_spill:
+                    # Don't wait for the input buffer while there are spilled events to send
+                    linger = 0
+                events = self.event_queue.drain(self.batch_size - len(pending),
+                                                self.max_batch_bytes - self._pending_bytes, linger)
+                now = time.monotonic()
+                self._update_arrival_rate(len(events), now)
+                if draining_spill and len(pending) + len(events) < self.batch_size:
+                    events.extend(self.spill_queue.get(
+                        self.batch_size - len(pending) - len(events),
+                        self.max_batch_bytes - self._pending_bytes - sum(size for _, size in events)))
+                if not pending and not events:
+                    batch_started = now
+                    continue
+                pending.extend(events)
+                self._pending_bytes += sum(size for _, size in events)
 
-        # After stop event is set, continue to drain the input queue until it's empty
-        self.timeout = 0
-        while not self.event_queue.empty():
-            try:
-                batch = self._create_batch(block=False)
-                if batch:
-                    self.batch_queue.put(batch)
+                # Flush full batches immediately
+                while len(pending) >= self.batch_size or self._pending_bytes >= self.max_batch_bytes:
+                    self._put_batch(pending)
+                    batch_started = now
+                # Flush the partial batch once it lingered long enough
+                if pending and now - batch_started >= self._linger_time(len(pending)):
+                    self._put_batch(pending)
+                if not pending:
+                    batch_started = now
             except Exception as e:
                 logger.exception(f"Exception occurred in Batcher thread. {str(e)}")
                 continue
 
-    def _create_batch(self, block):
+        # After stop event is set, drain the input buffer until it's empty
+        try:
+            events = self.event_queue.drain(0, 0, 0)
+            pending.extend(events)
+            self._pending_bytes += sum(size for _, size in events)
+            while pending:
+                self._put_batch(pending)
+        except Exception as e:
+            logger.exception(f"Exception occurred in Batcher thread. {str(e)}")
+
+    def _draining_spill(self):
+        return (self.spill_queue is not None and not self.spill_queue.empty() and
+                (self.can_drain_spill is None or self.can_drain_spill()))
+
+    def _put_batch(self, pending):
         batch = []
-        start_time = time.time()
-        max_wait = self.timeout
-        # Continue to consume the input queue until the batch is full or the batcher has been waiting for too long
-        while len(batch) < self.batch_size and max_wait > 0:
+        batch_bytes = 0
+        while pending and len(batch) < self.batch_size:
+            size = pending[0][1]
+            # An event over the budget on its own still makes a batch of one
+            if batch and batch_bytes + size > self.max_batch_bytes:
+                break
+            batch.append(pending.popleft()[0])
+            batch_bytes += size
+        self._pending_bytes -= batch_bytes
+        if self.debug:
+            logger.debug(f"Putting batch of {len(batch)} events in queue")
+        self.batch_queue.put(batch)
+
+    def _update_arrival_rate(self, count, now):
+        interval = now - self._last_drain_time
+        self._last_drain_time = now
+        if interval > 0:
+            self.arrival_rate += ARRIVAL_RATE_SMOOTHING * (count / interval - self.arrival_rate)
+
+    def _linger_time(self, pending_count):
+        # Wait for the time the arrival rate needs to fill the batch, with some headroom, capped by the timeout
+        if self.arrival_rate <= 0 or not pending_count:
+            return self.timeout
+        fill_time = (self.batch_size - pending_count) / self.arrival_rate
+        return min(self.timeout, LINGER_HEADROOM * fill_time)
+
+
+class Spiller(threading.Thread):
+    """
+    Writes the events the event queue had no room for to the spill queue. This runs in a single
+    background thread, so the request threads only append the raw capture record to a bounded
+    buffer, and the event is built, serialized and written to disk here.
+    """
+    def __init__(self, spill_queue, event_sender, build_event, max_size=SPILL_BUFFER_SIZE):
+        super().__init__(daemon=True)
+        self.spill_queue = spill_queue
+        self.event_sender = event_sender
+        self.build_event = build_event
+        self.buffer = EventBuffer(max_size)
+        self._stop_event = threading.Event()
+
+    def add_event(self, event, size=0):
+        """Do not block and return immediately, True if successful, False if the buffer is full"""
+        return self.buffer.put(event, size)
+
+    def stop(self):
+        self._stop_event.set()
+        self.buffer.interrupt()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.spill(self.buffer.drain(1, 1, 1))
+        # Events left in the buffer are written before the spill queue is closed
+        self.spill(self.buffer.drain(0, 0, 0))
+
+    def spill(self, events):
+        for event, _ in events:
             try:
-                # If block is True, this will block until the next event is available which is the default behavior we want
-                # this is the primary wait loop which aggregates events into a batch and enforces the max wait time
-                # if block is False, this will return immediately when the input queue is empty, and this is used during shutdown
-                item = self.event_queue.get(block=block, timeout=max_wait)
-                batch.append(item)
-                logger.debug(f"Got event from queue {str(item.request.uri)}")
-            except queue.Empty:
-                pass
-            # Calculate the max wait time for the next event in the batch based on the timeout
-            max_wait = self.timeout - (time.time() - start_time)
-        return batch
+                if not isinstance(event, bytes):
+                    event = self.event_sender.serialize_event(self.build_event(event))
+                self.spill_queue.put(event)
+            except Exception as ex:
+                logger.exception(f"Error spilling event to disk. {str(ex)}")
 
 
 class Worker(threading.Thread):
     """
     A class used for sending events to Moesif asynchronously. This runs in a pool of
-    background threads, and consumes batches of events from the batch queue.
+    background threads, and consumes batches of raw capture records from the batch queue.
+    Each record is turned into an event model with build_event before the batch is sent.
+    Events spilled to disk are already serialized. Batches which could not be sent because
+    Moesif is unavailable are spilled to disk if a spill queue is given, until their events
+    failed to be sent max_attempts times. Events read back from disk are only acknowledged
+    to the spill queue once they were sent, spilled again or given up on.
+
+    Once stopped, a worker sends the batches left in the queue without retrying them, then exits.
+    The time spent on batches is accounted for the WorkerAutoscaler. A retired worker exits
+    after the batch it's sending, without abandoning its retries as stop does.
     """
-    def __init__(self, queue, api_client, config, debug):
+    def __init__(self, queue, event_sender, config, debug, build_event, spill_queue=None, metrics=None):
         super().__init__(daemon=True)
         logger.debug("Initializing Worker")
         self.queue = queue
-        self.api_client = api_client
+        self.event_sender = event_sender
         self.config = config
         self.debug = debug
+        self.build_event = build_event
+        self.spill_queue = spill_queue
         self.logger_helper = LoggerHelper()
+        metrics = metrics or MetricsRegistry()
+        self.batch_events = metrics.histogram('batch_events', "Events per batch sent", BATCH_EVENTS_BUCKETS)
+        self.batch_bytes = metrics.histogram('batch_bytes', "Serialized size of the batches sent, before compression",
+                                             BATCH_BYTES_BUCKETS)
+        self.send_seconds = metrics.histogram('send_seconds', "Time taken to send a batch, retries included",
+                                              SECONDS_BUCKETS)
+        self.send_errors = metrics.counter('send_errors', "Batches which failed to be sent, by error",
+                                           label='error')
         # stop_event is used to signal the worker to stop during graceful shutdown
         self._stop_event = threading.Event()
+        self._retired = False
+        # Seconds spent on the batches finished so far, and when the current batch was taken
+        self.busy_time = 0.0
+        self.busy_since = None
+        self.batches_done = 0
 
     def stop(self):
         self._stop_event.set()
 
+    def retire(self):
+        self._retired = True
+
     def run(self):
-        while not self._stop_event.is_set():  # Check if the stop event is set
+        while not self._retired:
             try:
                 # blocking here until a batch is available is the desired behavior
-                batch = self.queue.get(block=True, timeout=1)
-                if batch:
-                    self.send_events(batch)
-                    self.queue.task_done()
+                batch = self.queue.get(block=not self._stop_event.is_set(), timeout=1)
             except queue.Empty:
+                # The batcher is stopped first, so the queue is complete once the worker is stopped
+                if self._stop_event.is_set():
+                    break
                 continue
+            try:
+                if batch:
+                    self.busy_since = time.monotonic()
+                    try:
+                        batch_events, spilled = self.build_events(batch)
+                        if batch_events:
+                            self.send_events(batch_events, spilled)
+                    finally:
+                        self.busy_time += time.monotonic() - self.busy_since
+                        self.busy_since = None
+                        self.batches_done += 1
             except Exception as e:
                 logger.exception(f"Exception occurred in Worker thread. {str(e)}")
+            finally:
+                # Counted as done even if it failed, so stop doesn't wait for it forever
+                self.queue.task_done()
+
+    def build_events(self, batch):
+        """The serialized events of the batch, and the SpilledEvents among them, whose payloads are put last"""
+        # Each event is serialized as soon as it's built, so only one event model is alive at a time
+        batch_events = []
+        spilled = []
+        for data in batch:
+            if isinstance(data, SpilledEvent):
+                spilled.append(data)
+                continue
+            if isinstance(data, bytes):
+                batch_events.append(data)
                 continue
+            try:
+                event = self.event_sender.serialize_event(self.build_event(data))
+                if self.debug:
+                    logger.debug(f"Event built: {event.decode('utf-8')}")
+                batch_events.append(event)
+            except Exception as ex:
+                logger.exception(f"Error building event for {str(data.url)}. {str(ex)}")
+        batch_events.extend(event.payload for event in spilled)
+        return batch_events, spilled
 
-    def send_events(self, batch_events):
+    def send_events(self, batch_events, spilled=()):
+        started = time.monotonic()
         try:
             logger.debug("Sending events to Moesif")
-            batch_events_api_response = self.api_client.create_events_batch(batch_events)
-            # Update the configuration if necessary
-            etag = batch_events_api_response.get("X-Moesif-Config-ETag")
-            self.config.check_and_update(etag)
-            if self.debug:
-                logger.debug("Events sent successfully to Moesif")
+            # Retries are abandoned when the worker is stopped
+            response_headers = self.event_sender.send(batch_events, self._stop_event)
+            self.record_batch(batch_events, started)
+            self.on_events_sent(response_headers)
         except Exception as ex:
-            logger.exception(f"Error sending event to Moesif. {str(ex)}")
+            self.on_send_error(batch_events, ex, spilled)
+        finally:
+            self.ack_spilled(spilled)
+
+    def record_batch(self, batch_events, started):
+        self.send_seconds.observe(time.monotonic() - started)
+        self.batch_events.observe(len(batch_events))
+        self.batch_bytes.observe(sum(len(event) for event in batch_events))
+
+    def on_events_sent(self, batch_events_api_response):
+        # Update the configuration if necessary
+        etag = batch_events_api_response.get("X-Moesif-Config-ETag")
+        if self.config is not None:
+            self.config.check_and_update(etag)
+        if self.debug:
+            logger.debug("Events sent successfully to Moesif")
+
+    def on_send_error(self, batch_events, ex, spilled=()):
+        # Responses rejected by Moesif are counted by their status code
+        self.send_errors.inc(label_value=f"HTTP {ex.response_code}" if isinstance(ex, APIException)
+                             else type(ex).__name__)
+        if isinstance(ex, CircuitOpenError):
+            # The batch wasn't sent, so it's not counted as an attempt
+            if not self.spill_batch(batch_events, spilled, failed=False):
+                logger.info(f"Dropped batch of {len(batch_events)} events. {str(ex)}")
+            return
+        logger.exception(f"Error sending event to Moesif. {str(ex)}")
+        if self.event_sender.is_retryable(ex)[0]:
+            self.spill_batch(batch_events, spilled)
+
+    def spill_batch(self, batch_events, spilled=(), failed=True):
+        """
+        Spill a batch Moesif was unavailable for to disk, so it's sent once Moesif is available again.
+        The events which failed to be sent max_attempts times are dropped instead. spilled are the
+        SpilledEvents the last events of the batch were read from.
+        """
+        if self.spill_queue is None:
+            return False
+        attempts = [0] * (len(batch_events) - len(spilled)) + [event.attempts for event in spilled]
+        spill_count = given_up = 0
+        for event, event_attempts in zip(batch_events, attempts):
+            if failed:
+                event_attempts += 1
+            if event_attempts >= self.spill_queue.max_attempts:
+                given_up += 1
+            elif self.spill_queue.put(event, event_attempts):
+                spill_count += 1
+        if given_up:
+            logger.warning(f"Dropped {given_up} events which failed to be sent {self.spill_queue.max_attempts} times")
+        logger.info(f"Spilled {spill_count} of {len(batch_events)} events to disk")
+        return spill_count == len(batch_events)
+
+    def ack_spilled(self, spilled):
+        # Only once the events were sent, spilled again or given up on, so a crash before replays them
+        if spilled:
+            self.spill_queue.ack(spilled)
+
+
+class AsyncBatchQueue(object):
+    """
+    Batch queue between the batcher thread and the event loop of the AsyncShipper. The batcher
+    blocks while maxsize batches are queued or in flight, and wakes up the event loop when it
+    puts a batch.
+    """
+    def __init__(self, maxsize):
+        self._batches = collections.deque()
+        self._slots = threading.Semaphore(maxsize)
+        self._unfinished = 0
+        self._all_done = threading.Condition()
+        # Set by the shipper once its event loop is running
+        self.wakeup = None
+
+    def put(self, batch):
+        self._slots.acquire()
+        with self._all_done:
+            self._unfinished += 1
+        self._batches.append(batch)
+        wakeup = self.wakeup
+        if wakeup is not None:
+            wakeup()
+
+    def get_nowait(self):
+        # Raises IndexError if empty
+        return self._batches.popleft()
+
+    def task_done(self):
+        self._slots.release()
+        with self._all_done:
+            self._unfinished -= 1
+            if not self._unfinished:
+                self._all_done.notify_all()
+
+    def qsize(self):
+        return len(self._batches)
+
+    def join(self):
+        with self._all_done:
+            while self._unfinished:
+                self._all_done.wait()
+
+
+class AsyncShipper(Worker):
+    """
+    Worker sending up to concurrency batches at once from a single thread running an asyncio event
+    loop, over the non-blocking connections of an AsyncHttpClient, instead of a thread per batch
+    in flight. Batches are retried with the policy of the event sender, without blocking the loop.
+    """
+    def __init__(self, queue, event_sender, config, debug, build_event, spill_queue, concurrency, http_client,
+                 metrics=None):
+        super().__init__(queue, event_sender, config, debug, build_event, spill_queue, metrics)
+        self.concurrency = concurrency
+        self.http_client = http_client
+        self.loop = None
+        self._stopping = None
+        self._wakeup = None
+
+    def stop(self):
+        super().stop()
+        loop = self.loop
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(self._set_stopping)
+            except RuntimeError:
+                # The loop already finished
+                pass
+
+    def _set_stopping(self):
+        # Not created yet if ship hasn't started, it then sees the stop event is set
+        if self._stopping is not None:
+            self._stopping.set()
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.loop.run_until_complete(self.ship())
+        except Exception as e:
+            logger.exception(f"Exception occurred in AsyncShipper thread. {str(e)}")
+        finally:
+            self.queue.wakeup = None
+            self.http_client.close()
+            self.loop.close()
+
+    async def ship(self):
+        self._stopping = asyncio.Event()
+        self._wakeup = asyncio.Event()
+        self.queue.wakeup = lambda: self.loop.call_soon_threadsafe(self._wakeup.set)
+        if self._stop_event.is_set():
+            self._stopping.set()
+        in_flight = set()
+        slots = asyncio.Semaphore(self.concurrency)
+        while True:
+            try:
+                batch = self.queue.get_nowait()
+            except IndexError:
+                # The batcher is stopped first, so the queue is complete once the shipper is stopped
+                if self._stop_event.is_set():
+                    break
+                self._wakeup.clear()
+                if not self.queue.qsize():
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), 1)
+                    except asyncio.TimeoutError:
+                        pass
+                continue
+            await slots.acquire()
+            task = self.loop.create_task(self.ship_batch(batch, slots))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+        if in_flight:
+            await asyncio.gather(*in_flight)
+
+    async def ship_batch(self, batch, slots):
+        try:
+            batch_events, spilled = self.build_events(batch)
+            if batch_events:
+                started = time.monotonic()
+                try:
+                    logger.debug("Sending events to Moesif")
+                    response_headers = await self.send(batch_events)
+                    self.record_batch(batch_events, started)
+                    self.on_events_sent(response_headers)
+                except Exception as ex:
+                    self.on_send_error(batch_events, ex, spilled)
+                finally:
+                    self.ack_spilled(spilled)
+        except Exception as e:
+            logger.exception(f"Exception occurred in AsyncShipper thread. {str(e)}")
+        finally:
+            slots.release()
+            self.queue.task_done()
+
+    async def send(self, batch_events):
+        """The retry loop of EventSender.send, waiting for retries without blocking the event loop"""
+        payload, headers = self.event_sender.build_payload(batch_events)
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            self.event_sender.check_circuit()
+            try:
+                request = self.event_sender.prepare_request(payload, headers)
+                return self.event_sender.complete_request(request, await self.http_client.execute(request))
+            except Exception as e:
+                delay = self.event_sender.retry_delay(e, attempt, started)
+                if delay is None:
+                    raise
+                attempt += 1
+                # Retries are abandoned when the shipper is stopped
+                if await self._stopped_within(delay):
+                    self.event_sender.count_failed()
+                    raise
+
+    async def _stopped_within(self, delay):
+        try:
+            await asyncio.wait_for(self._stopping.wait(), delay)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+
+class WorkerAutoscaler(threading.Thread):
+    """
+    Scales the worker threads of a BatchedWorkerPool between min_count and max_count. Every
+    AUTOSCALE_INTERVAL seconds, the number of workers needed is estimated from the time the
+    workers spent sending batches, which is the send latency times the batches sent, so the
+    workers are busy AUTOSCALE_TARGET_UTILIZATION of the time. While batches are queued beyond the
+    workers, enough workers are added on top to send them within AUTOSCALE_BACKLOG_TIME seconds,
+    and at least one is added if events were dropped since the last check.
+
+    Workers are added as soon as the latest check needs them, and retired one at a time once the
+    smoothed estimate has needed fewer for scale_down_delay seconds, at most one per scale_down_delay,
+    so bursts don't make the pool flap. No workers are added while the circuit breaker isn't closed,
+    as retries don't need more workers.
+    """
+    def __init__(self, pool, min_count, max_count, scale_down_delay):
+        super().__init__(daemon=True)
+        self.pool = pool
+        self.min_count = min_count
+        self.max_count = max_count
+        self.scale_down_delay = scale_down_delay
+        # Smoothed number of workers needed, and seconds to send a batch
+        self.demand = float(min_count)
+        self.send_latency = None
+        self.scale_ups = 0
+        self.scale_downs = 0
+        self.decisions = collections.deque(maxlen=AUTOSCALE_HISTORY)
+        self._lock = threading.Lock()
+        self._last_check = time.monotonic()
+        self._last_dropped = 0
+        # Busy time, and send time and batches finished, of each worker at the last check
+        self._last_totals = {}
+        self._idle_since = None
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        while not self._stop_event.wait(AUTOSCALE_INTERVAL):
+            try:
+                self.check()
+            except Exception as e:
+                logger.exception(f"Exception occurred in WorkerAutoscaler thread. {str(e)}")
+
+    def check(self):
+        now = time.monotonic()
+        interval = now - self._last_check
+        self._last_check = now
+        if interval <= 0:
+            return
+        busy, send_time, batches = self._measure(now)
+        needed = busy / interval / AUTOSCALE_TARGET_UTILIZATION
+        self.demand += AUTOSCALE_SMOOTHING * (needed - self.demand)
+        if batches:
+            latency = send_time / batches
+            self.send_latency = latency if self.send_latency is None else (
+                self.send_latency + AUTOSCALE_SMOOTHING * (latency - self.send_latency))
+        dropped = self.pool.dropped_events - self._last_dropped
+        self._last_dropped = self.pool.dropped_events
+        queued = self.pool.batch_queue.qsize()
+
+        count = len(self.pool.workers)
+        wanted = math.ceil(max(needed, self.demand))
+        reason = f"{max(needed, self.demand):.1f} workers needed at {AUTOSCALE_TARGET_UTILIZATION:.0%} busy"
+        if queued > count:
+            backlog = math.ceil(queued * (self.send_latency or 0) / AUTOSCALE_BACKLOG_TIME)
+            wanted = max(wanted, count + max(backlog, 1))
+            reason = f"{queued} batches queued"
+        if dropped:
+            wanted = max(wanted, count + 1)
+            reason = f"{dropped} events dropped"
+        wanted = min(max(wanted, self.min_count), self.max_count)
+
+        if wanted > count:
+            self._idle_since = None
+            if self.pool.event_sender.circuit_breaker.state == CircuitBreaker.CLOSED:
+                self._scale(count, wanted, reason)
+        elif wanted < count and not queued and not dropped:
+            if self._idle_since is None:
+                self._idle_since = now
+            elif now - self._idle_since >= self.scale_down_delay:
+                self._scale(count, count - 1, reason)
+                # The next worker is only retired after another scale_down_delay
+                self._idle_since = now
+        else:
+            self._idle_since = None
+
+    def _measure(self, now):
+        """The seconds the workers were busy since the last check, and the send time and number of the batches they finished"""
+        busy = send_time = 0.0
+        batches = 0
+        totals = {}
+        for worker in self.pool.workers + self.pool.retired_workers:
+            batches_done = worker.batches_done
+            busy_time = worker.busy_time
+            busy_since = worker.busy_since
+            # Including the time spent on the batch in progress
+            total_busy = busy_time + (now - busy_since if busy_since is not None else 0.0)
+            last_busy, last_send_time, last_batches = self._last_totals.get(worker, (0.0, 0.0, 0))
+            busy += total_busy - last_busy
+            send_time += busy_time - last_send_time
+            batches += batches_done - last_batches
+            totals[worker] = (total_busy, busy_time, batches_done)
+        self._last_totals = totals
+        return max(busy, 0.0), max(send_time, 0.0), max(batches, 0)
+
+    def _scale(self, count, wanted, reason):
+        if wanted > count:
+            self.pool.add_workers(wanted - count)
+            self.scale_ups += 1
+        else:
+            self.pool.retire_workers(count - wanted)
+            self.scale_downs += 1
+        logger.info(f"Scaled workers from {count} to {wanted}, {reason}")
+        with self._lock:
+            self.decisions.append({"time": time.time(), "from": count, "to": wanted, "reason": reason})
+
+    def get_stats(self):
+        with self._lock:
+            decisions = list(self.decisions)
+        return {
+            "worker_count_min": self.min_count,
+            "worker_count_max": self.max_count,
+            "worker_scale_ups": self.scale_ups,
+            "worker_scale_downs": self.scale_downs,
+            "workers_needed": self.demand,
+            "send_latency_seconds": self.send_latency,
+            "worker_scaling_decisions": decisions,
+        }
 
 
 class BatchedWorkerPool:
@@ -125,56 +706,151 @@ class BatchedWorkerPool:
     A class used for managing a pool of workers and a batcher. This class is
     responsible for starting and stopping the workers and the batcher, and
     for adding events to the event queue.
+
+    With a spill queue, events which don't fit in the event queue are handed to a Spiller,
+    which serializes them and writes them to disk instead of them being dropped.
+
+    With an async_http_client, a single AsyncShipper sends up to async_concurrency batches at
+    once instead of the worker threads.
+
+    With a max_worker_count above worker_count, a WorkerAutoscaler scales the worker threads
+    between the two as needed.
     """
-    def __init__(self, worker_count, api_client, config, debug, max_queue_size, batch_size, timeout):
+    def __init__(self, worker_count, event_sender, config, debug, max_queue_size, batch_size, timeout, build_event,
+                 max_batch_bytes=None, spill_queue=None, async_http_client=None, async_concurrency=8,
+                 max_worker_count=None, scale_down_delay=30, metrics=None):
         logger.debug("Initializing BatchedWorkerPool")
-        self.event_queue = queue.Queue(maxsize=max_queue_size)
-        self.batch_queue = queue.Queue(maxsize=math.ceil(max_queue_size / batch_size))
+        self.event_queue = EventBuffer(max_queue_size)
+        if async_http_client is not None:
+            self.batch_queue = AsyncBatchQueue(math.ceil(max_queue_size / batch_size))
+        else:
+            self.batch_queue = queue.Queue(maxsize=math.ceil(max_queue_size / batch_size))
         self.batch_size = batch_size
+        self.max_batch_bytes = max_batch_bytes
         self.timeout = timeout
         self.worker_count = worker_count
-        self.api_client = api_client
+        self.event_sender = event_sender
         self.config = config
         self.debug = debug
+        self.build_event = build_event
+        self.spill_queue = spill_queue
+        self.async_http_client = async_http_client
+        # Events add_event could neither queue nor spill
+        self.dropped_events = 0
+        self.metrics = metrics or MetricsRegistry()
 
         # Start batcher
-        self.batcher = Batcher(self.event_queue, self.batch_queue, self.batch_size, self.timeout, self.debug)
+        self.batcher = Batcher(self.event_queue, self.batch_queue, self.batch_size, self.timeout, self.debug,
+                               self.max_batch_bytes, self.spill_queue, self.event_sender.circuit_breaker.is_available)
         self.batcher.start()
 
+        # Events spilled to disk are built and written off the request threads
+        self.spiller = None
+        if self.spill_queue is not None:
+            self.spiller = Spiller(self.spill_queue, self.event_sender, self.build_event)
+            self.spiller.start()
+
         # Start workers
         self.workers = []
-        for _ in range(self.worker_count):
-            worker = Worker(self.batch_queue, self.api_client, self.config, self.debug)
-            worker.start()
-            self.workers.append(worker)
+        # Workers finishing their last batch after being scaled down
+        self.retired_workers = []
+        self._workers_lock = threading.Lock()
+        self.autoscaler = None
+        self.register_gauges()
+        if self.async_http_client is not None:
+            shipper = AsyncShipper(self.batch_queue, self.event_sender, self.config, self.debug, self.build_event,
+                                   self.spill_queue, async_concurrency, self.async_http_client, self.metrics)
+            shipper.start()
+            self.workers.append(shipper)
+            return
+        self.add_workers(self.worker_count)
+        if max_worker_count is not None and max_worker_count > self.worker_count:
+            self.autoscaler = WorkerAutoscaler(self, self.worker_count, max_worker_count, scale_down_delay)
+            self.autoscaler.start()
+
+    def register_gauges(self):
+        self.metrics.gauge('event_queue_events', "Events in the event queue", self.event_queue.qsize)
+        self.metrics.gauge('batch_queue_batches', "Batches waiting for a worker", self.batch_queue.qsize)
+        self.metrics.gauge('workers', "Threads sending batches", lambda: len(self.workers))
+        if self.spill_queue is not None:
+            self.metrics.gauge('spill_queue_events', "Events spilled to disk", self.spill_queue.qsize)
+
+    def add_workers(self, count):
+        with self._workers_lock:
+            for _ in range(count):
+                worker = Worker(self.batch_queue, self.event_sender, self.config, self.debug, self.build_event,
+                                self.spill_queue, self.metrics)
+                worker.start()
+                # Copied so other threads can iterate the workers without the lock
+                self.workers = self.workers + [worker]
+
+    def retire_workers(self, count):
+        with self._workers_lock:
+            retired = self.workers[len(self.workers) - count:]
+            self.workers = self.workers[:len(self.workers) - count]
+            self.retired_workers = [worker for worker in self.retired_workers if worker.is_alive()] + retired
+        for worker in retired:
+            worker.retire()
 
-    def add_event(self, event):
-        # Add event to the event queue if it's not full
+    def add_event(self, event, size=0):
+        # Add event and its estimated size in bytes to the event buffer if it's not full
         # do not block and return immediately, True if successful, False if not
-        try:
-            self.event_queue.put(event, block=False)
+        if self.event_queue.put(event, size):
             return True
-        except queue.Full:
-            return False
+        if self.spiller is not None and self.spiller.add_event(event, size):
+            return True
+        self.dropped_events += 1
+        return False
+
+    def occupancy(self):
+        """Share of the event queue in use, from 0 to 1"""
+        return self.event_queue.qsize() / self.event_queue.max_size
+
+    def get_stats(self):
+        stats = self.event_sender.get_stats()
+        if self.async_http_client is not None:
+            stats.update(self.async_http_client.get_stats())
+        stats["queued_events"] = self.event_queue.qsize()
+        stats["queued_batches"] = self.batch_queue.qsize()
+        stats["worker_count"] = len(self.workers)
+        if self.autoscaler is not None:
+            stats.update(self.autoscaler.get_stats())
+        if self.spill_queue is not None:
+            stats.update(self.spill_queue.get_stats())
+        return stats
 
     def stop(self):
         logging.debug("Stopping BatchedWorkerPool")
+        if self.autoscaler is not None:
+            self.autoscaler.stop()
+            self.autoscaler.join()
+            self.autoscaler = None
+
         if self.batcher:
             self.batcher.stop()
             self.batcher.join()
 
-        for worker in self.workers:
+        for worker in self.workers + self.retired_workers:
             worker.stop()
 
         # Wait for all tasks in the queue to be processed
         self.batch_queue.join()
 
-        for worker in self.workers:
+        for worker in self.workers + self.retired_workers:
             worker.join()
 
+        # Events left on disk are replayed by the next process
+        if self.spiller is not None:
+            self.spiller.stop()
+            self.spiller.join()
+            self.spiller = None
+        if self.spill_queue is not None:
+            self.spill_queue.close()
+
         # Clear workers
         self.batcher = None
         self.workers = []
+        self.retired_workers = []
 
 
 class ConfigJobScheduler:
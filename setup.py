@@ -105,4 +105,11 @@ setup(
         'test': ['nose'],
     },
 
+    # Collector receiving the events of the processes of a host, see COLLECTOR_SOCKET
+    entry_points={
+        'console_scripts': [
+            'moesif-collector=moesifwsgi.collector:main',
+        ],
+    },
+
 )
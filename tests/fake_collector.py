@@ -0,0 +1,152 @@
+import gzip
+import io
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from wsgiref.util import setup_testing_defaults
+
+
+class RecordedRequest(object):
+    def __init__(self, method, path, headers, raw_body, chunked):
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.raw_body = raw_body
+        self.chunked = chunked
+
+    @property
+    def body(self):
+        if self.headers.get('Content-Encoding') == 'gzip':
+            return gzip.decompress(self.raw_body)
+        return self.raw_body
+
+
+class FakeCollector(object):
+    """
+    Local stand-in for the Moesif API. Serves config and rules from config and rules, the config
+    with config_etag when it's set, and records every request. Batch posts are answered with the next of the queued
+    responses, given as (status, headers), an exception to close the connection instead, or a
+    number of seconds to wait before closing it without answering, then with 201 once the queue is empty.
+    """
+    def __init__(self, config=None, rules=None):
+        self.config = config if config is not None else {"sample_rate": 100}
+        self.rules = rules if rules is not None else []
+        self.config_etag = None
+        self.requests = []
+        self.responses = []
+        self._lock = threading.Lock()
+        collector = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                collector.record(self, b'', False)
+                if self.path.startswith('/v1/config'):
+                    etag = collector.config_etag
+                    self.reply(200, collector.config, [('X-Moesif-Config-ETag', etag)] if etag else ())
+                elif self.path.startswith('/v1/rules'):
+                    self.reply(200, collector.rules)
+                else:
+                    self.reply(404, {})
+
+            def do_POST(self):
+                chunked = self.headers.get('Transfer-Encoding', '').lower() == 'chunked'
+                raw_body = self.read_chunked() if chunked else self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                collector.record(self, raw_body, chunked)
+                response = collector.next_response()
+                if isinstance(response, (int, float)):
+                    time.sleep(response)
+                    self.close_connection = True
+                    return
+                if isinstance(response, Exception):
+                    self.close_connection = True
+                    return
+                status, headers = response
+                self.reply(status, {}, headers)
+
+            def read_chunked(self):
+                data = b''
+                while True:
+                    size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                    if not size:
+                        self.rfile.readline()
+                        return data
+                    data += self.rfile.read(size)
+                    self.rfile.readline()
+
+            def reply(self, status, body, headers=()):
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def record(self, handler, raw_body, chunked):
+        with self._lock:
+            self.requests.append(RecordedRequest(handler.command, handler.path, handler.headers, raw_body, chunked))
+
+    def next_response(self):
+        with self._lock:
+            return self.responses.pop(0) if self.responses else (201, ())
+
+    def config_requests(self):
+        with self._lock:
+            return [request for request in self.requests if request.path.startswith('/v1/config')]
+
+    def batch_requests(self):
+        with self._lock:
+            return [request for request in self.requests if request.path.startswith('/v1/events/batch')]
+
+    def events(self):
+        return [event for request in self.batch_requests() for event in json.loads(request.body)]
+
+    def wait_for_events(self, count, timeout=10):
+        deadline = time.monotonic() + timeout
+        while len(self.events()) < count and time.monotonic() < deadline:
+            time.sleep(0.02)
+        return self.events()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def make_environ(method='GET', path='/', body=b'', **extra):
+    environ = {}
+    setup_testing_defaults(environ)
+    environ['REQUEST_METHOD'] = method
+    environ['PATH_INFO'] = path
+    environ['wsgi.input'] = io.BytesIO(body)
+    if body:
+        environ['CONTENT_LENGTH'] = str(len(body))
+    environ.update(extra)
+    return environ
+
+
+def call_app(app, environ):
+    """Call a WSGI app, returns the status and the response body"""
+    result = {}
+
+    def start_response(status, headers, exc_info=None):
+        result['status'] = status
+
+    response = app(environ, start_response)
+    try:
+        body = b''.join(response)
+    finally:
+        if hasattr(response, 'close'):
+            response.close()
+    return result['status'], body
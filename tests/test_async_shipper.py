@@ -0,0 +1,54 @@
+import asyncio
+import unittest
+
+from moesifapi.configuration import Configuration
+from moesifapi.moesif_api_client import MoesifAPIClient
+from moesifwsgi.async_http_client import AsyncHttpClient
+from moesifwsgi.event_sender import EventSender
+from moesifwsgi.workers import AsyncBatchQueue, AsyncShipper, BatchedWorkerPool
+from .fake_collector import FakeCollector
+
+
+class NoConfig(object):
+    def check_and_update(self, response_headers):
+        pass
+
+
+class AsyncShipperTest(unittest.TestCase):
+    def setUp(self):
+        self.collector = FakeCollector()
+        self.base_uri = Configuration.BASE_URI
+        Configuration.BASE_URI = self.collector.url
+        self.api_client = MoesifAPIClient('test').api
+
+    def tearDown(self):
+        Configuration.BASE_URI = self.base_uri
+        self.collector.stop()
+
+    def test_stop_before_the_loop_ships(self):
+        shipper = AsyncShipper(AsyncBatchQueue(10), EventSender(self.api_client), NoConfig(), False,
+                               lambda event: event, None, 4, AsyncHttpClient())
+        # The loop exists but ship hasn't created its events yet
+        shipper.loop = asyncio.new_event_loop()
+        try:
+            shipper.stop()
+            shipper.loop.run_until_complete(asyncio.sleep(0))
+        finally:
+            shipper.loop.close()
+
+    def test_ships_batches_and_caches_the_resolved_address(self):
+        http_client = AsyncHttpClient()
+        pool = BatchedWorkerPool(1, EventSender(self.api_client), NoConfig(), False, 1000, 10, 0.05,
+                                 lambda event: event, async_http_client=http_client, async_concurrency=4)
+        try:
+            for index in range(25):
+                pool.add_event({"index": index}, 20)
+            events = self.collector.wait_for_events(25)
+        finally:
+            pool.stop()
+        self.assertEqual(sorted(event["index"] for event in events), list(range(25)))
+        self.assertIsNotNone(http_client.dns_cache.get('127.0.0.1', self.collector.server.server_port))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import unittest
+from unittest import mock
+
+from moesifwsgi.retry import CircuitBreaker
+from moesifwsgi.workers import WorkerAutoscaler
+
+
+class FakeWorker(object):
+    def __init__(self):
+        self.busy_time = 0.0
+        self.busy_since = None
+        self.batches_done = 0
+
+
+class FakeQueue(object):
+    def __init__(self):
+        self.size = 0
+
+    def qsize(self):
+        return self.size
+
+
+class FakeSender(object):
+    def __init__(self):
+        self.circuit_breaker = CircuitBreaker(1, 30)
+
+
+class FakePool(object):
+    """The parts of a BatchedWorkerPool the autoscaler reads and scales"""
+    def __init__(self, count):
+        self.workers = [FakeWorker() for _ in range(count)]
+        self.retired_workers = []
+        self.dropped_events = 0
+        self.batch_queue = FakeQueue()
+        self.event_sender = FakeSender()
+
+    def add_workers(self, count):
+        self.workers = self.workers + [FakeWorker() for _ in range(count)]
+
+    def retire_workers(self, count):
+        self.retired_workers += self.workers[len(self.workers) - count:]
+        self.workers = self.workers[:len(self.workers) - count]
+
+
+class WorkerAutoscalerTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('moesifwsgi.workers.time')
+        self.time = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.time.monotonic.side_effect = lambda: self.now
+        self.time.time.side_effect = lambda: self.now
+
+    def check(self, autoscaler, seconds=1):
+        self.now += seconds
+        autoscaler.check()
+
+    def test_scales_up_on_a_backlog(self):
+        pool = FakePool(2)
+        autoscaler = WorkerAutoscaler(pool, 2, 8, 30)
+        # Each worker sent 4 batches of 0.25 seconds, and 10 batches are waiting
+        for worker in pool.workers:
+            worker.busy_time, worker.batches_done = 1.0, 4
+        pool.batch_queue.size = 10
+        self.check(autoscaler)
+        self.assertGreater(len(pool.workers), 2)
+        self.assertEqual(autoscaler.scale_ups, 1)
+        self.assertEqual(autoscaler.decisions[-1]["reason"], "10 batches queued")
+
+    def test_scales_up_on_dropped_events(self):
+        pool = FakePool(2)
+        autoscaler = WorkerAutoscaler(pool, 2, 8, 30)
+        pool.dropped_events = 5
+        self.check(autoscaler)
+        self.assertEqual(len(pool.workers), 3)
+        self.assertEqual(autoscaler.decisions[-1]["reason"], "5 events dropped")
+
+    def test_no_scale_up_while_the_circuit_is_open(self):
+        pool = FakePool(2)
+        autoscaler = WorkerAutoscaler(pool, 2, 8, 30)
+        pool.event_sender.circuit_breaker.record_failure()
+        pool.batch_queue.size = 10
+        pool.dropped_events = 5
+        self.check(autoscaler)
+        self.assertEqual(len(pool.workers), 2)
+        self.assertEqual(autoscaler.scale_ups, 0)
+
+    def test_retires_one_worker_per_delay(self):
+        pool = FakePool(6)
+        autoscaler = WorkerAutoscaler(pool, 2, 8, 30)
+        # Idle workers, the first check starts the delay
+        self.check(autoscaler)
+        for _ in range(29):
+            self.check(autoscaler)
+        self.assertEqual(len(pool.workers), 6)
+        self.check(autoscaler)
+        self.assertEqual(len(pool.workers), 5)
+        for _ in range(29):
+            self.check(autoscaler)
+        self.assertEqual(len(pool.workers), 5)
+        self.check(autoscaler)
+        self.assertEqual(len(pool.workers), 4)
+        self.assertEqual(autoscaler.scale_downs, 2)
+
+    def test_never_scales_below_the_minimum(self):
+        pool = FakePool(2)
+        autoscaler = WorkerAutoscaler(pool, 2, 8, 1)
+        for _ in range(10):
+            self.check(autoscaler)
+        self.assertEqual(len(pool.workers), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
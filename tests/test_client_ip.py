@@ -0,0 +1,51 @@
+import unittest
+
+from moesifwsgi.client_ip import ClientIp
+
+
+class ClientIpTest(unittest.TestCase):
+    def test_left_most_forwarded_address_without_trusted_proxies(self):
+        client_ip = ClientIp()
+        environ = {'REMOTE_ADDR': '10.0.0.1', 'HTTP_X_FORWARDED_FOR': 'unknown, 1.2.3.4, 10.0.0.2'}
+        self.assertEqual(client_ip.get_client_address(environ), '1.2.3.4')
+        self.assertEqual(client_ip.get_client_address({'REMOTE_ADDR': '10.0.0.1', 'HTTP_X_CLIENT_IP': '5.6.7.8'}),
+                         '5.6.7.8')
+
+    def test_headers_ignored_when_remote_addr_is_not_trusted(self):
+        client_ip = ClientIp(trusted_proxies=['10.0.0.0/8'])
+        environ = {'REMOTE_ADDR': '9.9.9.9', 'HTTP_X_FORWARDED_FOR': '1.2.3.4', 'HTTP_X_CLIENT_IP': '1.2.3.4'}
+        self.assertEqual(client_ip.get_client_address(environ), '9.9.9.9')
+
+    def test_client_ip_header_is_not_honoured_behind_a_trusted_proxy(self):
+        client_ip = ClientIp(trusted_proxies=['10.0.0.0/8'])
+        environ = {'REMOTE_ADDR': '10.0.0.1', 'HTTP_X_CLIENT_IP': '1.2.3.4', 'HTTP_TRUE_CLIENT_IP': '1.2.3.4',
+                   'HTTP_X_FORWARDED_FOR': '9.9.9.9'}
+        self.assertEqual(client_ip.get_client_address(environ), '9.9.9.9')
+        # Unless the headers are configured explicitly
+        client_ip = ClientIp(['X-Client-IP'], trusted_proxies=['10.0.0.0/8'])
+        self.assertEqual(client_ip.get_client_address(environ), '1.2.3.4')
+
+    def test_multi_hop_forwarded_for_is_walked_from_the_right(self):
+        client_ip = ClientIp(trusted_proxies=['10.0.0.0/8', '173.245.48.0/20'])
+        # The left-most entry was sent by the client itself
+        environ = {'REMOTE_ADDR': '10.0.0.1', 'HTTP_X_FORWARDED_FOR': '1.1.1.1, 9.9.9.9, 173.245.48.5, 10.0.0.2'}
+        self.assertEqual(client_ip.get_client_address(environ), '9.9.9.9')
+        # Only trusted proxies, the connection's address is used
+        environ = {'REMOTE_ADDR': '10.0.0.1', 'HTTP_X_FORWARDED_FOR': '10.0.0.3, 10.0.0.2'}
+        self.assertEqual(client_ip.get_client_address(environ), '10.0.0.1')
+
+    def test_walk_stops_at_unknown_entries(self):
+        client_ip = ClientIp(trusted_proxies=['10.0.0.0/8'])
+        environ = {'REMOTE_ADDR': '10.0.0.1', 'HTTP_X_FORWARDED_FOR': '1.2.3.4, unknown, 10.0.0.2'}
+        self.assertEqual(client_ip.get_client_address(environ), '10.0.0.1')
+        environ = {'REMOTE_ADDR': '10.0.0.1', 'HTTP_X_FORWARDED_FOR': 'unknown, 9.9.9.9, 10.0.0.2'}
+        self.assertEqual(client_ip.get_client_address(environ), '9.9.9.9')
+
+    def test_ports_are_removed(self):
+        client_ip = ClientIp(trusted_proxies=['10.0.0.0/8'])
+        environ = {'REMOTE_ADDR': '10.0.0.1', 'HTTP_X_FORWARDED_FOR': '[2001:db8::1]:443, 10.0.0.2:80'}
+        self.assertEqual(client_ip.get_client_address(environ), '2001:db8::1')
+
+
+if __name__ == '__main__':
+    unittest.main()
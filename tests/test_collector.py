@@ -0,0 +1,82 @@
+import os
+import shutil
+import socket
+import stat
+import tempfile
+import threading
+import time
+import unittest
+
+from moesifapi.configuration import Configuration
+from moesifapi.moesif_api_client import MoesifAPIClient
+from moesifwsgi.collector import CollectorSender, EventCollector
+from moesifwsgi.event_sender import EventSender
+from .fake_collector import FakeCollector
+
+
+class EventCollectorTest(unittest.TestCase):
+    """A collector on a temporary socket, sending to a local fake collector"""
+    def setUp(self):
+        self.fake = FakeCollector()
+        self.base_uri = Configuration.BASE_URI
+        Configuration.BASE_URI = self.fake.url
+        self.directory = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.directory, 'collector.sock')
+        self.collector = EventCollector(self.socket_path, MoesifAPIClient('test').api, worker_count=1,
+                                        max_queue_size=1000, batch_size=100, timeout=0.1, debug=False)
+        self.thread = threading.Thread(target=self.collector.serve_forever)
+        self.thread.start()
+        deadline = time.monotonic() + 5
+        while not os.path.exists(self.socket_path) and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def tearDown(self):
+        self.collector.stop()
+        self.thread.join(10)
+        Configuration.BASE_URI = self.base_uri
+        self.fake.stop()
+        shutil.rmtree(self.directory)
+
+    def send_datagram(self, datagram):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            sock.connect(self.socket_path)
+            sock.send(datagram)
+        finally:
+            sock.close()
+
+    def test_socket_is_only_writable_by_its_user_and_group(self):
+        self.assertEqual(stat.S_IMODE(os.stat(self.socket_path).st_mode), 0o660)
+
+    def test_skips_empty_and_invalid_pieces(self):
+        self.send_datagram(b'{"index":1}\n\n{"index":2}\nnot an event\n')
+        events = self.fake.wait_for_events(2)
+        self.assertEqual(events, [{"index": 1}, {"index": 2}])
+        stats = self.collector.get_stats()
+        self.assertEqual(stats["invalid_events"], 3)
+        self.assertEqual(stats["dropped_events"], 0)
+
+    def test_forwarded_from_concurrent_threads(self):
+        sender = CollectorSender(self.socket_path, MoesifAPIClient('test').api)
+
+        def forward(thread_index):
+            for index in range(50):
+                sender.send([EventSender.serialize_event({"thread": thread_index, "index": index})])
+
+        threads = [threading.Thread(target=forward, args=(thread_index,)) for thread_index in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        sender.close()
+        events = self.fake.wait_for_events(400)
+        self.assertEqual(len(events), 400)
+        # Events the collector can't take in time are sent in process, none are lost
+        stats = sender.get_stats()
+        self.assertEqual(stats["forwarded_events"] + stats["events_sent_in_process"], 400)
+        self.assertGreater(stats["forwarded_events"], 0)
+        self.assertEqual(self.collector.get_stats()["invalid_events"], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
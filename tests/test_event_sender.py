@@ -0,0 +1,107 @@
+import gzip
+import json
+import unittest
+
+from moesifapi.configuration import Configuration
+from moesifapi.moesif_api_client import MoesifAPIClient
+from moesifwsgi.event_sender import BatchStream, CompressedBatchStream, EventSender
+from moesifwsgi.pooled_http_client import PooledHttpClient
+from .fake_collector import FakeCollector
+
+
+def make_events(count, size=200):
+    return [EventSender.serialize_event({"index": index, "body": "x" * size}) for index in range(count)]
+
+
+class BatchStreamTest(unittest.TestCase):
+    def test_yields_the_json_array_with_its_length(self):
+        events = make_events(50)
+        stream = BatchStream(events, 1024)
+        payload = b"".join(stream)
+        self.assertEqual(len(payload), len(stream))
+        self.assertEqual([event["index"] for event in json.loads(payload)], list(range(50)))
+        # Iterated again for a retry
+        self.assertEqual(b"".join(stream), payload)
+
+    def test_empty_and_large_events(self):
+        self.assertEqual(json.loads(b"".join(BatchStream([], 16))), [])
+        events = make_events(3, size=5000)
+        stream = BatchStream(events, 1024)
+        self.assertEqual(len(json.loads(b"".join(stream))), 3)
+        self.assertEqual(len(b"".join(stream)), len(stream))
+
+    def test_compressed_stream_round_trip(self):
+        for events in ([], make_events(1), make_events(50), make_events(3, size=50000)):
+            stream = BatchStream(events, 1024)
+            compressed = CompressedBatchStream(stream, 6)
+            self.assertEqual(gzip.decompress(b"".join(compressed)), b"".join(stream))
+            # Iterated again for a retry
+            self.assertEqual(gzip.decompress(b"".join(compressed)), b"".join(stream))
+
+    def test_compressed_stream_counts_its_compression_once(self):
+        calls = []
+        stream = CompressedBatchStream(BatchStream(make_events(50), 1024), 6,
+                                       lambda *sizes: calls.append(sizes))
+        first = b"".join(stream)
+        second = b"".join(stream)
+        self.assertEqual(gzip.decompress(first), gzip.decompress(second))
+        self.assertEqual(len(json.loads(gzip.decompress(first))), 50)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(calls[0][1], len(first))
+
+
+class StreamedUploadTest(unittest.TestCase):
+    """Batches streamed to a local fake collector, with the requests session and the pooled connections"""
+    def setUp(self):
+        self.collector = FakeCollector()
+        self.base_uri = Configuration.BASE_URI
+        Configuration.BASE_URI = self.collector.url
+        self.api_client = MoesifAPIClient('test').api
+
+    def tearDown(self):
+        Configuration.BASE_URI = self.base_uri
+        self.collector.stop()
+
+    def senders(self, **options):
+        return [
+            EventSender(self.api_client, stream_uploads=True, stream_chunk_size=1024, **options),
+            EventSender(self.api_client, stream_uploads=True, stream_chunk_size=1024,
+                        http_client=PooledHttpClient(1), **options),
+        ]
+
+    def test_streamed_upload_has_a_content_length(self):
+        events = make_events(100)
+        for sender in self.senders(compression=False):
+            with self.subTest(http_client=type(sender.http_client).__name__):
+                sender.send(events)
+                request = self.collector.batch_requests()[-1]
+                self.assertFalse(request.chunked)
+                self.assertEqual(int(request.headers['Content-Length']), len(request.raw_body))
+                self.assertEqual(len(request.raw_body), len(BatchStream(events, 1024)))
+                self.assertIsNone(request.headers.get('Content-Encoding'))
+                self.assertEqual([event["index"] for event in json.loads(request.body)], list(range(100)))
+                sender.close()
+
+    def test_compressed_streamed_upload_is_chunked(self):
+        events = make_events(100)
+        for sender in self.senders(compression=True, compression_min_size=1024):
+            with self.subTest(http_client=type(sender.http_client).__name__):
+                sender.send(events)
+                request = self.collector.batch_requests()[-1]
+                self.assertTrue(request.chunked)
+                self.assertIsNone(request.headers.get('Content-Length'))
+                self.assertEqual(request.headers['Content-Encoding'], 'gzip')
+                self.assertEqual([event["index"] for event in json.loads(request.body)], list(range(100)))
+                self.assertEqual(sender.get_stats()["bytes_compressed"], len(request.raw_body))
+                sender.close()
+
+    def test_small_streamed_batch_is_not_compressed(self):
+        sender = EventSender(self.api_client, stream_uploads=True, compression=True, compression_min_size=1024)
+        sender.send(make_events(1, size=10))
+        request = self.collector.batch_requests()[-1]
+        self.assertIsNone(request.headers.get('Content-Encoding'))
+        self.assertEqual(len(json.loads(request.body)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
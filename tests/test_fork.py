@@ -0,0 +1,58 @@
+import os
+import unittest
+
+from moesifwsgi import MoesifMiddleware
+from .fake_collector import FakeCollector, call_app, make_environ
+
+
+def hello_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [b'hello']
+
+
+@unittest.skipUnless(hasattr(os, 'fork'), "requires os.fork")
+class ForkTest(unittest.TestCase):
+    def setUp(self):
+        self.collector = FakeCollector()
+        self.middleware = MoesifMiddleware(hello_app, {
+            'APPLICATION_ID': 'test', 'BASE_URI': self.collector.url, 'EVENT_BATCH_TIMEOUT': 0.1,
+        })
+
+    def tearDown(self):
+        self.middleware._shutdown()
+        self.collector.stop()
+
+    def test_forked_child_starts_its_own_threads_and_config_updates(self):
+        call_app(self.middleware, make_environ(path='/parent'))
+        parent_executor = self.middleware.config._executor
+        self.collector.wait_for_events(1)
+
+        pid = os.fork()
+        if not pid:
+            # In the child, exit with the number of the failed check
+            code = 0
+            try:
+                if self.middleware.worker_pool is not None or self.middleware._started_pid is not None:
+                    code = 1
+                elif self.middleware.config._executor is parent_executor:
+                    code = 2
+                else:
+                    call_app(self.middleware, make_environ(path='/child'))
+                    self.middleware._shutdown()
+                    if self.middleware._started_pid != os.getpid():
+                        code = 3
+            except BaseException:
+                code = 4
+            os._exit(code)
+
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+        events = self.collector.wait_for_events(2)
+        self.assertEqual(sorted(event['request']['uri'].split('/')[-1] for event in events), ['child', 'parent'])
+        # The parent keeps its own threads
+        self.assertIs(self.middleware.config._executor, parent_executor)
+        self.assertIsNotNone(self.middleware.worker_pool)
+
+
+if __name__ == '__main__':
+    unittest.main()
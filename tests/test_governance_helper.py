@@ -0,0 +1,51 @@
+import unittest
+
+from moesifwsgi.governance_helper import GovernanceHelper
+
+WSGI_STATUSES = {403: '403 Forbidden', 429: '429 Too Many Requests'}
+
+
+def regex_rule(rule_id, route, status, block=True):
+    return {
+        "_id": rule_id,
+        "type": "regex",
+        "block": block,
+        "regex_config": [{"conditions": [{"path": "request.route", "value": route}]}],
+        "response": {"status": status, "headers": {"X-Rule": rule_id}, "body": {"error": rule_id}},
+    }
+
+
+class GovernanceRuleSetTest(unittest.TestCase):
+    def setUp(self):
+        self.helper = GovernanceHelper(WSGI_STATUSES)
+
+    def govern(self, rule_set, route):
+        return rule_set.govern({'request.route': route}, None, None, lambda: None, lambda: None)
+
+    def test_invalid_rule_is_skipped(self):
+        rules = [
+            regex_rule('no-status', '^/admin', None),
+            regex_rule('bad-status', '^/admin', 'forbidden'),
+            {"type": "regex"},
+            regex_rule('blocked', '^/admin', 403),
+        ]
+        rule_set = self.helper.get_rule_set(rules, {})
+        self.assertEqual(rule_set.rejected_rules, ['no-status', 'bad-status', None])
+        self.assertEqual([rule.id for rule in rule_set.regex_rules], ['blocked'])
+
+        governed = self.govern(rule_set, '/admin/users')
+        self.assertEqual(governed.blocked_by, 'blocked')
+        self.assertEqual(governed.status_line, '403 Forbidden')
+        self.assertIsNone(self.govern(rule_set, '/public'))
+
+    def test_rule_set_is_cached_with_rejected_rules(self):
+        rules = [regex_rule('bad-status', '^/admin', 'forbidden'), regex_rule('blocked', '^/admin', 403)]
+        config_body = {}
+        rule_set = self.helper.get_rule_set(rules, config_body)
+        self.assertIs(self.helper.get_rule_set(rules, config_body), rule_set)
+        # Compiled again once the rules are replaced
+        self.assertIsNot(self.helper.get_rule_set(list(rules), config_body), rule_set)
+
+
+if __name__ == '__main__':
+    unittest.main()
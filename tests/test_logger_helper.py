@@ -0,0 +1,48 @@
+import base64
+import json
+import unittest
+from unittest import mock
+
+from moesifwsgi import logger_helper
+from moesifwsgi.logger_helper import LoggerHelper
+
+
+def bearer_token(payload):
+    encoded = base64.urlsafe_b64encode(json.dumps(payload).encode('utf-8')).decode('utf-8').rstrip('=')
+    return f"Bearer header.{encoded}.signature"
+
+
+class TokenCacheTest(unittest.TestCase):
+    def setUp(self):
+        LoggerHelper._token_user_ids.clear()
+
+    def test_decoded_once_per_token(self):
+        token = bearer_token({"sub": "user-1"})
+        with mock.patch.object(LoggerHelper, 'decode_user_id_from_token',
+                               wraps=LoggerHelper.decode_user_id_from_token) as decode:
+            self.assertEqual(LoggerHelper.parse_user_id_from_token(token, 'sub', False), 'user-1')
+            self.assertEqual(LoggerHelper.parse_user_id_from_token(token, 'sub', False), 'user-1')
+            self.assertEqual(decode.call_count, 1)
+            self.assertEqual(LoggerHelper.parse_user_id_from_token(bearer_token({"sub": "user-2"}), 'sub', False),
+                             'user-2')
+            self.assertEqual(decode.call_count, 2)
+
+    def test_cache_does_not_keep_the_token(self):
+        token = bearer_token({"sub": "user-1"})
+        LoggerHelper.parse_user_id_from_token(token, 'sub', False)
+        for key in LoggerHelper._token_user_ids:
+            self.assertNotIn(token, key)
+            self.assertNotIn(token.encode('utf-8'), key)
+
+    def test_least_recently_used_tokens_are_evicted(self):
+        with mock.patch.object(logger_helper, 'TOKEN_CACHE_SIZE', 2):
+            first = bearer_token({"sub": "user-1"})
+            LoggerHelper.parse_user_id_from_token(first, 'sub', False)
+            LoggerHelper.parse_user_id_from_token(bearer_token({"sub": "user-2"}), 'sub', False)
+            LoggerHelper.parse_user_id_from_token(first, 'sub', False)
+            LoggerHelper.parse_user_id_from_token(bearer_token({"sub": "user-3"}), 'sub', False)
+            self.assertEqual(sorted(LoggerHelper._token_user_ids.values()), ['user-1', 'user-3'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+import threading
+import unittest
+from unittest import mock
+
+from moesifwsgi import MoesifMiddleware
+from moesifwsgi.metrics import MetricsRegistry
+from .fake_collector import FakeCollector, call_app, make_environ
+
+
+def hello_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [b'hello']
+
+
+class MetricsRegistryTest(unittest.TestCase):
+    def run_thread(self, target):
+        thread = threading.Thread(target=target)
+        thread.start()
+        thread.join()
+
+    @mock.patch('moesifwsgi.metrics.SHARD_MERGE_THRESHOLD', 4)
+    def test_shards_of_exited_threads_are_merged(self):
+        registry = MetricsRegistry()
+        counter = registry.counter('events', "Events")
+        histogram = registry.histogram('sizes', "Sizes", (10, 100))
+        for index in range(20):
+            self.run_thread(lambda: (counter.inc(), histogram.observe(5 if index % 2 else 50)))
+        counter.inc(2)
+
+        self.assertLessEqual(len(registry._shards), 5)
+        self.assertEqual(counter.value(), 22)
+        self.assertEqual(registry.get_stats()["sizes"], {"count": 20, "sum": 550, "buckets": {10: 10, 100: 10}})
+        # Collecting doesn't count the merged values twice
+        self.assertEqual(counter.value(), 22)
+
+    def test_prometheus_exposition_format(self):
+        registry = MetricsRegistry()
+        registry.counter('sent', "Events sent").inc(3)
+        errors = registry.counter('errors', "Errors by kind", label='error')
+        errors.inc(label_value='HTTP 503')
+        errors.inc(2, label_value='say "hi"\n')
+        histogram = registry.histogram('seconds', "Send time", (0.1, 1))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        registry.gauge('depth', "Queue depth", lambda: 7)
+        registry.gauge('broken', "Unreadable", lambda: 1 / 0)
+
+        self.assertEqual(registry.render_prometheus(), (
+            '# HELP moesif_sent_total Events sent\n'
+            '# TYPE moesif_sent_total counter\n'
+            'moesif_sent_total 3\n'
+            '# HELP moesif_errors_total Errors by kind\n'
+            '# TYPE moesif_errors_total counter\n'
+            'moesif_errors_total{error="HTTP 503"} 1\n'
+            'moesif_errors_total{error="say \\"hi\\"\\n"} 2\n'
+            '# HELP moesif_seconds Send time\n'
+            '# TYPE moesif_seconds histogram\n'
+            'moesif_seconds_bucket{le="0.1"} 1\n'
+            'moesif_seconds_bucket{le="1"} 2\n'
+            'moesif_seconds_bucket{le="+Inf"} 3\n'
+            'moesif_seconds_sum 5.55\n'
+            'moesif_seconds_count 3\n'
+            '# HELP moesif_depth Queue depth\n'
+            '# TYPE moesif_depth gauge\n'
+            'moesif_depth 7.0\n'
+            '# HELP moesif_broken Unreadable\n'
+            '# TYPE moesif_broken gauge\n'
+            'moesif_broken NaN\n'
+        ))
+
+
+class MetricsEndpointTest(unittest.TestCase):
+    def setUp(self):
+        self.collector = FakeCollector()
+        self.middlewares = []
+
+    def tearDown(self):
+        for middleware in self.middlewares:
+            middleware._shutdown()
+        self.collector.stop()
+
+    def create_middleware(self, **settings):
+        middleware = MoesifMiddleware(hello_app, dict({
+            'APPLICATION_ID': 'test', 'BASE_URI': self.collector.url, 'METRICS_PATH': '/metrics',
+        }, **settings))
+        self.middlewares.append(middleware)
+        return middleware
+
+    def get_status(self, middleware, **extra):
+        status, _ = call_app(middleware, make_environ(path='/metrics', **extra))
+        return status
+
+    def test_served_to_the_host_itself(self):
+        middleware = self.create_middleware()
+        status, body = call_app(middleware, make_environ(path='/metrics', REMOTE_ADDR='127.0.0.1'))
+        self.assertEqual(status, '200 OK')
+        self.assertIn(b'# TYPE moesif_enqueued_events_total counter', body)
+        self.assertEqual(self.get_status(middleware, REMOTE_ADDR='::1'), '200 OK')
+        self.assertEqual(self.get_status(middleware, REMOTE_ADDR='203.0.113.5'), '403 Forbidden')
+        # A proxy on the same host may forward any client
+        self.assertEqual(self.get_status(middleware, REMOTE_ADDR='127.0.0.1', HTTP_X_FORWARDED_FOR='127.0.0.1'),
+                         '403 Forbidden')
+
+    def test_served_to_trusted_proxies(self):
+        middleware = self.create_middleware(TRUSTED_PROXIES=['10.0.0.0/8'])
+        self.assertEqual(self.get_status(middleware, REMOTE_ADDR='10.0.0.2'), '200 OK')
+        self.assertEqual(self.get_status(middleware, REMOTE_ADDR='10.0.0.2', HTTP_X_FORWARDED_FOR='10.0.0.3'),
+                         '200 OK')
+        # Forwarded for a client outside the trusted networks
+        self.assertEqual(self.get_status(middleware, REMOTE_ADDR='10.0.0.2', HTTP_X_FORWARDED_FOR='203.0.113.5'),
+                         '403 Forbidden')
+
+    def test_token_is_required_when_set(self):
+        middleware = self.create_middleware(METRICS_TOKEN='secret')
+        self.assertEqual(self.get_status(middleware, REMOTE_ADDR='203.0.113.5', HTTP_AUTHORIZATION='Bearer secret'),
+                         '200 OK')
+        self.assertEqual(self.get_status(middleware, REMOTE_ADDR='127.0.0.1'), '403 Forbidden')
+        self.assertEqual(self.get_status(middleware, REMOTE_ADDR='127.0.0.1', HTTP_AUTHORIZATION='Bearer wrong'),
+                         '403 Forbidden')
+
+
+if __name__ == '__main__':
+    unittest.main()
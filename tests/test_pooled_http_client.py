@@ -0,0 +1,73 @@
+import gzip
+import unittest
+
+from moesifwsgi.event_sender import BatchStream, CompressedBatchStream, EventSender
+from moesifwsgi.pooled_http_client import PooledHttpClient
+from .fake_collector import FakeCollector
+
+
+class PooledHttpClientTest(unittest.TestCase):
+    def setUp(self):
+        self.collector = FakeCollector()
+        self.client = PooledHttpClient(1)
+        self.url = self.collector.url + '/v1/events/batch'
+
+    def tearDown(self):
+        self.client.close()
+        self.collector.stop()
+
+    def post(self, body=b'[]'):
+        return self.client.execute_as_string(self.client.post(self.url, parameters=body))
+
+    def test_reuses_the_connection(self):
+        self.assertEqual(self.post().status_code, 201)
+        self.assertEqual(self.post().status_code, 201)
+        stats = self.client.get_stats()
+        self.assertEqual(stats["connections_opened"], 1)
+        self.assertEqual(stats["connections_reused"], 1)
+
+    def test_stale_connection_is_sent_again_on_a_new_one(self):
+        self.post()
+        # The server closes the kept alive connection instead of answering
+        self.collector.responses = [ConnectionResetError()]
+        self.assertEqual(self.post().status_code, 201)
+        self.assertEqual(len(self.collector.batch_requests()), 3)
+
+    def test_new_connection_is_closed_when_the_resend_fails(self):
+        self.post()
+        connections = []
+        send = self.client._send
+
+        def failing_send(connection, *args):
+            connections.append(connection)
+            if len(connections) == 1:
+                raise ConnectionResetError()
+            connection.connect()
+            raise TimeoutError()
+
+        self.client._send = failing_send
+        with self.assertRaises(TimeoutError):
+            self.post()
+        self.assertEqual(len(connections), 2)
+        self.assertTrue(all(connection.sock is None for connection in connections))
+
+        # The pool still works afterwards
+        self.client._send = send
+        self.assertEqual(self.post().status_code, 201)
+
+    def test_body_framing(self):
+        stream = BatchStream([EventSender.serialize_event({"index": index}) for index in range(20)], 64)
+        for body in (b'[{"index": 0}]', stream, CompressedBatchStream(stream, 6)):
+            self.assertEqual(self.post(body).status_code, 201)
+        requests = self.collector.batch_requests()
+        # Bodies with a known length are sent with Content-Length, the compressed stream is chunked
+        self.assertEqual([request.chunked for request in requests], [False, False, True])
+        self.assertEqual(requests[0].headers['Content-Length'], '14')
+        self.assertEqual(requests[1].headers['Content-Length'], str(len(stream)))
+        self.assertNotIn('Content-Length', requests[2].headers)
+        self.assertEqual(requests[1].body, b''.join(stream))
+        self.assertEqual(gzip.decompress(requests[2].body), b''.join(stream))
+
+
+if __name__ == '__main__':
+    unittest.main()
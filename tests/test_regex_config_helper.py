@@ -0,0 +1,58 @@
+import unittest
+
+from moesifwsgi.regex_config_helper import RegexRuleIndex, literal_prefix
+
+
+class LiteralPrefixTest(unittest.TestCase):
+    def test_anchored_literals(self):
+        self.assertEqual(literal_prefix('^/api/v1/users'), '/api/v1/users')
+        self.assertEqual(literal_prefix('^\\/api\\.v1/'), '/api.v1/')
+
+    def test_stops_at_the_first_pattern(self):
+        self.assertEqual(literal_prefix('^/users/[0-9]+'), '/users/')
+        self.assertEqual(literal_prefix('^/users?/x'), '/user')
+        self.assertEqual(literal_prefix('^/api/(users|orders)'), '/api/')
+
+    def test_no_prefix(self):
+        self.assertIsNone(literal_prefix('/users'))
+        self.assertIsNone(literal_prefix('^/users|/orders'))
+        self.assertIsNone(literal_prefix('(?i)^/Users'))
+        self.assertIsNone(literal_prefix('^/users('))
+
+
+class RegexRuleIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = RegexRuleIndex([
+            {"conditions": [{"path": "request.ip_address", "value": "^10\\."}], "sample_rate": 0},
+        ])
+
+    def test_missing_field_is_undecided_on_the_request(self):
+        self.assertEqual(self.index.lookup({"request.route": "/"}, request_only=True), (False, None))
+
+    def test_missing_field_does_not_match_once_the_response_finished(self):
+        self.assertEqual(self.index.lookup({"request.route": "/"}), (True, None))
+
+    def test_matching_field(self):
+        self.assertEqual(self.index.lookup({"request.ip_address": "10.0.0.1"}), (True, 0))
+
+    def test_zero_length_match_does_not_match(self):
+        # Same as moesifapi's helper, which tests the matched text
+        index = RegexRuleIndex([
+            {"conditions": [{"path": "request.route", "value": "x*"}], "sample_rate": 10},
+            {"conditions": [{"path": "request.verb", "value": "^(DELETE)?"}], "sample_rate": 20},
+        ])
+        self.assertEqual(index.lookup({"request.route": "/users", "request.verb": "GET"}), (True, None))
+        self.assertEqual(index.lookup({"request.route": "xx/users", "request.verb": "GET"}), (True, 10))
+        self.assertEqual(index.lookup({"request.route": "/users", "request.verb": "DELETE"}), (True, 20))
+
+    def test_top_level_alternation_is_not_indexed(self):
+        index = RegexRuleIndex([
+            {"conditions": [{"path": "request.route", "value": "^/users|/orders"}], "sample_rate": 10},
+        ])
+        self.assertEqual(index.lookup({"request.route": "/orders"}), (True, 10))
+        self.assertEqual(index.lookup({"request.route": "/users/1"}), (True, 10))
+        self.assertEqual(index.lookup({"request.route": "/items"}), (True, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
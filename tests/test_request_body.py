@@ -0,0 +1,70 @@
+import json
+import unittest
+from unittest import mock
+
+from moesifapi.parse_body import ParseBody
+from moesifwsgi import MoesifMiddleware
+from .fake_collector import FakeCollector, call_app, make_environ
+
+
+def echo_app(environ, start_response):
+    body = environ['wsgi.input'].read()
+    start_response('200 OK', [('Content-Type', 'application/json')])
+    return [body]
+
+
+class RequestBodyEnvironTest(unittest.TestCase):
+    def setUp(self):
+        self.collector = FakeCollector()
+        self.middlewares = []
+        self.seen = []
+
+    def tearDown(self):
+        for middleware in self.middlewares:
+            middleware._shutdown()
+        self.collector.stop()
+
+    def get_metadata(self, app, environ):
+        self.seen.append((environ.get('moesif.request_body'), environ.get('moesif.request_body_raw')))
+        return {"plan": environ['moesif.request_body']["plan"]}
+
+    def create_middleware(self, **settings):
+        middleware = MoesifMiddleware(echo_app, dict({
+            'APPLICATION_ID': 'test', 'BASE_URI': self.collector.url, 'EVENT_BATCH_TIMEOUT': 0.1,
+        }, **settings))
+        self.middlewares.append(middleware)
+        return middleware
+
+    def post(self, middleware):
+        body = json.dumps({"plan": "pro"}).encode('utf-8')
+        return call_app(middleware, make_environ('POST', '/orders', body, CONTENT_TYPE='application/json'))
+
+    def assert_parsed_for_the_callback(self, middleware):
+        with mock.patch.object(ParseBody, 'parse_bytes_body', autospec=True,
+                               side_effect=ParseBody.parse_bytes_body) as parse:
+            self.post(middleware)
+            [event] = self.collector.wait_for_events(1)
+        self.assertEqual(self.seen, [({"plan": "pro"}, b'{"plan": "pro"}')])
+        self.assertEqual(event["metadata"], {"plan": "pro"})
+        self.assertEqual(event["request"]["body"], {"plan": "pro"})
+        # The event reuses the body parsed for the callback, the other call parses the response body
+        self.assertEqual(parse.call_count, 2)
+
+    def test_parsed_body_for_callbacks(self):
+        self.assert_parsed_for_the_callback(self.create_middleware(GET_METADATA=self.get_metadata))
+
+    def test_parsed_body_for_callbacks_with_lazy_capture(self):
+        self.assert_parsed_for_the_callback(self.create_middleware(GET_METADATA=self.get_metadata,
+                                                                   LAZY_REQUEST_BODY_CAPTURE=True))
+
+    def test_not_parsed_on_the_request_without_callbacks(self):
+        environ = make_environ('POST', '/orders', b'{"plan": "pro"}')
+        call_app(self.create_middleware(), environ)
+        self.assertNotIn('moesif.request_body', environ)
+        self.assertEqual(environ['moesif.request_body_raw'], b'{"plan": "pro"}')
+        [event] = self.collector.wait_for_events(1)
+        self.assertEqual(event["request"]["body"], {"plan": "pro"})
+
+
+if __name__ == '__main__':
+    unittest.main()
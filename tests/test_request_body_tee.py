@@ -0,0 +1,34 @@
+import io
+import unittest
+
+from moesifwsgi.request_body_tee import RequestBodyTee
+
+
+class RequestBodyTeeTest(unittest.TestCase):
+    def test_records_what_the_app_reads(self):
+        tee = RequestBodyTee(io.BytesIO(b'line one\nline two\nrest'), 100)
+        self.assertEqual(tee.readline(), b'line one\n')
+        self.assertEqual(tee.read(4), b'line')
+        self.assertEqual(tee.read(), b' two\nrest')
+        self.assertEqual(tee.getvalue(), b'line one\nline two\nrest')
+        self.assertFalse(tee.is_truncated())
+
+    def test_only_max_body_size_bytes_are_recorded(self):
+        tee = RequestBodyTee(io.BytesIO(b'x' * 500), 100)
+        for _ in range(5):
+            self.assertEqual(len(tee.read(100)), 100)
+        self.assertEqual(tee.buffer.tell(), 100)
+        self.assertEqual(tee.getvalue(), b'x' * 100)
+        self.assertTrue(tee.is_truncated())
+
+    def test_uncapped_body_is_recorded_whole(self):
+        tee = RequestBodyTee(io.BytesIO(b'x' * 500), None)
+        tee.read()
+        self.assertEqual(tee.getvalue(), b'x' * 500)
+        tee.discard()
+        self.assertIsNone(tee.buffer)
+        self.assertEqual(tee.getvalue(), b'')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,180 @@
+import email.utils
+import time
+import unittest
+from unittest import mock
+
+from moesifapi.configuration import Configuration
+from moesifapi.exceptions.api_exception import APIException
+from moesifapi.moesif_api_client import MoesifAPIClient
+from moesifwsgi.event_sender import EventSender
+from moesifwsgi.retry import CircuitBreaker, CircuitOpenError, parse_retry_after
+from .fake_collector import FakeCollector
+
+
+class RecordingEvent(object):
+    """Stop event which records the retry delays instead of waiting them out"""
+    def __init__(self):
+        self.waits = []
+
+    def wait(self, timeout):
+        self.waits.append(timeout)
+        return False
+
+
+class ParseRetryAfterTest(unittest.TestCase):
+    def test_seconds(self):
+        self.assertEqual(parse_retry_after('5'), 5.0)
+        self.assertEqual(parse_retry_after('-3'), 0.0)
+
+    def test_http_date(self):
+        delay = parse_retry_after(email.utils.formatdate(time.time() + 20, usegmt=True))
+        self.assertTrue(18 <= delay <= 20, delay)
+        self.assertEqual(parse_retry_after(email.utils.formatdate(time.time() - 20, usegmt=True)), 0.0)
+
+    def test_missing_or_invalid(self):
+        self.assertIsNone(parse_retry_after(None))
+        self.assertIsNone(parse_retry_after(''))
+        self.assertIsNone(parse_retry_after('soon'))
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def test_opens_after_the_threshold_and_half_opens_after_the_timeout(self):
+        breaker = CircuitBreaker(2, 0.05)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow())
+        self.assertFalse(breaker.is_available())
+
+        time.sleep(0.06)
+        self.assertTrue(breaker.is_available())
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        # Only a single trial attempt is let through
+        self.assertFalse(breaker.allow())
+
+        # A failed trial opens the circuit again
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertEqual(breaker.opened_count, 2)
+
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(breaker.allow())
+
+
+class RetryTest(unittest.TestCase):
+    """Batches sent to a local fake collector which answers with queued failures"""
+    def setUp(self):
+        self.collector = FakeCollector()
+        self.base_uri = Configuration.BASE_URI
+        Configuration.BASE_URI = self.collector.url
+        self.sender = EventSender(MoesifAPIClient('test').api, compression=False)
+        self.stop_event = RecordingEvent()
+        self.events = [EventSender.serialize_event({"index": 1})]
+
+    def tearDown(self):
+        self.sender.close()
+        Configuration.BASE_URI = self.base_uri
+        self.collector.stop()
+
+    @mock.patch('moesifwsgi.event_sender.backoff_delay', return_value=0)
+    def test_429_waits_for_retry_after_seconds(self, _):
+        self.collector.responses = [(429, [('Retry-After', '7')])]
+        self.sender.send(self.events, self.stop_event)
+        self.assertEqual(self.stop_event.waits, [7.0])
+        self.assertEqual(len(self.collector.batch_requests()), 2)
+        self.assertEqual(self.sender.get_stats()["retries"], 1)
+
+    @mock.patch('moesifwsgi.event_sender.backoff_delay', return_value=0)
+    def test_429_waits_for_retry_after_date(self, _):
+        retry_at = email.utils.formatdate(time.time() + 20, usegmt=True)
+        self.collector.responses = [(429, [('Retry-After', retry_at)])]
+        self.sender.send(self.events, self.stop_event)
+        self.assertEqual(len(self.stop_event.waits), 1)
+        self.assertTrue(18 <= self.stop_event.waits[0] <= 20, self.stop_event.waits)
+
+    def test_retry_after_beyond_max_retry_time_gives_up(self):
+        self.collector.responses = [(429, [('Retry-After', '120')])]
+        with self.assertRaises(APIException):
+            self.sender.send(self.events, self.stop_event)
+        self.assertEqual(self.stop_event.waits, [])
+        self.assertEqual(self.sender.get_stats()["batches_failed"], 1)
+
+    def test_5xx_backs_off_exponentially(self):
+        self.collector.responses = [(503, ()), (500, ()), (502, ())]
+        self.sender.send(self.events, self.stop_event)
+        self.assertEqual(len(self.collector.batch_requests()), 4)
+        self.assertEqual(len(self.stop_event.waits), 3)
+        for attempt, delay in enumerate(self.stop_event.waits):
+            self.assertTrue(0 <= delay <= 0.5 * 2 ** attempt, (attempt, delay))
+        self.assertEqual(self.sender.get_stats()["batches_sent"], 1)
+
+    def test_5xx_gives_up_after_max_retries(self):
+        self.collector.responses = [(503, ())] * 4
+        with self.assertRaises(APIException):
+            self.sender.send(self.events, self.stop_event)
+        self.assertEqual(len(self.collector.batch_requests()), 4)
+        self.assertEqual(self.sender.get_stats()["batches_failed"], 1)
+
+    def test_4xx_is_not_retried(self):
+        self.collector.responses = [(400, ())]
+        with self.assertRaises(APIException):
+            self.sender.send(self.events, self.stop_event)
+        self.assertEqual(len(self.collector.batch_requests()), 1)
+        self.assertEqual(self.stop_event.waits, [])
+        # The collector responded, so the circuit stays closed
+        self.assertEqual(self.sender.circuit_breaker.state, CircuitBreaker.CLOSED)
+
+    def test_connection_error_is_retried_once_per_attempt(self):
+        # The requests client doesn't resend on its own, every attempt is a single request
+        self.collector.responses = [ConnectionResetError(), ConnectionResetError()]
+        self.sender.send(self.events, self.stop_event)
+        self.assertEqual(len(self.collector.batch_requests()), 3)
+        self.assertEqual(len(self.stop_event.waits), 2)
+
+    def test_read_timeout_is_retried(self):
+        sender = EventSender(MoesifAPIClient('test').api, compression=False, timeout=0.2)
+        self.collector.responses = [1]
+        sender.send(self.events, self.stop_event)
+        self.assertEqual(len(self.stop_event.waits), 1)
+        self.assertEqual(len(self.collector.batch_requests()), 2)
+        sender.close()
+
+    def test_read_timeout_opens_the_circuit(self):
+        sender = EventSender(MoesifAPIClient('test').api, compression=False, timeout=0.2, max_retries=0,
+                             circuit_breaker_threshold=1)
+        self.collector.responses = [1]
+        started = time.monotonic()
+        with self.assertRaises(OSError):
+            sender.send(self.events, self.stop_event)
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(sender.circuit_breaker.state, CircuitBreaker.OPEN)
+        self.assertEqual(sender.get_stats()["batches_failed"], 1)
+        with self.assertRaises(CircuitOpenError):
+            sender.send(self.events, self.stop_event)
+        sender.close()
+
+    def test_open_circuit_rejects_batches_until_the_reset_timeout(self):
+        sender = EventSender(MoesifAPIClient('test').api, compression=False, max_retries=0,
+                             circuit_breaker_threshold=1, circuit_breaker_reset_timeout=0.1)
+        self.collector.responses = [(503, ())]
+        with self.assertRaises(APIException):
+            sender.send(self.events, self.stop_event)
+        with self.assertRaises(CircuitOpenError):
+            sender.send(self.events, self.stop_event)
+        self.assertEqual(len(self.collector.batch_requests()), 1)
+        self.assertEqual(sender.get_stats()["batches_rejected"], 1)
+
+        # Half open after the timeout, the successful trial closes the circuit
+        time.sleep(0.12)
+        sender.send(self.events, self.stop_event)
+        self.assertEqual(sender.circuit_breaker.state, CircuitBreaker.CLOSED)
+        sender.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
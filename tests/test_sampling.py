@@ -0,0 +1,48 @@
+import time
+import unittest
+
+from moesifwsgi import MoesifMiddleware
+from .fake_collector import FakeCollector, call_app, make_environ
+
+
+def hello_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [b'hello']
+
+
+class SamplingTest(unittest.TestCase):
+    def setUp(self):
+        self.collector = FakeCollector(config={
+            "sample_rate": 100,
+            "regex_config": [{"conditions": [{"path": "request.ip_address", "value": "^10\\."}], "sample_rate": 0}],
+        })
+        self.middleware = MoesifMiddleware(hello_app, {
+            'APPLICATION_ID': 'test', 'BASE_URI': self.collector.url, 'EVENT_BATCH_TIMEOUT': 0.1,
+        })
+        deadline = time.monotonic() + 5
+        while not self.middleware.config.config_parsed_body.get('regex_config') and time.monotonic() < deadline:
+            time.sleep(0.02)
+
+    def tearDown(self):
+        self.middleware._shutdown()
+        self.collector.stop()
+
+    def test_rule_on_a_missing_field_falls_through_to_the_sample_rate(self):
+        # Without a client address, the rule can't match and the event is kept at the sample rate
+        environ = make_environ()
+        environ.pop('REMOTE_ADDR', None)
+        self.assertEqual(call_app(self.middleware, environ), ('200 OK', b'hello'))
+        events = self.collector.wait_for_events(1)
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]['weight'], 1)
+
+    def test_matching_rule_samples_out(self):
+        call_app(self.middleware, make_environ(REMOTE_ADDR='10.0.0.1'))
+        call_app(self.middleware, make_environ(REMOTE_ADDR='192.168.0.1'))
+        events = self.collector.wait_for_events(1)
+        time.sleep(0.3)
+        self.assertEqual([event['request']['ip_address'] for event in self.collector.events()], ['192.168.0.1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from moesifapi.app_config.app_config import AppConfig
+from moesifapi.configuration import Configuration
+from moesifapi.http.http_response import HttpResponse
+from moesifapi.moesif_api_client import MoesifAPIClient
+from moesifwsgi import shared_config
+from moesifwsgi.shared_config import SharedConfigUpdateManager
+from .fake_collector import FakeCollector
+
+
+class SequenceAppConfig(AppConfig):
+    """Returns a new config of a different size on every fetch, numbered in its body and ETag"""
+    def __init__(self):
+        super().__init__()
+        self.count = 0
+
+    def get_config(self, api_client, debug):
+        self.count += 1
+        body = json.dumps({"n": self.count, "padding": "x" * (self.count % 50 * 100)})
+        return HttpResponse(200, {"X-Moesif-Config-ETag": f"etag-{self.count}"}, body)
+
+
+@unittest.skipUnless(shared_config.fcntl is not None, "requires file locks")
+class SharedConfigUpdateManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.collector = FakeCollector(config={"sample_rate": 50})
+        self.collector.config_etag = 'etag-1'
+        self.base_uri = Configuration.BASE_URI
+        Configuration.BASE_URI = self.collector.url
+        self.api_client = MoesifAPIClient('test').api
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'config')
+
+    def tearDown(self):
+        Configuration.BASE_URI = self.base_uri
+        self.collector.stop()
+
+    def create_manager(self, app_config=None):
+        manager = SharedConfigUpdateManager(self.api_client, app_config or AppConfig(), False, self.path)
+        self.wait_for_update(manager)
+        return manager
+
+    def wait_for_update(self, manager):
+        manager._executor.submit(lambda: None).result()
+
+    def test_one_process_fetches_the_config(self):
+        managers = []
+        threads = [threading.Thread(target=lambda: managers.append(self.create_manager())) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(self.collector.config_requests()), 1)
+        self.assertEqual(sum(manager.get_stats()["config_fetches"] for manager in managers), 1)
+        for manager in managers:
+            self.assertEqual(manager.config_parsed_body, {"sample_rate": 50})
+            self.assertEqual(manager.current_etag, 'etag-1')
+            self.assertEqual(json.loads(manager.config.raw_body), {"sample_rate": 50})
+
+    @mock.patch('moesifwsgi.shared_config.SHARED_CONFIG_MIN_AGE', 0.2)
+    def test_new_etag_is_fetched_once_the_shared_config_is_min_age_old(self):
+        manager = self.create_manager()
+        other = self.create_manager()
+        self.collector.config = {"sample_rate": 10}
+        self.collector.config_etag = 'etag-2'
+
+        # Too soon after the shared config was fetched
+        manager.check_and_update('etag-2')
+        self.wait_for_update(manager)
+        self.assertEqual(len(self.collector.config_requests()), 1)
+        self.assertEqual(manager.current_etag, 'etag-1')
+
+        time.sleep(0.25)
+        manager.check_and_update('etag-2')
+        self.wait_for_update(manager)
+        self.assertEqual(len(self.collector.config_requests()), 2)
+        self.assertEqual(manager.config_parsed_body, {"sample_rate": 10})
+        self.assertEqual(manager.current_etag, 'etag-2')
+
+        # The other process loads it without fetching it
+        other.check_and_update('etag-2')
+        self.wait_for_update(other)
+        self.assertEqual(len(self.collector.config_requests()), 2)
+        self.assertEqual(other.config_parsed_body, {"sample_rate": 10})
+        self.assertEqual(json.loads(other.config.raw_body), {"sample_rate": 10})
+
+    def test_reader_never_loads_a_config_being_published(self):
+        writer = self.create_manager(SequenceAppConfig())
+        reader = self.create_manager()
+        publishing = True
+
+        def publish():
+            while publishing:
+                writer._fetch_and_publish()
+
+        thread = threading.Thread(target=publish)
+        thread.start()
+        try:
+            loaded = set()
+            deadline = time.monotonic() + 1
+            while time.monotonic() < deadline:
+                reader._load()
+                body = reader.config_parsed_body
+                if "n" in body:
+                    self.assertEqual(reader.current_etag, f"etag-{body['n']}")
+                    self.assertEqual(len(body["padding"]), body["n"] % 50 * 100)
+                    loaded.add(body["n"])
+        finally:
+            publishing = False
+            thread.join()
+        self.assertGreater(len(loaded), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
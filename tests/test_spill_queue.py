@@ -0,0 +1,112 @@
+import shutil
+import tempfile
+import unittest
+
+from moesifapi.configuration import Configuration
+from moesifapi.moesif_api_client import MoesifAPIClient
+from moesifwsgi.event_sender import EventSender
+from moesifwsgi.spill_queue import SpillQueue
+from moesifwsgi.workers import Worker
+from .fake_collector import FakeCollector
+
+
+class SpillQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def reopen(self, spill_queue):
+        # Closed without acknowledging, as a process crashing while the events are sent
+        spill_queue.close()
+        spill_queue = SpillQueue(self.directory, 1048576, 4096)
+        self.addCleanup(spill_queue.close)
+        return spill_queue
+
+    def payloads(self, events):
+        return [event.payload for event, _ in events]
+
+    def test_events_are_replayed_until_acknowledged(self):
+        spill_queue = SpillQueue(self.directory, 1048576, 4096)
+        for index in range(3):
+            self.assertTrue(spill_queue.put(b'event %d' % index))
+        events = spill_queue.get(10, 4096)
+        self.assertEqual(self.payloads(events), [b'event 0', b'event 1', b'event 2'])
+        self.assertTrue(spill_queue.empty())
+
+        spill_queue = self.reopen(spill_queue)
+        self.assertEqual(self.payloads(spill_queue.get(10, 4096)), [b'event 0', b'event 1', b'event 2'])
+
+    def test_only_events_acknowledged_in_order_are_done(self):
+        spill_queue = SpillQueue(self.directory, 1048576, 4096)
+        for index in range(3):
+            spill_queue.put(b'event %d' % index)
+        events = [event for event, _ in spill_queue.get(10, 4096)]
+        spill_queue.ack([events[0], events[2]])
+
+        # The second event is still in flight, so the third is replayed with it
+        spill_queue = self.reopen(spill_queue)
+        self.assertEqual(self.payloads(spill_queue.get(10, 4096)), [b'event 1', b'event 2'])
+
+    def test_acknowledged_segments_are_deleted(self):
+        spill_queue = SpillQueue(self.directory, 1048576, 64)
+        for index in range(6):
+            spill_queue.put(b'event %d' % index)
+        events = [event for event, _ in spill_queue.get(10, 4096)]
+        self.assertEqual(len(events), 6)
+        segments = spill_queue.get_stats()["spill_bytes"]
+        spill_queue.ack(events)
+        self.assertLess(spill_queue.get_stats()["spill_bytes"], segments)
+
+        spill_queue = self.reopen(spill_queue)
+        self.assertEqual(spill_queue.get(10, 4096), [])
+
+    def test_attempts_are_kept_on_disk(self):
+        spill_queue = SpillQueue(self.directory, 1048576, 4096)
+        spill_queue.put(b'event', 3)
+        spill_queue = self.reopen(spill_queue)
+        [(event, size)] = spill_queue.get(10, 4096)
+        self.assertEqual((event.payload, event.attempts, size), (b'event', 3, 5))
+
+
+class WorkerSpillTest(unittest.TestCase):
+    def setUp(self):
+        self.collector = FakeCollector()
+        self.base_uri = Configuration.BASE_URI
+        Configuration.BASE_URI = self.collector.url
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.spill_queue = SpillQueue(directory, 1048576, 4096, max_attempts=3)
+        self.addCleanup(self.spill_queue.close)
+        self.sender = EventSender(MoesifAPIClient('test').api, compression=False, max_retries=0)
+        self.worker = Worker(None, self.sender, None, False, lambda event: event, self.spill_queue)
+
+    def tearDown(self):
+        self.sender.close()
+        Configuration.BASE_URI = self.base_uri
+        self.collector.stop()
+
+    def send_spilled_event(self, event):
+        self.worker.send_events(*self.worker.build_events([event]))
+
+    def test_failed_events_are_spilled_until_max_attempts(self):
+        self.collector.responses = [(503, ())] * 3
+        self.worker.send_events([EventSender.serialize_event({"index": 1})])
+        for attempts in (1, 2):
+            [(event, _)] = self.spill_queue.get(10, 4096)
+            self.assertEqual(event.attempts, attempts)
+            self.send_spilled_event(event)
+        # Given up on after the third failure
+        self.assertTrue(self.spill_queue.empty())
+        self.assertEqual(len(self.collector.batch_requests()), 3)
+
+    def test_sent_events_are_acknowledged(self):
+        self.spill_queue.put(EventSender.serialize_event({"index": 1}), 1)
+        [(event, _)] = self.spill_queue.get(10, 4096)
+        self.assertFalse(event.segment.consumed())
+        self.send_spilled_event(event)
+        self.assertEqual(len(self.collector.events()), 1)
+        self.assertTrue(event.segment.consumed())
+
+
+if __name__ == '__main__':
+    unittest.main()
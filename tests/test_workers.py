@@ -0,0 +1,117 @@
+import collections
+import queue
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from moesifapi.configuration import Configuration
+from moesifapi.moesif_api_client import MoesifAPIClient
+from moesifwsgi.event_sender import EventSender
+from moesifwsgi.spill_queue import SpillQueue
+from moesifwsgi.workers import Batcher, BatchedWorkerPool, EventBuffer
+from .fake_collector import FakeCollector
+
+
+class NoConfig(object):
+    def check_and_update(self, response_headers):
+        pass
+
+
+class BatcherTest(unittest.TestCase):
+    def put_batches(self, sizes, max_batch_bytes):
+        batch_queue = queue.Queue()
+        batcher = Batcher(EventBuffer(100), batch_queue, 10, 1, False, max_batch_bytes)
+        pending = collections.deque((index, size) for index, size in enumerate(sizes))
+        batcher._pending_bytes = sum(sizes)
+        while pending:
+            batcher._put_batch(pending)
+        self.assertEqual(batcher._pending_bytes, 0)
+        return list(batch_queue.queue)
+
+    def test_batch_is_split_at_max_batch_bytes(self):
+        # Events adding up to exactly the cap stay in one batch
+        self.assertEqual(self.put_batches([400, 300, 300, 100], 1000), [[0, 1, 2], [3]])
+        self.assertEqual(self.put_batches([400, 300, 301, 100], 1000), [[0, 1], [2, 3]])
+
+    def test_event_larger_than_max_batch_bytes_is_sent_alone(self):
+        self.assertEqual(self.put_batches([100, 1500, 100], 1000), [[0], [1], [2]])
+        self.assertEqual(self.put_batches([1500], 1000), [[0]])
+
+    def test_spilled_events_are_batched_without_lingering(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        spill_queue = SpillQueue(directory, 1048576, 4096)
+        self.addCleanup(spill_queue.close)
+        for index in range(25):
+            spill_queue.put(b'event %d' % index)
+        batch_queue = queue.Queue()
+        batcher = Batcher(EventBuffer(100), batch_queue, 10, 30, False, spill_queue=spill_queue)
+        batcher.start()
+        try:
+            # The full batches are not held back waiting for the input buffer for the 30 seconds timeout
+            batches = [batch_queue.get(timeout=5) for _ in range(2)]
+        finally:
+            batcher.stop()
+            batcher.join(5)
+        self.assertEqual([event.payload for batch in batches for event in batch],
+                         [b'event %d' % index for index in range(20)])
+
+
+class BatchedWorkerPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.collector = FakeCollector()
+        self.base_uri = Configuration.BASE_URI
+        Configuration.BASE_URI = self.collector.url
+        self.api_client = MoesifAPIClient('test').api
+
+    def tearDown(self):
+        Configuration.BASE_URI = self.base_uri
+        self.collector.stop()
+
+    def test_stop_sends_the_batches_left_in_the_queue(self):
+        # The first batch is throttled, so the worker is waiting to retry it when the pool is stopped
+        self.collector.responses = [(429, [('Retry-After', '30')])]
+        pool = BatchedWorkerPool(1, EventSender(self.api_client), NoConfig(), False, 1000, 1, 0.05,
+                                 lambda event: event)
+        for index in range(20):
+            pool.add_event({"index": index}, 20)
+        deadline = time.monotonic() + 5
+        while not self.collector.batch_requests() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        stopping = threading.Thread(target=pool.stop, daemon=True)
+        stopping.start()
+        stopping.join(10)
+        self.assertFalse(stopping.is_alive(), "stop is waiting on the batches left in the queue")
+        # The throttled batch is given up on, the others are sent once without retrying
+        self.assertEqual(len(self.collector.batch_requests()), 20)
+        self.assertEqual(sorted(event["index"] for event in self.collector.events()), list(range(20)))
+        self.assertEqual(pool.get_stats()["batches_failed"], 1)
+
+    def test_events_overflowing_the_queue_are_spilled_off_the_request_thread(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        build_threads = []
+
+        def build_event(event):
+            build_threads.append(threading.current_thread())
+            return event
+
+        pool = BatchedWorkerPool(1, EventSender(self.api_client), NoConfig(), False, 10, 10, 0.05, build_event,
+                                 spill_queue=SpillQueue(directory, 1048576, 65536))
+        # The event queue is full
+        pool.event_queue.put = lambda event, size=0: False
+        try:
+            for index in range(5):
+                self.assertTrue(pool.add_event({"index": index}, 20))
+            self.assertNotIn(threading.current_thread(), build_threads)
+        finally:
+            pool.stop()
+        self.assertEqual(len(build_threads), 5)
+        self.assertEqual(pool.spill_queue.get_stats()["spilled_events"], 5)
+
+
+if __name__ == '__main__':
+    unittest.main()